@@ -1,7 +1,10 @@
+import array
 import datetime
 import logging
 import operator
+import queue
 import sys
+import threading
 import time
 from collections import defaultdict, namedtuple
 from time import sleep
@@ -9,10 +12,16 @@ from time import sleep
 
 from OpenSSL import SSL
 import facebook
+import numpy as np
 
-from db_functions import db_interface_context
+from db_functions import CrawlCheckpoint, db_interface_context
 from slack_notifier import notify_slack
 import config_utils
+import graph_api_client
+import rate_limiter
+
+DEFAULT_FLUSH_MAX_IDS = 100000
+DEFAULT_FLUSH_MAX_SECONDS = 60
 
 SearchRunnerParams = namedtuple(
         'SearchRunnerParams',
@@ -22,19 +31,99 @@ SearchRunnerParams = namedtuple(
          'request_limit',
          'max_requests',
          'stop_at_datetime',
-         ])
+         'rate_limiter',
+         'graph_api_pool_size',
+         'graph_api_max_retries',
+         'checkpoint_max_age',
+         'flush_max_ids',
+         'flush_max_seconds',
+         ],
+        defaults=[None, graph_api_client.DEFAULT_POOL_SIZE, graph_api_client.DEFAULT_MAX_RETRIES,
+                  None, DEFAULT_FLUSH_MAX_IDS, DEFAULT_FLUSH_MAX_SECONDS])
+
+
+# Outcome of one country's active ads sweep in multi-country mode.
+CountrySweepResult = namedtuple('CountrySweepResult',
+                                ['country_code', 'completion_status', 'num_ads_marked_active',
+                                 'graph_error_counts'])
+
+
+class ActiveAdIdBuffer():
+    """Buffer of active ad archive IDs accumulated across API results pages until a flush threshold
+    is reached.
+
+    IDs are stored as a compact int64 array and deduped when drained.
+    """
+
+    def __init__(self, max_ids, max_seconds, clock=time.monotonic):
+        """
+        Args:
+            max_ids: int number of buffered IDs (including duplicates) after which buffer should be
+                flushed.
+            max_seconds: float seconds since last flush after which buffer should be flushed.
+            clock: function returning current time in seconds.
+        """
+        self._max_ids = max_ids
+        self._max_seconds = max_seconds
+        self._clock = clock
+        self._archive_ids = array.array('q')
+        self._last_flush_time = clock()
+
+    def __len__(self):
+        return len(self._archive_ids)
+
+    def add(self, archive_id):
+        self._archive_ids.append(archive_id)
+
+    def should_flush(self):
+        return bool(self._archive_ids) and (
+            len(self._archive_ids) >= self._max_ids or
+            self._clock() - self._last_flush_time >= self._max_seconds)
+
+    def drain(self):
+        """Empty buffer and reset flush timer.
+
+        Returns:
+            list of unique int archive IDs that were buffered, sorted ascending.
+        """
+        archive_ids = np.unique(np.frombuffer(self._archive_ids, dtype=np.int64)).tolist()
+        self._archive_ids = array.array('q')
+        self._last_flush_time = self._clock()
+        return archive_ids
 
 
 class SearchRunner():
 
-    def __init__(self, database_connection_params, search_runner_params):
+    def __init__(self, database_connection_params, search_runner_params, graph=None):
+        """
+        Args:
+            database_connection_params: config_utils.DatabaseConnectionParams.
+            search_runner_params: SearchRunnerParams.
+            graph: facebook.GraphAPI to share with other SearchRunners (ie from
+                graph_api_client.make_graph_api). A new one is made if None.
+        """
         self.country_code = search_runner_params.country_code
         self.database_connection_params = database_connection_params
         self.fb_access_token = search_runner_params.facebook_access_token
         self.sleep_time = search_runner_params.sleep_time
         self.request_limit = search_runner_params.request_limit
         self.max_requests = search_runner_params.max_requests
-        self.active_ads = []
+        # Optional rate_limiter.AdaptiveRateController. If set it replaces sleeping sleep_time after
+        # every request.
+        self.rate_limiter = search_runner_params.rate_limiter
+        # Shared by all fetchers, and kept across errors so connections are reused.
+        self.graph = graph or graph_api_client.make_graph_api(
+            self.fb_access_token, rate_limiter=self.rate_limiter,
+            pool_size=search_runner_params.graph_api_pool_size,
+            max_retries=search_runner_params.graph_api_max_retries)
+        # datetime.timedelta max age of crawl checkpoint to resume from. None disables
+        # checkpointing.
+        self.checkpoint_max_age = search_runner_params.checkpoint_max_age
+        # Active ad IDs are written (with the checkpoint of the last buffered page) when buffer
+        # reaches flush_max_ids IDs or flush_max_seconds since last write, and when search ends.
+        self.active_ads = ActiveAdIdBuffer(search_runner_params.flush_max_ids,
+                                           search_runner_params.flush_max_seconds)
+        self.pending_checkpoint = None
         self.total_ads_marked_active = 0
         self.graph_error_counts = defaultdict(int)
         self.ad_delivery_date_arg = datetime.date.today() - datetime.timedelta(days=1)
@@ -45,20 +134,39 @@ class SearchRunner():
                          search_runner_params.stop_at_datetime, self.stop_time)
 
     def run_search(self):
+        try:
+            self.fetch_active_ads()
+        finally:
+            # Write IDs buffered before deadline, max requests, or an exception ended the search.
+            self.write_results()
+
+    def fetch_active_ads(self):
         #get ads
-        graph = facebook.GraphAPI(access_token=self.fb_access_token, version='7.0')
+        graph = self.graph
         has_next = True
         next_cursor = ""
         backoff_multiplier = 1
         logging.info(datetime.datetime.now())
+        # Cumulative requests of the sweep (stored in checkpoints), and requests made by this run
+        # (limited to max_requests, so that a resumed sweep gets a full request budget).
         request_count = 0
+        num_requests_this_run = 0
         ad_delivery_date_arg_isoformat = self.ad_delivery_date_arg.isoformat()
-        while (has_next and request_count < self.max_requests and
+        query = 'active_ads:%s' % ad_delivery_date_arg_isoformat
+        checkpoint = self.load_checkpoint(query)
+        if checkpoint:
+            logging.info('Resuming %s from request %d.', query, checkpoint.request_count)
+            next_cursor = checkpoint.cursor or ""
+            request_count = checkpoint.request_count
+        while (has_next and num_requests_this_run < self.max_requests and
                self.allowed_execution_time_remaining()):
             request_count += 1
+            num_requests_this_run += 1
             total_ad_count = 0
             try:
                 results = None
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
                 logging.info(f"making active ads request")
                 logging.info(f"making request {request_count}")
                 results = graph.get_object(
@@ -73,6 +181,8 @@ class SearchRunner():
                     fields="id",
                     after=next_cursor)
                 backoff_multiplier = 1
+                if self.rate_limiter:
+                    self.rate_limiter.on_success()
             except facebook.GraphAPIError as e:
                 logging.error("Graph Error")
                 logging.error(e.code)
@@ -96,11 +206,11 @@ class SearchRunner():
                     backoff_multiplier *= 4
                     logging.info('Rate liimit exceeded, back off multiplier is now %d.',
                                  backoff_multiplier)
+                    if self.rate_limiter:
+                        self.rate_limiter.on_throttle(self.sleep_time * backoff_multiplier)
                 else:
                     backoff_multiplier += 1
 
-                logging.info("resetting graph")
-                graph = facebook.GraphAPI(access_token=self.fb_access_token)
                 continue
 
             except OSError as e:
@@ -108,19 +218,18 @@ class SearchRunner():
                 logging.error(datetime.datetime.now())
                 # Reset backoff multiplier since this is a local OS issue and not an API issue.
                 backoff_multiplier = 1
-                logging.info("resetting graph")
-                graph = facebook.GraphAPI(access_token=self.fb_access_token)
                 continue
 
             except SSL.SysCallError as e:
                 logging.error(e)
                 backoff_multiplier += backoff_multiplier
-                logging.error("resetting graph")
-                graph = facebook.GraphAPI(access_token=self.fb_access_token)
                 continue
 
             finally:
                 sleep_time = self.sleep_time * backoff_multiplier
+                if self.rate_limiter and backoff_multiplier == 1:
+                    # Request rate is governed by the rate limiter, only sleep to back off errors.
+                    sleep_time = 0
                 logging.info(f"waiting for {sleep_time} seconds before next query.")
                 sleep(sleep_time)
 
@@ -129,20 +238,25 @@ class SearchRunner():
                 active_ad_id = result.get('id', None)
                 if active_ad_id:
                     try:
-                        self.active_ads.append(int(active_ad_id))
+                        self.active_ads.add(int(active_ad_id))
                     except ValueError as error:
                         logging.warning('Unable to convert "id" from result %s to int. %s', result,
                                         error)
 
 
-            #we finished parsing all ads in the result
-            self.write_results()
-
             if "paging" in results and "next" in results["paging"]:
                 next_cursor = results["paging"]["cursors"]["after"]
             else:
                 has_next = False
 
+            #we finished parsing all ads in the result
+            self.pending_checkpoint = CrawlCheckpoint(
+                country_code=self.country_code, query=query,
+                cursor=next_cursor if has_next else None, request_count=request_count,
+                completed=not has_next)
+            if self.active_ads.should_flush():
+                self.write_results()
+
 
     def allowed_execution_time_remaining(self):
         # No deadline configured.
@@ -156,14 +270,36 @@ class SearchRunner():
         return True
 
 
+    def load_checkpoint(self, query):
+        """Get resumable CrawlCheckpoint of query, or None if not found, completed, or
+        checkpointing is disabled."""
+        if self.checkpoint_max_age is None:
+            return None
+        with db_interface_context(self.database_connection_params) as db_interface:
+            return db_interface.crawl_checkpoints(self.country_code,
+                                                  self.checkpoint_max_age).get(query)
+
     def write_results(self):
-        #write new ads to our database
-        num_active_ads = len(self.active_ads)
-        logging.info("marking %d ads as active %s", num_active_ads, self.ad_delivery_date_arg)
+        """Write buffered active ad IDs, and checkpoint of last buffered page."""
+        checkpoint = self.pending_checkpoint
+        if not self.active_ads and not checkpoint:
+            return
+        num_buffered_ids = len(self.active_ads)
+        active_ads = self.active_ads.drain()
+        self.pending_checkpoint = None
+        num_active_ads = len(active_ads)
+        logging.info("marking %d ads (%d before dedupe) as active %s", num_active_ads,
+                     num_buffered_ids, self.ad_delivery_date_arg)
+        start_time = time.monotonic()
         with db_interface_context(self.database_connection_params) as db_interface:
-            db_interface.update_ad_last_active_date(self.ad_delivery_date_arg, self.active_ads)
+            num_rows_updated = db_interface.update_ad_last_active_date(self.ad_delivery_date_arg,
+                                                                       active_ads)
+            if self.checkpoint_max_age is not None and checkpoint:
+                db_interface.upsert_crawl_checkpoints([checkpoint])
+        seconds = time.monotonic() - start_time
+        logging.info('Updated last_active_date of %d impressions rows in %.3f seconds (%.1f rows/'
+                     'second).', num_rows_updated, seconds, num_rows_updated / (seconds or 1))
         self.total_ads_marked_active += num_active_ads
-        self.active_ads = []
 
 
     def get_formatted_graph_error_counts(self, delimiter='\n'):
@@ -188,6 +324,73 @@ class SearchRunner():
         return self.total_ads_marked_active
 
 
+def run_multi_country_search(database_connection_params, search_runner_params, country_codes,
+                             num_workers):
+    """Run active ads sweep of each country in country_codes with num_workers concurrent sweeps.
+
+    All sweeps share one Graph API session and search_runner_params.rate_limiter, and database
+    connections come from the process wide connection pool. A failed sweep does not stop sweeps of
+    other countries.
+
+    Args:
+        database_connection_params: config_utils.DatabaseConnectionParams.
+        search_runner_params: SearchRunnerParams, country_code is replaced by each country code.
+        country_codes: list of str country codes to sweep.
+        num_workers: int max number of countries swept concurrently.
+    Returns:
+        list of CountrySweepResult in country_codes order.
+    """
+    graph = graph_api_client.make_graph_api(
+        search_runner_params.facebook_access_token,
+        rate_limiter=search_runner_params.rate_limiter,
+        pool_size=max(num_workers, search_runner_params.graph_api_pool_size),
+        max_retries=search_runner_params.graph_api_max_retries)
+    pending_country_codes = queue.Queue()
+    for country_code in country_codes:
+        pending_country_codes.put(country_code)
+    sweep_results = {}
+    stop_sweeping = threading.Event()
+
+    def sweep_countries():
+        while not stop_sweeping.is_set():
+            try:
+                country_code = pending_country_codes.get_nowait()
+            except queue.Empty:
+                return
+            logging.info('Starting active ads sweep of %s', country_code)
+            search_runner = SearchRunner(
+                database_connection_params,
+                search_runner_params._replace(country_code=country_code), graph=graph)
+            completion_status = 'Failure'
+            try:
+                search_runner.run_search()
+                completion_status = 'Success'
+            except Exception as e:
+                completion_status = f'Uncaught exception: {e}'
+                logging.error('%s active ads sweep failed: %s', country_code, completion_status,
+                              exc_info=True)
+                if isinstance(e, facebook.GraphAPIError) and e.code == 190:
+                    # Access token expired, sweeps of remaining countries would fail too.
+                    stop_sweeping.set()
+            sweep_results[country_code] = CountrySweepResult(
+                country_code=country_code, completion_status=completion_status,
+                num_ads_marked_active=search_runner.num_ads_marked(),
+                graph_error_counts=search_runner.get_formatted_graph_error_counts(delimiter=', '))
+            logging.info('Finished active ads sweep of %s: %s', country_code,
+                         sweep_results[country_code])
+
+    workers = [threading.Thread(target=sweep_countries, name='active_ads_sweeper_%d' % i,
+                                daemon=True)
+               for i in range(min(num_workers, len(country_codes)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return [sweep_results.get(country_code, CountrySweepResult(
+        country_code=country_code, completion_status='Not started', num_ads_marked_active=0,
+        graph_error_counts='')) for country_code in country_codes]
+
+
 def min_expected_active_ads_met(num_ads_marked_active, min_expected_active_ads):
     return num_ads_marked_active >= min_expected_active_ads
 
@@ -214,6 +417,33 @@ def send_completion_slack_notification(
         f"Completion status {completion_status}. {graph_error_count_string}")
     notify_slack(slack_url, completion_message)
 
+def multi_country_sweep_succeeded(sweep_results, min_expected_active_ads):
+    return all(result.completion_status == 'Success' and
+               min_expected_active_ads_met(result.num_ads_marked_active, min_expected_active_ads)
+               for result in sweep_results)
+
+def send_multi_country_completion_slack_notification(slack_url, sweep_results, start_time,
+                                                     end_time, min_expected_active_ads):
+    """Send one completion message summarizing sweeps of all countries."""
+    duration_minutes = (end_time - start_time).seconds / 60
+    country_msgs = []
+    for result in sweep_results:
+        country_msg = (f"{result.country_code.upper()}: {result.num_ads_marked_active} active ads, "
+                       f"status {result.completion_status}.")
+        if not min_expected_active_ads_met(result.num_ads_marked_active, min_expected_active_ads):
+            country_msg = (f":rotating_light: {country_msg} Minimum expected records not met! "
+                           f"Ads expected: {min_expected_active_ads}")
+            logging.error(country_msg)
+        if result.graph_error_counts:
+            country_msg += f" {result.graph_error_counts}"
+        country_msgs.append(country_msg)
+    total_ads_marked_active = sum(result.num_ads_marked_active for result in sweep_results)
+    completion_message = (
+        f"Active ads collection started at {start_time} for {len(sweep_results)} countries "
+        f"completed in {duration_minutes} minutes. Added active {total_ads_marked_active} ads.\n" +
+        '\n'.join(country_msgs))
+    notify_slack(slack_url, completion_message)
+
 def get_stop_at_datetime(stop_at_time_str):
     """Get datetime for today at the clock time in ISO format.
 
@@ -242,15 +472,53 @@ def main(config):
     stop_at_datetime = get_stop_at_datetime(
         config.get('SEARCH', 'STOP_AT_CLOCK_TIME', fallback='23:55'))
 
+    # Resume interrupted search from checkpoint saved within this many hours. 0 disables.
+    checkpoint_max_age_hours = config.getfloat('SEARCH', 'CHECKPOINT_MAX_AGE_HOURS', fallback=0)
+    checkpoint_max_age = None
+    if checkpoint_max_age_hours:
+        checkpoint_max_age = datetime.timedelta(hours=checkpoint_max_age_hours)
+
+    # Sweep all these countries from this process (sharing one rate limiter, Graph API session and
+    # DB connection pool) instead of only COUNTRY_CODE.
+    country_codes = [country_code.strip() for country_code in
+                     config.get('SEARCH', 'COUNTRY_CODES', fallback='').split(',')
+                     if country_code.strip()]
+
     search_runner_params = SearchRunnerParams(
-        country_code=config['SEARCH']['COUNTRY_CODE'],
+        country_code=config.get('SEARCH', 'COUNTRY_CODE', fallback=None),
         facebook_access_token=config_utils.get_facebook_access_token(config),
         sleep_time=config.getint('SEARCH', 'SLEEP_TIME'),
         request_limit=config.getint('SEARCH', 'LIMIT'),
         max_requests=config.getint('SEARCH', 'MAX_REQUESTS'),
-        stop_at_datetime=stop_at_datetime)
+        stop_at_datetime=stop_at_datetime,
+        rate_limiter=rate_limiter.make_adaptive_rate_controller_from_config(config),
+        graph_api_pool_size=config.getint('SEARCH', 'GRAPH_API_POOL_SIZE',
+                                          fallback=graph_api_client.DEFAULT_POOL_SIZE),
+        graph_api_max_retries=config.getint('SEARCH', 'GRAPH_API_MAX_RETRIES',
+                                            fallback=graph_api_client.DEFAULT_MAX_RETRIES),
+        checkpoint_max_age=checkpoint_max_age,
+        flush_max_ids=config.getint('SEARCH', 'FLUSH_MAX_IDS', fallback=DEFAULT_FLUSH_MAX_IDS),
+        flush_max_seconds=config.getfloat('SEARCH', 'FLUSH_MAX_SECONDS',
+                                          fallback=DEFAULT_FLUSH_MAX_SECONDS))
 
     database_connection_params = config_utils.get_database_connection_params_from_config(config)
+    if country_codes:
+        start_time = datetime.datetime.now()
+        notify_slack(slack_url_info_channel,
+                     f"Starting active ad collection at {start_time} for "
+                     f"{', '.join(country_codes).upper()}")
+        sweep_results = run_multi_country_search(
+            database_connection_params, search_runner_params, country_codes,
+            num_workers=config.getint('SEARCH', 'NUM_COUNTRY_WORKERS',
+                                      fallback=len(country_codes)))
+        slack_url_for_completion_msg = slack_url_error_channel
+        if multi_country_sweep_succeeded(sweep_results, min_expected_active_ads):
+            slack_url_for_completion_msg = slack_url_info_channel
+        send_multi_country_completion_slack_notification(
+            slack_url_for_completion_msg, sweep_results, start_time, datetime.datetime.now(),
+            min_expected_active_ads)
+        return
+
     search_runner = SearchRunner(database_connection_params, search_runner_params)
     start_time = datetime.datetime.now()
     country_code_uppercase = search_runner_params.country_code.upper()
@@ -280,7 +548,7 @@ def main(config):
 
 if __name__ == '__main__':
     config = config_utils.get_config(sys.argv[1])
-    country_code = config['SEARCH']['COUNTRY_CODE'].lower()
+    country_code = config.get('SEARCH', 'COUNTRY_CODE', fallback='multi_country').lower()
 
     config_utils.configure_logger(f"{country_code}_active_ads_fb_api_collection.log")
     if len(sys.argv) < 2:
@@ -0,0 +1,45 @@
+import unittest
+
+from active_ads_fb_collector import ActiveAdIdBuffer
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ActiveAdIdBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.buffer = ActiveAdIdBuffer(max_ids=3, max_seconds=10, clock=self.clock)
+
+    def testFlushAfterMaxIds(self):
+        self.buffer.add(1)
+        self.buffer.add(2)
+        self.assertFalse(self.buffer.should_flush())
+        self.buffer.add(2)
+        self.assertTrue(self.buffer.should_flush())
+
+    def testFlushAfterMaxSeconds(self):
+        self.clock.now = 11
+        self.assertFalse(self.buffer.should_flush())
+        self.buffer.add(1)
+        self.assertTrue(self.buffer.should_flush())
+
+    def testDrainDedupesAndResets(self):
+        for archive_id in [5, 3, 5, 10**15, 3]:
+            self.buffer.add(archive_id)
+        self.clock.now = 20
+        self.assertEqual(self.buffer.drain(), [3, 5, 10**15])
+        self.assertEqual(len(self.buffer), 0)
+        self.buffer.add(1)
+        self.assertFalse(self.buffer.should_flush())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""CPU bound feature extraction (hashes and language) of ad creatives.
+
+Functions in this module are run in worker processes of a concurrent.futures.ProcessPoolExecutor
+(see make_creative_features_executor), so they only take and return picklable values and this
+module avoids importing browser or storage dependencies.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import io
+import multiprocessing
+
+import dhash
+from langdetect import detect
+from langdetect import DetectorFactory
+from langdetect.lang_detect_exception import LangDetectException
+from PIL import Image
+
+import sim_hash_ad_creative_text
+
+CreativeFeatures = collections.namedtuple('CreativeFeatures', [
+    'image_dhash',
+    'image_sha256_hash',
+    # str description of error decoding image, or None.
+    'image_error',
+    'text_sim_hash',
+    'text_sha256_hash',
+    'text_language',
+])
+
+
+def get_image_dhash(image_bytes):
+    image_file = io.BytesIO(image_bytes)
+    image = Image.open(image_file)
+    dhash.force_pil()
+    row, col = dhash.dhash_row_col(image)
+    image_dhash = dhash.format_hex(row, col)
+    return image_dhash
+
+
+def init_worker():
+    # Force consistent langdetect results. https://pypi.org/project/langdetect/
+    DetectorFactory.seed = 0
+
+
+def compute_creative_features(image_bytes, text):
+    """Compute image hashes and text hashes and language of an ad creative.
+
+    Args:
+        image_bytes: bytes of creative image, or None.
+        text: str creative body, or None.
+    Returns:
+        CreativeFeatures. Image fields are None if there is no image, or it could not be decoded
+        (in which case image_error is set). Text fields are None if there is no text, and
+        text_language is None if it could not be detected.
+    """
+    image_dhash = None
+    image_sha256_hash = None
+    image_error = None
+    if image_bytes:
+        try:
+            image_dhash = get_image_dhash(image_bytes)
+            image_sha256_hash = hashlib.sha256(image_bytes).hexdigest()
+        except OSError as error:
+            image_error = str(error)
+
+    text_sim_hash = None
+    text_sha256_hash = None
+    text_language = None
+    if text:
+        # Get simhash as hex without leading '0x'
+        text_sim_hash = '%x' % sim_hash_ad_creative_text.hash_ad_creative_text(text)
+        text_sha256_hash = hashlib.sha256(bytes(text, encoding='UTF-32')).hexdigest()
+        try:
+            text_language = detect(text)
+        except LangDetectException:
+            text_language = None
+
+    return CreativeFeatures(
+        image_dhash=image_dhash, image_sha256_hash=image_sha256_hash, image_error=image_error,
+        text_sim_hash=text_sim_hash, text_sha256_hash=text_sha256_hash,
+        text_language=text_language)
+
+
+def make_creative_features_executor(num_workers):
+    """Get ProcessPoolExecutor for compute_creative_features with num_workers processes.
+
+    Workers are started with spawn rather than fork, because they are started on first use, after
+    the retrieval, upload, and lease heartbeat threads are running. Forking then could copy locks
+    held by those threads into the workers.
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker)
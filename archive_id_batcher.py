@@ -1,4 +1,5 @@
 """Module to make batches of unfetched archive IDs and store them in the DB."""
+import datetime
 import sys
 
 import db_functions
@@ -6,16 +7,46 @@ import config_utils
 
 DEFAULT_BATCH_SIZE = 1000
 DEFAULT_MIN_AD_CREATION_DATE = '2019-01-01'
+# Snapshots whose impressions or page coverage changed within this many hours are rescored. Should
+# exceed time between runs.
+DEFAULT_RESCORE_LOOKBACK_HOURS = 25
+
+
+def get_priority_weights_from_config(config):
+    default_weights = db_functions.DEFAULT_SNAPSHOT_FETCH_PRIORITY_WEIGHTS
+    return db_functions.SnapshotFetchPriorityWeights(
+        max_spend_weight=config.getfloat('SNAPSHOT_FETCH_PRIORITY', 'MAX_SPEND_WEIGHT',
+                                         fallback=default_weights.max_spend_weight),
+        recently_active_weight=config.getfloat('SNAPSHOT_FETCH_PRIORITY', 'RECENTLY_ACTIVE_WEIGHT',
+                                               fallback=default_weights.recently_active_weight),
+        recently_active_days=config.getint('SNAPSHOT_FETCH_PRIORITY', 'RECENTLY_ACTIVE_DAYS',
+                                           fallback=default_weights.recently_active_days),
+        page_coverage_weight=config.getfloat('SNAPSHOT_FETCH_PRIORITY', 'PAGE_COVERAGE_WEIGHT',
+                                             fallback=default_weights.page_coverage_weight))
+
 
 def main(config):
     country_code = config.get('SEARCH', 'COUNTRY_CODE', fallback=None)
     min_ad_creation_date = config.get('SEARCH', 'MIN_AD_CREATION_DATE',
                                       fallback=DEFAULT_MIN_AD_CREATION_DATE)
+    priority_weights = get_priority_weights_from_config(config)
+    rescore_lookback_hours = config.getint('SNAPSHOT_FETCH_PRIORITY', 'RESCORE_LOOKBACK_HOURS',
+                                           fallback=DEFAULT_RESCORE_LOOKBACK_HOURS)
+    modified_since = (datetime.datetime.now(datetime.timezone.utc) -
+                      datetime.timedelta(hours=rescore_lookback_hours))
     with config_utils.get_database_connection_from_config(config) as database_connection:
         database_interface = db_functions.DBInterface(database_connection)
+        # Snapshots that are now higher priority than their batch are removed from it, and batched
+        # again below with the new snapshots.
+        database_interface.reprioritize_snapshot_fetch_batches(modified_since,
+                                                              priority_weights=priority_weights)
+        # Committed separately so that rescored batches are not locked (and skipped by claims)
+        # while new batches are made, and rescoring is kept if batching fails.
+        database_connection.commit()
         database_interface.make_snapshot_fetch_batches(batch_size=DEFAULT_BATCH_SIZE,
                                                        country_code=country_code,
-                                                       min_ad_creation_date=min_ad_creation_date)
+                                                       min_ad_creation_date=min_ad_creation_date,
+                                                       priority_weights=priority_weights)
 
 if __name__ == '__main__':
     config_utils.configure_logger('archive_id_batcher.log')
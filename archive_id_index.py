@@ -0,0 +1,81 @@
+"""Compact, memory-bounded set of ad archive IDs.
+
+Archive IDs are stored as a sorted array of signed 64 bit ints (8 bytes per ID) and membership is
+checked with binary search. IDs added after the index is built are kept in a small set that is
+periodically merged into the sorted array.
+"""
+import array
+import bisect
+import heapq
+import logging
+
+# Number of pending IDs to accumulate before merging them into the sorted array.
+DEFAULT_MERGE_THRESHOLD = 100000
+_ARRAY_TYPECODE = 'q'
+
+
+class ArchiveIdIndex:
+    """Set-like container of int archive IDs. Supports `in`, len() and add()."""
+
+    def __init__(self, merge_threshold=DEFAULT_MERGE_THRESHOLD):
+        self._sorted_ids = array.array(_ARRAY_TYPECODE)
+        self._pending_ids = set()
+        self._merge_threshold = merge_threshold
+
+    @classmethod
+    def from_sorted_ids(cls, sorted_archive_ids, merge_threshold=DEFAULT_MERGE_THRESHOLD):
+        """Build index from an iterable of archive IDs in ascending order.
+
+        Args:
+            sorted_archive_ids: iterable of int archive IDs sorted in ascending order (ie
+                DBInterface.stream_archive_ids()).
+            merge_threshold: int number of added IDs to hold before merging into sorted array.
+        Returns:
+            ArchiveIdIndex containing all provided IDs.
+        Raises:
+            ValueError if sorted_archive_ids is not sorted.
+        """
+        index = cls(merge_threshold=merge_threshold)
+        sorted_ids = index._sorted_ids
+        previous_id = None
+        for archive_id in sorted_archive_ids:
+            if previous_id is not None and archive_id <= previous_id:
+                if archive_id == previous_id:
+                    continue
+                raise ValueError('archive IDs must be in ascending order. %s followed %s' % (
+                    archive_id, previous_id))
+            sorted_ids.append(archive_id)
+            previous_id = archive_id
+        logging.info('Built archive ID index of %d IDs (%d bytes)', len(sorted_ids),
+                     sorted_ids.itemsize * len(sorted_ids))
+        return index
+
+    def __contains__(self, archive_id):
+        if archive_id in self._pending_ids:
+            return True
+        sorted_ids = self._sorted_ids
+        position = bisect.bisect_left(sorted_ids, archive_id)
+        return position < len(sorted_ids) and sorted_ids[position] == archive_id
+
+    def __len__(self):
+        return len(self._sorted_ids) + len(self._pending_ids)
+
+    def add(self, archive_id):
+        """Add archive_id to index. No-op if already present."""
+        if archive_id in self:
+            return
+        self._pending_ids.add(archive_id)
+        if len(self._pending_ids) >= self._merge_threshold:
+            self._merge_pending_ids()
+
+    def update(self, archive_ids):
+        for archive_id in archive_ids:
+            self.add(archive_id)
+
+    def _merge_pending_ids(self):
+        merged_ids = array.array(_ARRAY_TYPECODE,
+                                 heapq.merge(self._sorted_ids, sorted(self._pending_ids)))
+        logging.debug('Merged %d pending archive IDs into index of %d IDs',
+                      len(self._pending_ids), len(self._sorted_ids))
+        self._sorted_ids = merged_ids
+        self._pending_ids = set()
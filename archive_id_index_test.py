@@ -0,0 +1,34 @@
+import unittest
+
+from archive_id_index import ArchiveIdIndex
+
+
+class ArchiveIdIndexTest(unittest.TestCase):
+
+    def testMembershipFromSortedIds(self):
+        index = ArchiveIdIndex.from_sorted_ids([1, 5, 5, 9, 2**62])
+        self.assertEqual(len(index), 4)
+        for archive_id in (1, 5, 9, 2**62):
+            self.assertIn(archive_id, index)
+        for archive_id in (0, 2, 10, 2**62 + 1):
+            self.assertNotIn(archive_id, index)
+
+    def testUnsortedIdsRaises(self):
+        with self.assertRaises(ValueError):
+            ArchiveIdIndex.from_sorted_ids([3, 2])
+
+    def testAddMergesPendingIds(self):
+        index = ArchiveIdIndex.from_sorted_ids([10, 20, 30], merge_threshold=2)
+        index.add(15)
+        index.add(20)
+        self.assertEqual(len(index), 4)
+        index.add(5)
+        self.assertEqual(list(index._sorted_ids), [5, 10, 15, 20, 30])
+        self.assertFalse(index._pending_ids)
+        for archive_id in (5, 10, 15, 20, 30):
+            self.assertIn(archive_id, index)
+        self.assertNotIn(25, index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""Background upload of blobs to storage buckets, and a local filesystem bucket client."""
+import collections
+import concurrent.futures
+import logging
+import os
+import shutil
+import threading
+
+DEFAULT_MAX_UPLOAD_WORKERS = 8
+DEFAULT_MAX_PENDING_BYTES = 256 * 1024 * 1024
+DEFAULT_STORED_BLOB_PATH_CACHE_SIZE = 100000
+
+
+class BlobUploader:
+    """Uploads blobs on a bounded pool of threads.
+
+    submit() blocks while the total size of blobs submitted but not yet uploaded would exceed
+    max_pending_bytes, so that a slow bucket applies backpressure instead of buffering unbounded
+    media in memory. A blob larger than max_pending_bytes is accepted once nothing else is pending.
+    """
+
+    def __init__(self, upload_function, max_workers=DEFAULT_MAX_UPLOAD_WORKERS,
+                 max_pending_bytes=DEFAULT_MAX_PENDING_BYTES):
+        """
+        Args:
+            upload_function: function(bucket_client, blob_path, blob_data) that uploads blob and
+                returns blob ID. blob_data is bytes or a binary file object.
+            max_workers: int max number of concurrent uploads.
+            max_pending_bytes: int max total size of blobs submitted but not yet uploaded.
+        """
+        self._upload_function = upload_function
+        self._max_pending_bytes = max_pending_bytes
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='blob_uploader')
+        self._pending_bytes_condition = threading.Condition()
+        self._pending_bytes = 0
+        self._pending_uploads = []
+
+    def _upload(self, bucket_client, blob_path, blob_data, blob_size):
+        try:
+            blob_id = self._upload_function(bucket_client, blob_path, blob_data)
+            logging.debug('Uploaded %s', blob_id)
+            return blob_id
+        finally:
+            if not isinstance(blob_data, bytes):
+                blob_data.close()
+            with self._pending_bytes_condition:
+                self._pending_bytes -= blob_size
+                self._pending_bytes_condition.notify_all()
+
+    def submit(self, bucket_client, blob_path, blob_data, blob_size=None):
+        """Queue upload of blob_data to blob_path in bucket_client. Blocks while too many bytes are
+        pending upload.
+
+        Args:
+            bucket_client: bucket to upload to.
+            blob_path: str path of blob in bucket.
+            blob_data: bytes, or binary file object (ie tempfile.SpooledTemporaryFile) which is
+                closed after upload.
+            blob_size: int size of blob_data in bytes. Required if blob_data is a file object.
+        Returns:
+            concurrent.futures.Future of uploaded blob ID.
+        """
+        if blob_size is None:
+            blob_size = len(blob_data)
+        with self._pending_bytes_condition:
+            self._pending_bytes_condition.wait_for(
+                lambda: (not self._pending_bytes or
+                         self._pending_bytes + blob_size <= self._max_pending_bytes))
+            self._pending_bytes += blob_size
+        upload_future = self._executor.submit(self._upload, bucket_client, blob_path, blob_data,
+                                              blob_size)
+        self._pending_uploads.append(upload_future)
+        return upload_future
+
+    def wait_for_uploads(self):
+        """Block until all submitted uploads are complete.
+
+        Raises:
+            First exception raised by an upload, after all uploads have completed.
+        """
+        pending_uploads = self._pending_uploads
+        self._pending_uploads = []
+        concurrent.futures.wait(pending_uploads)
+        for upload_future in pending_uploads:
+            upload_future.result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class StoredBlobPathCache:
+    """LRU set of blob paths known to be stored in a content addressed bucket."""
+
+    def __init__(self, max_size=DEFAULT_STORED_BLOB_PATH_CACHE_SIZE):
+        self._max_size = max_size
+        self._blob_paths = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._blob_paths)
+
+    def __contains__(self, blob_path):
+        if blob_path not in self._blob_paths:
+            return False
+        self._blob_paths.move_to_end(blob_path)
+        return True
+
+    def add(self, blob_path):
+        self._blob_paths[blob_path] = None
+        self._blob_paths.move_to_end(blob_path)
+        if len(self._blob_paths) > self._max_size:
+            self._blob_paths.popitem(last=False)
+
+    def discard(self, blob_path):
+        self._blob_paths.pop(blob_path, None)
+
+
+class LocalFilesystemBlob:
+    """Subset of google.cloud.storage.Blob API backed by a local file."""
+
+    def __init__(self, bucket_dir, blob_path):
+        self.path = os.path.join(bucket_dir, blob_path)
+        self.id = self.path
+
+    def upload_from_string(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        partial_path = '%s.%d.%d.partial' % (self.path, os.getpid(), threading.get_ident())
+        with open(partial_path, 'wb') as blob_file:
+            blob_file.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+        os.replace(partial_path, self.path)
+
+    def upload_from_file(self, file_obj, rewind=False):
+        if rewind:
+            file_obj.seek(0)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        partial_path = '%s.%d.%d.partial' % (self.path, os.getpid(), threading.get_ident())
+        with open(partial_path, 'wb') as blob_file:
+            shutil.copyfileobj(file_obj, blob_file)
+        os.replace(partial_path, self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+class LocalFilesystemBucketClient:
+    """Subset of google.cloud.storage.Bucket API storing blobs under a local directory. For testing
+    and running without GCS."""
+
+    def __init__(self, bucket_dir):
+        self.bucket_dir = bucket_dir
+
+    def blob(self, blob_path):
+        return LocalFilesystemBlob(self.bucket_dir, blob_path)
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import blob_uploader
+
+
+def upload_blob(bucket_client, blob_path, blob_data):
+    blob = bucket_client.blob(blob_path)
+    blob.upload_from_string(blob_data)
+    return blob.id
+
+
+class BlobUploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bucket_client = blob_uploader.LocalFilesystemBucketClient(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def testUploadsToLocalBucket(self):
+        uploader = blob_uploader.BlobUploader(upload_blob, max_workers=2)
+        uploader.submit(self.bucket_client, 'a/b/c.jpg', b'image')
+        uploader.submit(self.bucket_client, 'd.png', b'screenshot')
+        uploader.wait_for_uploads()
+        uploader.shutdown()
+        with open(os.path.join(self.temp_dir.name, 'a/b/c.jpg'), 'rb') as blob_file:
+            self.assertEqual(blob_file.read(), b'image')
+        self.assertTrue(self.bucket_client.blob('d.png').exists())
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ['a', 'd.png'])
+
+    def testSubmitBlocksWhilePendingBytesExceedLimit(self):
+        release_upload = threading.Event()
+
+        def blocking_upload(bucket_client, blob_path, blob_data):
+            release_upload.wait()
+            return upload_blob(bucket_client, blob_path, blob_data)
+
+        uploader = blob_uploader.BlobUploader(blocking_upload, max_workers=4, max_pending_bytes=10)
+        uploader.submit(self.bucket_client, 'first', b'x' * 8)
+        second_submitted = threading.Event()
+
+        def submit_second():
+            uploader.submit(self.bucket_client, 'second', b'y' * 8)
+            second_submitted.set()
+
+        submitter = threading.Thread(target=submit_second)
+        submitter.start()
+        self.assertFalse(second_submitted.wait(0.2))
+        release_upload.set()
+        self.assertTrue(second_submitted.wait(5))
+        submitter.join()
+        uploader.wait_for_uploads()
+        uploader.shutdown()
+        self.assertTrue(self.bucket_client.blob('second').exists())
+
+    def testWaitForUploadsRaisesUploadError(self):
+        def failing_upload(bucket_client, blob_path, blob_data):
+            raise IOError('upload failed')
+
+        uploader = blob_uploader.BlobUploader(failing_upload)
+        uploader.submit(self.bucket_client, 'blob', b'data')
+        with self.assertRaises(IOError):
+            uploader.wait_for_uploads()
+        uploader.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Benchmark execute_values inserts vs COPY based bulk inserts of ads, impressions, and demo/region
+impression results.
+
+All writes are done in a transaction that is rolled back, so the database is left unchanged.
+
+Usage: python3 bulk_write_benchmark.py <config file> [num rows ...]
+"""
+import datetime
+import logging
+import sys
+import time
+
+import config_utils
+import db_functions
+from generic_fb_collector import AdRecord, SnapshotDemoRecord, SnapshotRegionRecord
+
+DEFAULT_NUM_ROWS = [10000, 100000, 1000000]
+_BENCHMARK_PAGE_ID = 1
+_BASE_ARCHIVE_ID = 10 ** 15
+_AGE_RANGES = ['18-24', '25-34', '35-44', '45-54', '55-64', '65+']
+_GENDERS = ['male', 'female', 'unknown']
+
+
+def make_ad_records(num_rows):
+    ad_creation_time = datetime.datetime(2020, 10, 1, tzinfo=datetime.timezone.utc)
+    return [AdRecord(
+        ad_creation_time=ad_creation_time,
+        ad_creative_body='Benchmark ad body text %d\twith a tab' % i,
+        ad_creative_link_caption='example.com',
+        ad_creative_link_description=None,
+        ad_creative_link_title='Title %d' % i,
+        ad_delivery_start_time=ad_creation_time,
+        ad_delivery_stop_time=None,
+        ad_snapshot_url='https://www.facebook.com/ads/archive/render_ad/?id=%d' % (
+            _BASE_ARCHIVE_ID + i),
+        ad_status=1,
+        archive_id=_BASE_ARCHIVE_ID + i,
+        country_code='US',
+        currency='USD',
+        first_crawl_time=datetime.date.today(),
+        funding_entity='Benchmark Funder',
+        impressions__lower_bound=1000,
+        impressions__upper_bound=1999,
+        page_id=_BENCHMARK_PAGE_ID,
+        page_name='Benchmark Page',
+        publisher_platform='facebook',
+        spend__lower_bound=100,
+        spend__upper_bound=199,
+        potential_reach__lower_bound=None,
+        potential_reach__upper_bound=None) for i in range(num_rows)]
+
+
+def make_demo_records(num_rows):
+    demo_groups = [(age_range, gender) for age_range in _AGE_RANGES for gender in _GENDERS]
+    return [SnapshotDemoRecord(
+        archive_id=_BASE_ARCHIVE_ID + i // len(demo_groups),
+        age_range=demo_groups[i % len(demo_groups)][0],
+        gender=demo_groups[i % len(demo_groups)][1],
+        spend_percentage='0.055556',
+        min_impressions=55.556,
+        max_impressions=111.05,
+        min_spend=5.5556,
+        max_spend=11.055) for i in range(num_rows)]
+
+
+def make_region_records(num_rows, num_regions=50):
+    return [SnapshotRegionRecord(
+        archive_id=_BASE_ARCHIVE_ID + i // num_regions,
+        region='Region %d' % (i % num_regions),
+        spend_percentage='0.02',
+        min_impressions=20.0,
+        max_impressions=39.98,
+        min_spend=2.0,
+        max_spend=3.98) for i in range(num_rows)]
+
+
+def time_writes(database_connection_params, ads, demos, regions, bulk):
+    connection = config_utils.get_database_connection(database_connection_params)
+    try:
+        db_interface = db_functions.DBInterface(connection)
+        db_interface.get_cursor().execute(
+            'INSERT INTO pages (page_id, page_name) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+            (_BENCHMARK_PAGE_ID, 'Benchmark Page'))
+        start_time = time.monotonic()
+        if bulk:
+            db_interface.bulk_insert_new_ads(ads)
+            db_interface.bulk_insert_new_impressions(ads)
+            db_interface.bulk_insert_new_impression_demos(demos)
+            db_interface.bulk_insert_new_impression_regions(regions)
+        else:
+            db_interface.insert_new_ads(ads)
+            db_interface.insert_new_impressions(ads)
+            db_interface.insert_new_impression_demos(demos)
+            db_interface.insert_new_impression_regions(regions)
+        return time.monotonic() - start_time
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def main(argv):
+    config = config_utils.get_config(argv[0])
+    database_connection_params = config_utils.get_database_connection_params_from_config(config)
+    num_rows_list = [int(arg) for arg in argv[1:]] or DEFAULT_NUM_ROWS
+    for num_rows in num_rows_list:
+        ads = make_ad_records(num_rows)
+        demos = make_demo_records(num_rows)
+        regions = make_region_records(num_rows)
+        execute_values_seconds = time_writes(database_connection_params, ads, demos, regions,
+                                             bulk=False)
+        copy_seconds = time_writes(database_connection_params, ads, demos, regions, bulk=True)
+        logging.info('%d rows per table: execute_values %.2fs, COPY %.2fs (%.1fx speedup)',
+                     num_rows, execute_values_seconds, copy_seconds,
+                     execute_values_seconds / copy_seconds)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Usage: %s <config file> [num rows ...]' % sys.argv[0])
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
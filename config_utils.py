@@ -1,16 +1,30 @@
 """Module to hold common config logic."""
 import collections
 import configparser
+import contextlib
 import logging
+import threading
+import time
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+DEFAULT_POOL_MIN_SIZE = 1
+DEFAULT_POOL_MAX_SIZE = 4
+# Connections idle longer than this are pinged with SELECT 1 before being handed out.
+POOL_HEALTH_CHECK_IDLE_SECONDS = 60
 
 DatabaseConnectionParams = collections.namedtuple('DatabaseConnectionParams',
                                                   ['host',
                                                    'database_name',
                                                    'username',
                                                    'password',
-                                                   'port'])
+                                                   'port',
+                                                   'pool_min_size',
+                                                   'pool_max_size'],
+                                                  defaults=[DEFAULT_POOL_MIN_SIZE,
+                                                            DEFAULT_POOL_MAX_SIZE])
 
 
 def get_database_connection_params_from_config(config):
@@ -26,7 +40,14 @@ def get_database_connection_params_from_config(config):
         database_name=config['POSTGRES']['DBNAME'],
         username=config['POSTGRES']['USER'],
         password=config['POSTGRES']['PASSWORD'],
-        port=config['POSTGRES']['PORT'])
+        port=config['POSTGRES']['PORT'],
+        pool_min_size=config.getint('POSTGRES', 'POOL_MIN_SIZE', fallback=DEFAULT_POOL_MIN_SIZE),
+        pool_max_size=config.getint('POSTGRES', 'POOL_MAX_SIZE', fallback=DEFAULT_POOL_MAX_SIZE))
+
+
+def _make_dsn(database_connection_params):
+    return ("host=%(host)s dbname=%(database_name)s user=%(username)s "
+            "password=%(password)s port=%(port)s sslmode=require") % database_connection_params._asdict()
 
 
 def get_database_connection(database_connection_params):
@@ -38,13 +59,93 @@ def get_database_connection(database_connection_params):
     Returns:
         psycopg2.connection ready to be used.
     """
-    db_authorize = ("host=%(host)s dbname=%(database_name)s user=%(username)s "
-                    "password=%(password)s port=%(port)s sslmode=require") % database_connection_params._asdict()
-    connection = psycopg2.connect(db_authorize)
+    connection = psycopg2.connect(_make_dsn(database_connection_params))
     logging.info('Established connecton to %s', connection.dsn)
     return connection
 
 
+class DatabaseConnectionPool:
+    """Thread safe pool of long lived database connections.
+
+    Checkout blocks while pool_max_size connections are in use. Connections are health checked on
+    checkout and replaced if they have been closed or fail a ping.
+    """
+
+    def __init__(self, database_connection_params):
+        self._min_size = database_connection_params.pool_min_size
+        self._max_size = database_connection_params.pool_max_size
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            self._min_size, self._max_size, _make_dsn(database_connection_params))
+        self._available_slots = threading.BoundedSemaphore(self._max_size)
+        self._last_used_time = {}
+        logging.info('Created database connection pool (min size: %d, max size: %d)',
+                     self._min_size, self._max_size)
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        if (connection.get_transaction_status() !=
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            return False
+        last_used_time = self._last_used_time.get(id(connection), 0)
+        if time.monotonic() - last_used_time < POOL_HEALTH_CHECK_IDLE_SECONDS:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except psycopg2.Error as error:
+            logging.info('Discarding pooled database connection that failed health check: %s',
+                         error)
+            return False
+        return True
+
+    def getconn(self):
+        """Check out a healthy connection. Must be returned with putconn()."""
+        self._available_slots.acquire()
+        try:
+            connection = self._pool.getconn()
+            while not self._is_healthy(connection):
+                self._last_used_time.pop(id(connection), None)
+                self._pool.putconn(connection, close=True)
+                connection = self._pool.getconn()
+        except BaseException:
+            self._available_slots.release()
+            raise
+        return connection
+
+    def putconn(self, connection):
+        """Return connection to pool. Broken connections are closed rather than reused."""
+        try:
+            close = bool(connection.closed)
+            if not close and (connection.get_transaction_status() !=
+                              psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                # Don't hand out connections with a dangling transaction.
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+            if close:
+                self._last_used_time.pop(id(connection), None)
+            else:
+                self._last_used_time[id(connection)] = time.monotonic()
+            self._pool.putconn(connection, close=close)
+        finally:
+            self._available_slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager yielding a pooled connection which is returned to the pool on exit."""
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def closeall(self):
+        self._pool.closeall()
+
+
 def get_database_connection_from_config(config):
     """Get pyscopg2 database connection from the provided ConfigParser.
 
@@ -1,7 +1,12 @@
 """Encapsulation of database read, write, and update logic."""
 from collections import defaultdict, namedtuple
 from contextlib import contextmanager
+import datetime
+import io
+import itertools
 import logging
+import threading
+import time
 
 import psycopg2
 import psycopg2.extras
@@ -15,13 +20,177 @@ PageAgeAndMinImpressionSum = namedtuple('PageAgeAndMinImpressionSum',
 PageSnapshotFetchInfo = namedtuple('PageSnapshotFetchInfo',
                                    ['page_id', 'snapshot_fetch_status', 'count'])
 PageRecord = namedtuple("PageRecord", ["id", "name"])
+# Position of ads_archive API paging through results of query. cursor is None if query has not made
+# any requests, or if completed.
+CrawlCheckpoint = namedtuple('CrawlCheckpoint',
+                             ['country_code', 'query', 'cursor', 'request_count', 'completed'])
+# Delivery date window of a date windowed crawl. window_end is None if the window is open-ended.
+CrawlDateWindow = namedtuple('CrawlDateWindow', ['window_start', 'window_end'])
+# Weights of terms of the priority score of unfetched snapshots (see
+# _SNAPSHOT_FETCH_PRIORITY_EXPRESSION).
+SnapshotFetchPriorityWeights = namedtuple('SnapshotFetchPriorityWeights',
+                                          ['max_spend_weight', 'recently_active_weight',
+                                           'recently_active_days', 'page_coverage_weight'])
+DEFAULT_SNAPSHOT_FETCH_PRIORITY_WEIGHTS = SnapshotFetchPriorityWeights(
+    max_spend_weight=1.0, recently_active_weight=5.0, recently_active_days=7,
+    page_coverage_weight=5.0)
 
 _DEFAULT_PAGE_SIZE = 250
+# Prefix of crawl_checkpoints query of the marker of the latest crawl of a country that paged
+# through all of its searches, followed by the crawl query identifying the ads crawled.
+_COMPLETED_CRAWL_QUERY_PREFIX = 'completed_crawl:'
+# Number of successfully fetched snapshots of each page. Formatted with page_id_condition, a
+# condition on ads.page_id (starting with AND) restricting the pages counted, or sql.SQL('').
+_PAGE_FETCHED_SNAPSHOT_COUNTS_CTE = sql.SQL(
+    'page_fetched_snapshot_counts AS ('
+    '  SELECT page_id, count(*) AS num_fetched_snapshots FROM ads '
+    '  JOIN ad_snapshot_metadata USING(archive_id) '
+    '  WHERE ad_snapshot_metadata.snapshot_fetch_status = 1 {page_id_condition} '
+    '  GROUP BY page_id)')
+# Priority of fetching an ad's snapshot: log of its max spend, plus a bonus if it was active in the
+# last recently_active_days days, plus a bonus for pages with few fetched snapshots that shrinks as
+# 1 / (1 + fetched snapshots of the page). Requires ads, impressions (LEFT JOIN) and
+# page_fetched_snapshot_counts (LEFT JOIN) to be in scope, and params named by
+# SnapshotFetchPriorityWeights fields.
+_SNAPSHOT_FETCH_PRIORITY_EXPRESSION = sql.SQL(
+    '(%(max_spend_weight)s::double precision * '
+    '   ln(1 + greatest(coalesce(impressions.max_spend, 0), 0))::double precision + '
+    ' CASE WHEN impressions.last_active_date >= CURRENT_DATE - %(recently_active_days)s::integer '
+    '   THEN %(recently_active_weight)s::double precision ELSE 0 END + '
+    ' %(page_coverage_weight)s::double precision / '
+    '   (1 + coalesce(page_fetched_snapshot_counts.num_fetched_snapshots, 0)))')
+# Snapshot fetch batches claimed by a worker are reclaimable if their lease is not renewed within
+# this long.
+DEFAULT_FETCH_BATCH_LEASE_DURATION = datetime.timedelta(minutes=10)
+_DEFAULT_STREAM_FETCH_SIZE = 100000
+_DEFAULT_LAST_ACTIVE_DATE_BATCH_SIZE = 100000
+
+# Escape sequences required for values in Postgres COPY text format.
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_COPY_TEXT_NULL = '\\N'
+
+# Temp tables used to stage bulk loaded records before merging them into the real tables. They
+# are created once per DB session and emptied on commit. Demo/region result impressions and spend
+# are computed as floats, so they are staged as numeric and rounded by the assignment cast on merge
+# (same as inserting float literals). Ad datetimes are staged as timestamptz, so that the merge
+# converts them to dates in the session time zone (same as inserting datetime parameters), rather
+# than date input dropping their time and offset.
+_ADS_STAGING_TABLE_DEFINITION = (
+    'CREATE TEMP TABLE IF NOT EXISTS ads_staging ('
+    '  archive_id bigint NOT NULL, ad_creative_body character varying, '
+    '  ad_creation_time timestamp with time zone, '
+    '  ad_delivery_start_time timestamp with time zone, '
+    '  ad_delivery_stop_time timestamp with time zone, page_id bigint, '
+    '  currency character varying (4), ad_creative_link_caption character varying, '
+    '  ad_creative_link_title character varying, ad_creative_link_description character varying, '
+    '  ad_snapshot_url character varying, funding_entity character varying, '
+    '  country_code character varying) ON COMMIT DELETE ROWS')
+_ADS_STAGING_COLUMNS = (
+    'archive_id', 'ad_creative_body', 'ad_creation_time', 'ad_delivery_start_time',
+    'ad_delivery_stop_time', 'page_id', 'currency', 'ad_creative_link_caption',
+    'ad_creative_link_title', 'ad_creative_link_description', 'ad_snapshot_url', 'funding_entity',
+    'country_code')
+_IMPRESSIONS_STAGING_TABLE_DEFINITION = (
+    'CREATE TEMP TABLE IF NOT EXISTS impressions_staging ('
+    '  archive_id bigint NOT NULL, ad_status bigint, min_spend decimal(10, 2), '
+    '  max_spend decimal(10, 2), min_impressions integer, max_impressions integer, '
+    '  potential_reach_min bigint, potential_reach_max bigint) ON COMMIT DELETE ROWS')
+_IMPRESSIONS_STAGING_COLUMNS = (
+    'archive_id', 'ad_status', 'min_spend', 'max_spend', 'min_impressions', 'max_impressions',
+    'potential_reach_min', 'potential_reach_max')
+# row_number is the order of rows copied from DistributionColumns, so that the last of duplicate
+# rows is written.
+_DEMO_IMPRESSIONS_STAGING_TABLE_DEFINITION = (
+    'CREATE TEMP TABLE IF NOT EXISTS demo_impressions_staging ('
+    '  archive_id bigint NOT NULL, age_group character varying, gender character varying, '
+    '  spend_percentage decimal(7, 6), min_impressions numeric, max_impressions numeric, '
+    '  min_spend numeric, max_spend numeric, row_number bigint) ON COMMIT DELETE ROWS')
+_DEMO_IMPRESSIONS_STAGING_COLUMNS = (
+    'archive_id', 'age_group', 'gender', 'spend_percentage', 'min_impressions', 'max_impressions',
+    'min_spend', 'max_spend')
+_REGION_IMPRESSIONS_STAGING_TABLE_DEFINITION = (
+    'CREATE TEMP TABLE IF NOT EXISTS region_impressions_staging ('
+    '  archive_id bigint NOT NULL, region character varying, spend_percentage decimal(7, 6), '
+    '  min_impressions numeric, max_impressions numeric, min_spend numeric, max_spend numeric, '
+    '  row_number bigint) ON COMMIT DELETE ROWS')
+_REGION_IMPRESSIONS_STAGING_COLUMNS = (
+    'archive_id', 'region', 'spend_percentage', 'min_impressions', 'max_impressions', 'min_spend',
+    'max_spend')
+
+
+def _format_copy_text_value(value):
+    if value is None:
+        return _COPY_TEXT_NULL
+    if isinstance(value, str):
+        return value.translate(_COPY_TEXT_ESCAPES)
+    return str(value)
+
+
+def _make_copy_text_buffer(rows):
+    """Make file-like object of rows in Postgres COPY text format.
+
+    Args:
+        rows: iterable of sequences of values, in staging table column order.
+    Returns:
+        io.StringIO positioned at start of data.
+    """
+    buffer = io.StringIO()
+    write = buffer.write
+    for row in rows:
+        write('\t'.join([_format_copy_text_value(value) for value in row]))
+        write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def _copy_rows_to_staging_table(cursor, staging_table_definition, staging_table_name,
+                                staging_columns, rows):
+    cursor.execute(staging_table_definition)
+    # Staging tables are only emptied on commit, so clear rows from any earlier load in this
+    # transaction.
+    cursor.execute(sql.SQL('TRUNCATE {}').format(sql.Identifier(staging_table_name)))
+    copy_query = sql.SQL('COPY {} ({}) FROM STDIN').format(
+        sql.Identifier(staging_table_name),
+        sql.SQL(', ').join(map(sql.Identifier, staging_columns)))
+    cursor.copy_expert(copy_query, _make_copy_text_buffer(rows))
+
+def _distribution_columns_copy_rows(distribution_columns):
+    """Get iterable of COPY rows of results_page_parser.DistributionColumns, zipped straight from
+    its columns in staging table column order, ending with the row number."""
+    return zip(distribution_columns.archive_ids.tolist(), *distribution_columns.key_columns,
+               distribution_columns.spend_percentages,
+               distribution_columns.min_impressions.tolist(),
+               distribution_columns.max_impressions.tolist(),
+               distribution_columns.min_spend.tolist(), distribution_columns.max_spend.tolist(),
+               itertools.count())
+
+def _modified_since_where_clause(modified_since):
+    """Get WHERE clause restricting rows to last_modified_time >= %(modified_since)s if
+    modified_since is provided, otherwise empty clause."""
+    if modified_since is None:
+        return sql.SQL('')
+    return sql.SQL('WHERE last_modified_time >= %(modified_since)s')
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(database_connection_params):
+    """Get process wide connection pool for database_connection_params, creating it if needed."""
+    with _connection_pools_lock:
+        connection_pool = _connection_pools.get(database_connection_params)
+        if connection_pool is None:
+            connection_pool = config_utils.DatabaseConnectionPool(database_connection_params)
+            _connection_pools[database_connection_params] = connection_pool
+        return connection_pool
 
 @contextmanager
 def db_interface_context(database_connection_params):
-    with config_utils.get_database_connection(database_connection_params) as db_connection:
-        yield DBInterface(db_connection)
+    """Yield DBInterface using a pooled connection. Transaction is committed if the context exits
+    normally, and rolled back if it raises.
+    """
+    with get_connection_pool(database_connection_params).connection() as db_connection:
+        with db_connection:
+            yield DBInterface(db_connection)
 
 class DBInterface():
 
@@ -50,33 +219,210 @@ class DBInterface():
         cursor.execute(existing_ad_query)
         return {row['archive_id'] for row in cursor}
 
-    def existing_pages(self):
+    def stream_archive_ids(self, fetch_size=_DEFAULT_STREAM_FETCH_SIZE):
+        """Generator yielding all archive IDs in ads table in ascending order.
+
+        Uses a server side cursor so that only fetch_size rows are held in memory at a time.
+
+        Args:
+            fetch_size: int number of rows to fetch from server per round trip.
+        Yields:
+            int archive IDs in ascending order.
+        """
+        cursor = self.connection.cursor(name='stream_archive_ids')
+        cursor.itersize = fetch_size
+        cursor.execute('SELECT archive_id FROM ads ORDER BY archive_id')
+        for row in cursor:
+            yield row[0]
+        cursor.close()
+
+    def current_timestamp(self):
+        """Get DB server CURRENT_TIMESTAMP (ie start time of current transaction)."""
         cursor = self.get_cursor()
-        existing_pages_query = "select page_id from pages;"
-        cursor.execute(existing_pages_query)
+        cursor.execute('SELECT CURRENT_TIMESTAMP AS now')
+        return cursor.fetchone()['now']
+
+    def existing_pages(self, modified_since=None):
+        """Get set of page IDs from pages table.
+
+        Args:
+            modified_since: datetime.datetime, if provided only pages with last_modified_time on or
+                after this time are returned.
+        Returns:
+            set of int page IDs.
+        """
+        cursor = self.get_cursor()
+        existing_pages_query = sql.SQL("select page_id from pages {where_clause};").format(
+            where_clause=_modified_since_where_clause(modified_since))
+        cursor.execute(existing_pages_query, {'modified_since': modified_since})
         existing_pages = {row['page_id'] for row in cursor}
         return existing_pages
 
 
-    def page_records_to_max_last_seen(self):
-        """Return dict of PageRecord -> max last_seen time for that PageRecord."""
+    def page_records_to_max_last_seen(self, modified_since=None):
+        """Return dict of PageRecord -> max last_seen time for that PageRecord.
+
+        Args:
+            modified_since: datetime.datetime, if provided only page_name_history rows with
+                last_modified_time on or after this time are returned.
+        """
         cursor = self.get_cursor()
-        page_name_history_query = (
+        page_name_history_query = sql.SQL(
             "SELECT page_id, page_name, max(last_seen) as "
-            "last_seen FROM page_name_history GROUP BY page_id, page_name;")
-        cursor.execute(page_name_history_query)
+            "last_seen FROM page_name_history {where_clause} GROUP BY page_id, page_name;").format(
+                where_clause=_modified_since_where_clause(modified_since))
+        cursor.execute(page_name_history_query, {'modified_since': modified_since})
         return {PageRecord(id=row['page_id'], name=row['page_name']): row['last_seen']
                 for row in cursor}
 
-    def existing_funding_entities(self):
+    def existing_funding_entities(self, modified_since=None):
+        """Get dict of funder name -> funder ID from funder_metadata table.
+
+        Args:
+            modified_since: datetime.datetime, if provided only funders with last_modified_time on
+                or after this time are returned.
+        """
         cursor = self.get_cursor()
-        existing_funder_query = "select funder_id, funder_name from funder_metadata;"
-        cursor.execute(existing_funder_query)
+        existing_funder_query = sql.SQL(
+            "select funder_id, funder_name from funder_metadata {where_clause};").format(
+                where_clause=_modified_since_where_clause(modified_since))
+        cursor.execute(existing_funder_query, {'modified_since': modified_since})
         existing_funders = dict()
         for row in cursor:
             existing_funders[row['funder_name']] = row['funder_id']
         return existing_funders
 
+    def crawl_checkpoints(self, country_code, max_age):
+        """Get resumable crawl checkpoints for country_code saved within max_age.
+
+        Checkpoints of completed queries are not returned, so that a finished crawl never
+        suppresses the next crawl of the same query.
+
+        Args:
+            country_code: str country code of crawl.
+            max_age: datetime.timedelta, older checkpoints are ignored.
+        Returns:
+            dict of str query -> CrawlCheckpoint.
+        """
+        cursor = self.get_cursor()
+        cursor.execute(
+            'SELECT country_code, query, cursor, request_count, completed FROM crawl_checkpoints '
+            'WHERE country_code = %(country_code)s AND completed = FALSE AND '
+            'last_modified_time >= CURRENT_TIMESTAMP - %(max_age)s',
+            {'country_code': country_code, 'max_age': max_age})
+        return {row['query']: CrawlCheckpoint(**row) for row in cursor}
+
+    def record_completed_crawl(self, country_code, crawl_query):
+        """Record that the crawl_query crawl of country_code paged through all of its searches.
+
+        Args:
+            country_code: str country code of crawl.
+            crawl_query: str identifying the ads crawled (ie search terms or page IDs),
+                regardless of delivery dates.
+        """
+        self.upsert_crawl_checkpoints([CrawlCheckpoint(
+            country_code=country_code, query=_COMPLETED_CRAWL_QUERY_PREFIX + crawl_query,
+            cursor=None, request_count=0, completed=True)])
+
+    def last_completed_crawl_date(self, country_code, crawl_query):
+        """Get date the latest completed crawl_query crawl (see record_completed_crawl) of
+        country_code finished, with a single crawl_checkpoints row lookup.
+
+        Args:
+            country_code: str country code of crawl.
+            crawl_query: str identifying the ads crawled, as passed to record_completed_crawl.
+        Returns:
+            datetime.date, or None if no such crawl of country_code has completed.
+        """
+        cursor = self.get_cursor()
+        cursor.execute(
+            'SELECT last_modified_time::date AS completed_date FROM crawl_checkpoints '
+            'WHERE country_code = %s AND query = %s',
+            (country_code, _COMPLETED_CRAWL_QUERY_PREFIX + crawl_query))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return row['completed_date']
+
+    def uncompleted_crawl_date_windows(self, country_code, crawl_query):
+        """Get date windows of the crawl_query date windowed crawl of country_code that remain
+        to be crawled, if it has not completed all of its windows.
+
+        The open-ended latest window is included even if completed by a previous run, so that
+        ads delivered since then are crawled before the crawl completes.
+
+        Args:
+            country_code: str country code of crawl.
+            crawl_query: str identifying the ads crawled, regardless of delivery dates.
+        Returns:
+            list of CrawlDateWindow ordered by window_start. Empty if no such crawl is
+            uncompleted.
+        """
+        cursor = self.get_cursor()
+        cursor.execute(
+            'SELECT window_start, window_end FROM crawl_date_windows '
+            'WHERE country_code = %(country_code)s AND crawl_query = %(crawl_query)s AND '
+            '(completed = FALSE OR window_end IS NULL) AND EXISTS ('
+            '  SELECT 1 FROM crawl_date_windows WHERE country_code = %(country_code)s AND '
+            '  crawl_query = %(crawl_query)s AND completed = FALSE) '
+            'ORDER BY window_start',
+            {'country_code': country_code, 'crawl_query': crawl_query})
+        return [CrawlDateWindow(**row) for row in cursor]
+
+    def replace_crawl_date_windows(self, country_code, crawl_query, date_windows):
+        """Replace date windows of the crawl_query date windowed crawl of country_code with
+        uncompleted date_windows.
+
+        Args:
+            country_code: str country code of crawl.
+            crawl_query: str identifying the ads crawled, regardless of delivery dates.
+            date_windows: iterable of CrawlDateWindow.
+        """
+        cursor = self.get_cursor()
+        cursor.execute(
+            'DELETE FROM crawl_date_windows WHERE country_code = %s AND crawl_query = %s',
+            (country_code, crawl_query))
+        psycopg2.extras.execute_values(
+            cursor,
+            'INSERT INTO crawl_date_windows (country_code, crawl_query, window_start, window_end) '
+            'VALUES %s',
+            [(country_code, crawl_query, window.window_start, window.window_end)
+             for window in date_windows],
+            page_size=_DEFAULT_PAGE_SIZE)
+
+    def mark_crawl_date_windows_completed(self, country_code, crawl_query, window_starts):
+        """Mark date windows of the crawl_query date windowed crawl of country_code starting on
+        window_starts completed.
+
+        Args:
+            country_code: str country code of crawl.
+            crawl_query: str identifying the ads crawled, regardless of delivery dates.
+            window_starts: iterable of datetime.date window_start of completed windows.
+        """
+        cursor = self.get_cursor()
+        cursor.execute(
+            'UPDATE crawl_date_windows SET completed = TRUE WHERE country_code = %s AND '
+            'crawl_query = %s AND window_start = ANY(%s)',
+            (country_code, crawl_query, list(window_starts)))
+
+    def upsert_crawl_checkpoints(self, checkpoints):
+        """Insert, or replace existing, crawl checkpoints.
+
+        Args:
+            checkpoints: iterable of CrawlCheckpoint.
+        """
+        cursor = self.get_cursor()
+        upsert_checkpoint_query = (
+            'INSERT INTO crawl_checkpoints (country_code, query, cursor, request_count, completed) '
+            'VALUES %s ON CONFLICT (country_code, query) DO UPDATE SET cursor = EXCLUDED.cursor, '
+            'request_count = EXCLUDED.request_count, completed = EXCLUDED.completed, '
+            'last_modified_time = CURRENT_TIMESTAMP')
+        psycopg2.extras.execute_values(
+            cursor, upsert_checkpoint_query,
+            [(c.country_code, c.query, c.cursor, c.request_count, c.completed)
+             for c in checkpoints],
+            template='(%s, %s, %s, %s, %s)', page_size=_DEFAULT_PAGE_SIZE)
+
     def existing_ad_clusters(self):
         cursor = self.get_cursor()
         existing_ad_clusters_query = 'SELECT archive_id, ad_cluster_id FROM ad_clusters'
@@ -124,6 +470,24 @@ class DBInterface():
         results = cursor.fetchall()
         return [row['archive_id'] for row in results]
 
+    def stored_ad_creative_image_bucket_paths(self, image_bucket_paths):
+        """Get set of image_bucket_paths referenced by an ad_creatives record (ie already
+        uploaded)."""
+        cursor = self.get_cursor()
+        cursor.execute(
+            'SELECT DISTINCT image_bucket_path FROM ad_creatives WHERE image_bucket_path = ANY(%s)',
+            (list(image_bucket_paths),))
+        return {row['image_bucket_path'] for row in cursor.fetchall()}
+
+    def stored_ad_creative_video_bucket_paths(self, video_bucket_paths):
+        """Get set of video_bucket_paths referenced by an ad_creatives record (ie already
+        uploaded)."""
+        cursor = self.get_cursor()
+        cursor.execute(
+            'SELECT DISTINCT video_bucket_path FROM ad_creatives WHERE video_bucket_path = ANY(%s)',
+            (list(video_bucket_paths),))
+        return {row['video_bucket_path'] for row in cursor.fetchall()}
+
     def all_ad_creative_image_simhashes(self):
         """Returns Dict image_sim_hash -> set of archive_ids.
         """
@@ -229,14 +593,24 @@ class DBInterface():
 
 
     def insert_funding_entities(self, new_funders):
+        """Insert new funders into funder_metadata.
+
+        Args:
+            new_funders: iterable of single element tuples of funder name.
+        Returns:
+            dict of funder name -> funder ID for inserted funders.
+        """
         cursor = self.get_cursor()
-        insert_funder_query = "INSERT INTO funder_metadata(funder_name) VALUES %s;"
+        insert_funder_query = (
+            "INSERT INTO funder_metadata(funder_name) VALUES %s RETURNING funder_id, funder_name;")
         insert_template = "(%s)"
-        psycopg2.extras.execute_values(cursor,
-                                       insert_funder_query,
-                                       new_funders,
-                                       template=insert_template,
-                                       page_size=_DEFAULT_PAGE_SIZE)
+        inserted_rows = psycopg2.extras.execute_values(cursor,
+                                                       insert_funder_query,
+                                                       new_funders,
+                                                       template=insert_template,
+                                                       page_size=_DEFAULT_PAGE_SIZE,
+                                                       fetch=True)
+        return {row['funder_name']: row['funder_id'] for row in inserted_rows}
 
     def insert_pages(self, new_pages, new_page_name_history_records):
         cursor = self.get_cursor()
@@ -433,6 +807,193 @@ class DBInterface():
                                        template=insert_template,
                                        page_size=_DEFAULT_PAGE_SIZE)
 
+    def bulk_insert_new_ads(self, new_ads):
+        """Same as insert_new_ads, but streams records to a staging table with COPY and merges
+        them with a single INSERT ... SELECT per table. Faster for large numbers of records.
+
+        Args:
+            new_ads: iterable of generic_fb_collector.AdRecord.
+        """
+        cursor = self.get_cursor()
+        _copy_rows_to_staging_table(
+            cursor, _ADS_STAGING_TABLE_DEFINITION, 'ads_staging', _ADS_STAGING_COLUMNS,
+            ((ad.archive_id, ad.ad_creative_body, ad.ad_creation_time, ad.ad_delivery_start_time,
+              ad.ad_delivery_stop_time, ad.page_id, ad.currency, ad.ad_creative_link_caption,
+              ad.ad_creative_link_title, ad.ad_creative_link_description, ad.ad_snapshot_url,
+              ad.funding_entity, ad.country_code) for ad in new_ads))
+        cursor.execute(
+            "INSERT INTO ads(archive_id, ad_creative_body, ad_creation_time, "
+            "ad_delivery_start_time, ad_delivery_stop_time, page_id, currency, "
+            "ad_creative_link_caption, ad_creative_link_title, ad_creative_link_description, "
+            "ad_snapshot_url, funding_entity) "
+            "SELECT archive_id, ad_creative_body, ad_creation_time, ad_delivery_start_time, "
+            "ad_delivery_stop_time, page_id, currency, ad_creative_link_caption, "
+            "ad_creative_link_title, ad_creative_link_description, ad_snapshot_url, "
+            "funding_entity FROM ads_staging on conflict (archive_id) do nothing;")
+        cursor.execute(
+            "INSERT INTO ad_countries(archive_id, country_code) "
+            "SELECT archive_id, country_code FROM ads_staging "
+            "on conflict (archive_id, country_code) do nothing;")
+        # Mark newly found archive_id as needing scrape.
+        cursor.execute(
+            "INSERT INTO ad_snapshot_metadata (archive_id, needs_scrape) "
+            "SELECT archive_id, TRUE FROM ads_staging on conflict (archive_id) do nothing;")
+
+    def bulk_insert_new_impressions(self, new_impressions):
+        """Same as insert_new_impressions, but loads records with COPY via a staging table.
+
+        Args:
+            new_impressions: iterable of generic_fb_collector.AdRecord.
+        """
+        cursor = self.get_cursor()
+        _copy_rows_to_staging_table(
+            cursor, _IMPRESSIONS_STAGING_TABLE_DEFINITION, 'impressions_staging',
+            _IMPRESSIONS_STAGING_COLUMNS,
+            ((ad.archive_id, ad.ad_status, ad.spend__lower_bound, ad.spend__upper_bound,
+              ad.impressions__lower_bound, ad.impressions__upper_bound,
+              ad.potential_reach__lower_bound, ad.potential_reach__upper_bound)
+             for ad in new_impressions))
+        # last_active_date is set to CURRENT_DATE in the insert values, but is not updated on
+        # conflict so that it is only set to CURRENT_DATE for newly seen ads. DISTINCT ON because
+        # ON CONFLICT DO UPDATE cannot affect the same row twice in one statement.
+        cursor.execute(
+            "INSERT INTO impressions(archive_id, ad_status, min_spend, max_spend, min_impressions, "
+            "max_impressions, potential_reach_min, potential_reach_max, last_active_date) "
+            "SELECT DISTINCT ON (archive_id) archive_id, ad_status, min_spend, max_spend, "
+            "min_impressions, max_impressions, potential_reach_min, potential_reach_max, "
+            "CURRENT_DATE FROM impressions_staging "
+            "on conflict (archive_id) do update set ad_status = EXCLUDED.ad_status, "
+            "min_spend = EXCLUDED.min_spend, max_spend = EXCLUDED.max_spend, "
+            "min_impressions = EXCLUDED.min_impressions, "
+            "max_impressions = EXCLUDED.max_impressions, "
+            "potential_reach_min = EXCLUDED.potential_reach_min, "
+            "potential_reach_max = EXCLUDED.potential_reach_max;")
+
+    def bulk_insert_new_impression_demos(self, new_ad_demo_impressions):
+        """Same as insert_new_impression_demos, but loads records with COPY via a staging table.
+
+        Args:
+            new_ad_demo_impressions: iterable of generic_fb_collector.SnapshotDemoRecord.
+        """
+        cursor = self.get_cursor()
+        _copy_rows_to_staging_table(
+            cursor, _DEMO_IMPRESSIONS_STAGING_TABLE_DEFINITION, 'demo_impressions_staging',
+            _DEMO_IMPRESSIONS_STAGING_COLUMNS,
+            ((demo.archive_id, demo.age_range, demo.gender, demo.spend_percentage,
+              demo.min_impressions, demo.max_impressions, demo.min_spend, demo.max_spend)
+             for demo in new_ad_demo_impressions))
+        cursor.execute(
+            "INSERT INTO demo_impressions(archive_id, age_group, gender, spend_percentage) "
+            "SELECT DISTINCT ON (archive_id, age_group, gender) archive_id, age_group, gender, "
+            "spend_percentage FROM demo_impressions_staging "
+            "on conflict on constraint unique_demos_per_ad do update set "
+            "spend_percentage = EXCLUDED.spend_percentage;")
+        cursor.execute(
+            "INSERT INTO demo_impression_results(archive_id, age_group, gender, min_impressions, "
+            "min_spend, max_impressions, max_spend) "
+            "SELECT DISTINCT ON (archive_id, age_group, gender) archive_id, age_group, gender, "
+            "min_impressions, min_spend, max_impressions, max_spend FROM demo_impressions_staging "
+            "on conflict on constraint unique_demo_results do update "
+            "set min_impressions = EXCLUDED.min_impressions, "
+            "min_spend = EXCLUDED.min_spend, max_impressions = EXCLUDED.max_impressions, "
+            "max_spend = EXCLUDED.max_spend;")
+
+    def bulk_insert_new_impression_regions(self, new_ad_region_impressions):
+        """Same as insert_new_impression_regions, but loads records with COPY via a staging table.
+
+        Args:
+            new_ad_region_impressions: iterable of generic_fb_collector.SnapshotRegionRecord.
+        """
+        cursor = self.get_cursor()
+        _copy_rows_to_staging_table(
+            cursor, _REGION_IMPRESSIONS_STAGING_TABLE_DEFINITION, 'region_impressions_staging',
+            _REGION_IMPRESSIONS_STAGING_COLUMNS,
+            ((region.archive_id, region.region, region.spend_percentage, region.min_impressions,
+              region.max_impressions, region.min_spend, region.max_spend)
+             for region in new_ad_region_impressions))
+        cursor.execute(
+            "INSERT INTO region_impressions(archive_id, region, spend_percentage) "
+            "SELECT DISTINCT ON (archive_id, region) archive_id, region, spend_percentage "
+            "FROM region_impressions_staging on conflict on constraint unique_regions_per_ad "
+            "do update set spend_percentage = EXCLUDED.spend_percentage;")
+        cursor.execute(
+            "INSERT INTO region_impression_results(archive_id, region, min_impressions, min_spend, "
+            "max_impressions, max_spend) "
+            "SELECT DISTINCT ON (archive_id, region) archive_id, region, min_impressions, "
+            "min_spend, max_impressions, max_spend FROM region_impressions_staging "
+            "on conflict on constraint unique_region_results "
+            "do update set min_impressions = EXCLUDED.min_impressions, "
+            "min_spend = EXCLUDED.min_spend, max_impressions = EXCLUDED.max_impressions, "
+            "max_spend = EXCLUDED.max_spend;")
+
+    def insert_new_impression_demo_columns(self, demo_columns):
+        """Insert or update demo impressions and demo impression results of
+        results_page_parser.DistributionColumns, copied straight from its columns to a staging
+        table.
+
+        Of rows with the same archive_id, age_group, and gender (ie an ad returned by several
+        searches written in one batch) only the last row is written, since ON CONFLICT DO UPDATE
+        cannot affect the same row twice in one statement.
+
+        Args:
+            demo_columns: results_page_parser.DistributionColumns of age, gender demographic
+                distributions.
+        """
+        cursor = self.get_cursor()
+        _copy_rows_to_staging_table(
+            cursor, _DEMO_IMPRESSIONS_STAGING_TABLE_DEFINITION, 'demo_impressions_staging',
+            _DEMO_IMPRESSIONS_STAGING_COLUMNS + ('row_number',),
+            _distribution_columns_copy_rows(demo_columns))
+        cursor.execute(
+            "INSERT INTO demo_impressions(archive_id, age_group, gender, spend_percentage) "
+            "SELECT DISTINCT ON (archive_id, age_group, gender) archive_id, age_group, gender, "
+            "spend_percentage FROM demo_impressions_staging "
+            "ORDER BY archive_id, age_group, gender, row_number DESC "
+            "on conflict on constraint unique_demos_per_ad do update set "
+            "spend_percentage = EXCLUDED.spend_percentage;")
+        cursor.execute(
+            "INSERT INTO demo_impression_results(archive_id, age_group, gender, min_impressions, "
+            "min_spend, max_impressions, max_spend) "
+            "SELECT DISTINCT ON (archive_id, age_group, gender) archive_id, age_group, gender, "
+            "min_impressions, min_spend, max_impressions, max_spend FROM demo_impressions_staging "
+            "ORDER BY archive_id, age_group, gender, row_number DESC "
+            "on conflict on constraint unique_demo_results do update "
+            "set min_impressions = EXCLUDED.min_impressions, "
+            "min_spend = EXCLUDED.min_spend, max_impressions = EXCLUDED.max_impressions, "
+            "max_spend = EXCLUDED.max_spend;")
+
+    def insert_new_impression_region_columns(self, region_columns):
+        """Insert or update region impressions and region impression results of
+        results_page_parser.DistributionColumns, copied straight from its columns to a staging
+        table.
+
+        Of rows with the same archive_id and region only the last row is written.
+
+        Args:
+            region_columns: results_page_parser.DistributionColumns of region distributions.
+        """
+        cursor = self.get_cursor()
+        _copy_rows_to_staging_table(
+            cursor, _REGION_IMPRESSIONS_STAGING_TABLE_DEFINITION, 'region_impressions_staging',
+            _REGION_IMPRESSIONS_STAGING_COLUMNS + ('row_number',),
+            _distribution_columns_copy_rows(region_columns))
+        cursor.execute(
+            "INSERT INTO region_impressions(archive_id, region, spend_percentage) "
+            "SELECT DISTINCT ON (archive_id, region) archive_id, region, spend_percentage "
+            "FROM region_impressions_staging ORDER BY archive_id, region, row_number DESC "
+            "on conflict on constraint unique_regions_per_ad "
+            "do update set spend_percentage = EXCLUDED.spend_percentage;")
+        cursor.execute(
+            "INSERT INTO region_impression_results(archive_id, region, min_impressions, min_spend, "
+            "max_impressions, max_spend) "
+            "SELECT DISTINCT ON (archive_id, region) archive_id, region, min_impressions, "
+            "min_spend, max_impressions, max_spend FROM region_impressions_staging "
+            "ORDER BY archive_id, region, row_number DESC "
+            "on conflict on constraint unique_region_results "
+            "do update set min_impressions = EXCLUDED.min_impressions, "
+            "min_spend = EXCLUDED.min_spend, max_impressions = EXCLUDED.max_impressions, "
+            "max_spend = EXCLUDED.max_spend;")
+
     def update_ad_snapshot_metadata(self, ad_snapshot_metadata_records):
         cursor = self.get_cursor()
         ad_snapshot_metadata_record_list = [x._asdict() for x in ad_snapshot_metadata_records]
@@ -648,15 +1209,22 @@ class DBInterface():
                                        page_size=_DEFAULT_PAGE_SIZE)
 
     def make_snapshot_fetch_batches(self, batch_size=1000, country_code=None,
-                                    min_ad_creation_date=None):
+                                    min_ad_creation_date=None,
+                                    priority_weights=DEFAULT_SNAPSHOT_FETCH_PRIORITY_WEIGHTS):
         """
         Add snapshots that need to be fetched into snapshot_fetch_batches in batches of batch_size.
 
+        Snapshots are batched in priority order, and each batch's priority is the max priority of
+        its snapshots, so batches of the most valuable snapshots are claimed first.
+
         Args:
             batch_size: int size of batches to create.
             country_code: str 2 letter country code. only ads shown in this country will be batched.
             min_ad_creation_date: datetime.date or YYYY-MM-DD str. only ads created on or after this
                 date will be batched
+            priority_weights: SnapshotFetchPriorityWeights of snapshot priority score.
+        Returns:
+            int number of batches created.
         """
         logging.info('About to make batches (size %d) of unfetched archive IDs. Contry code '
                      'restriction: %s. Min ad creation date: %s', batch_size, country_code,
@@ -668,68 +1236,227 @@ class DBInterface():
             min_ad_creation_date_condition = sql.SQL(
                 'ads.ad_creation_time >= %(min_ad_creation_date)s')
             where_clause = sql.SQL(' AND ').join([where_clause, min_ad_creation_date_condition])
-        # Get all archive IDs that are unfetched and not part of an existing batch (and reached the
-        # specified country_code if provided). Archive IDs are ordered oldest to newest ad_creation
-        # time so that larger batch_id roughly corresponds to newer ads.
         if country_code:
-            country_code_condition= sql.SQL('country_code ILIKE %(country_code)s')
+            # EXISTS rather than a join, because ILIKE can match more than one ad_countries row of
+            # an archive ID, and each archive ID must only be numbered once.
+            country_code_condition = sql.SQL(
+                'EXISTS (SELECT 1 FROM ad_countries '
+                '        WHERE ad_countries.archive_id = ad_snapshot_metadata.archive_id '
+                '        AND ad_countries.country_code ILIKE %(country_code)s)')
             where_clause = sql.SQL(' AND ').join([where_clause, country_code_condition])
-            unbatched_archive_ids_query = sql.SQL(
-                'SELECT ad_snapshot_metadata.archive_id FROM ad_snapshot_metadata '
-                'JOIN ads USING(archive_id) JOIN ad_countries USING(archive_id) '
-                'WHERE {where_clause} ORDER BY ad_creation_time ASC')
-        else:
-            unbatched_archive_ids_query = sql.SQL(
-                'SELECT ad_snapshot_metadata.archive_id FROM ad_snapshot_metadata '
-                'JOIN ads USING(archive_id) WHERE {where_clause}'
-                'ORDER BY ad_creation_time ASC')
-        # This query inserts an empty row and gets back the autoincremented new batch_id.
-        get_new_batch_id_query = (
-            'INSERT INTO snapshot_fetch_batches (time_started, time_completed) VALUES (NULL, NULL) '
-            'RETURNING batch_id')
-        assign_batch_id_query = (
-            'UPDATE ad_snapshot_metadata SET snapshot_fetch_batch_id = data.batch_id FROM '
-            '(VALUES %s) AS data (batch_id, archive_id) WHERE '
-            'ad_snapshot_metadata.archive_id = data.archive_id')
-        assign_batch_id_template = '(%s, %s)'
-
-        read_cursor = self.get_cursor()
-        read_cursor.arraysize = batch_size
-        write_cursor = self.get_cursor()
-        logging.info('Getting unfetched archive IDs.')
-        read_cursor.execute(unbatched_archive_ids_query.format(where_clause=where_clause),
-                            {'country_code': country_code,
-                             'min_ad_creation_date': min_ad_creation_date})
-        logging.info('make_snapshot_fetch_batches query: %s', read_cursor.query.decode())
-        fetched_rows = read_cursor.fetchmany()
-        num_new_batches = 0
-        while fetched_rows:
-            write_cursor.execute(get_new_batch_id_query)
-            batch_id = write_cursor.fetchone()['batch_id']
-            assign_batch_id_args = [(int(batch_id), int(row['archive_id'])) for row in fetched_rows]
-            logging.info(
-                'Assigning batch ID %d to %d archive IDs.', batch_id, len(assign_batch_id_args))
-            psycopg2.extras.execute_values(write_cursor,
-                                           assign_batch_id_query,
-                                           assign_batch_id_args,
-                                           template=assign_batch_id_template,
-                                           page_size=batch_size)
-            num_new_batches += 1
-            fetched_rows = read_cursor.fetchmany()
-
-        logging.info('Added %d new batches.', num_new_batches)
-
-    def get_archive_id_batch_to_fetch(self):
-        cursor = self.get_cursor()
-        # Get largest batch_id that has not yet been started (or was started more than 3 days ago
-        # (which we assume is due to the task that claimed the batch dying before marking it
-        # complete)).
+        # Batches are made in one statement: all archive IDs that are unfetched and not part of an
+        # existing batch (and reached the specified country_code if provided) are numbered lowest
+        # to highest priority (oldest to newest ad_creation_time among equal priority) and split
+        # into batch_size groups by row_number(), and a batch row is inserted per group with the
+        # group's max priority. Group priority never decreases with group number, so matching
+        # groups to new batch rows ordered by (priority, batch_id) gives each group a row of its own
+        # priority, and larger batch_id corresponds to newer ads among equal priority batches.
+        make_batches_query = sql.SQL(
+            'WITH {page_fetched_snapshot_counts_cte}, '
+            'unbatched_archive_ids AS ('
+            '  SELECT archive_id, priority, '
+            '    (row_number() OVER (ORDER BY priority ASC, ad_creation_time ASC, '
+            '                        archive_id ASC) - 1) / %(batch_size)s AS batch_number '
+            '  FROM (SELECT ad_snapshot_metadata.archive_id, ads.ad_creation_time, '
+            '          {priority_expression} AS priority '
+            '        FROM ad_snapshot_metadata JOIN ads USING(archive_id) '
+            '        LEFT JOIN impressions ON impressions.archive_id = ads.archive_id '
+            '        LEFT JOIN page_fetched_snapshot_counts USING(page_id) '
+            '        WHERE {where_clause}) AS prioritized_archive_ids), '
+            'new_batches AS ('
+            '  INSERT INTO snapshot_fetch_batches (time_started, time_completed, priority) '
+            '  SELECT NULL, NULL, max(priority) FROM unbatched_archive_ids GROUP BY batch_number '
+            '  ORDER BY batch_number RETURNING batch_id, priority), '
+            'numbered_new_batches AS ('
+            '  SELECT batch_id, '
+            '    row_number() OVER (ORDER BY priority ASC, batch_id ASC) - 1 AS batch_number '
+            '  FROM new_batches), '
+            'batched_archive_ids AS ('
+            '  UPDATE ad_snapshot_metadata '
+            '  SET snapshot_fetch_batch_id = numbered_new_batches.batch_id, '
+            '    snapshot_fetch_priority = unbatched_archive_ids.priority '
+            '  FROM unbatched_archive_ids JOIN numbered_new_batches USING(batch_number) '
+            '  WHERE ad_snapshot_metadata.archive_id = unbatched_archive_ids.archive_id '
+            '  RETURNING ad_snapshot_metadata.archive_id) '
+            'SELECT (SELECT count(*) FROM new_batches) AS num_new_batches, '
+            '  (SELECT count(*) FROM batched_archive_ids) AS num_archive_ids_batched').format(
+                page_fetched_snapshot_counts_cte=_PAGE_FETCHED_SNAPSHOT_COUNTS_CTE.format(
+                    page_id_condition=sql.SQL('')),
+                priority_expression=_SNAPSHOT_FETCH_PRIORITY_EXPRESSION,
+                where_clause=where_clause)
+
+        cursor = self.get_cursor()
+        logging.info('Batching unfetched archive IDs.')
+        start_time = time.monotonic()
+        make_batches_params = {'batch_size': batch_size, 'country_code': country_code,
+                               'min_ad_creation_date': min_ad_creation_date}
+        make_batches_params.update(priority_weights._asdict())
+        cursor.execute(make_batches_query, make_batches_params)
+        logging.info('make_snapshot_fetch_batches query: %s', cursor.query.decode())
+        row = cursor.fetchone()
+        num_new_batches = row['num_new_batches']
+        num_archive_ids_batched = row['num_archive_ids_batched']
+        logging.info('Added %d new batches of %d archive IDs in %.1f seconds.', num_new_batches,
+                     num_archive_ids_batched, time.monotonic() - start_time)
+        return num_new_batches
+
+    def reprioritize_snapshot_fetch_batches(
+            self, modified_since, priority_weights=DEFAULT_SNAPSHOT_FETCH_PRIORITY_WEIGHTS):
+        """Update priority of unstarted snapshot fetch batches whose snapshots' priority changed
+        since modified_since.
+
+        Snapshots in unstarted batches whose impressions were modified, whose recently active bonus
+        expired, or whose page had a snapshot fetched since modified_since (and all snapshots of
+        batches without a priority, ie made before batches had priorities) are rescored. Only
+        snapshots whose priority differs from the priority stored when they were last scored are
+        updated, so impressions rewritten with unchanged spend and activity (ie by every collector
+        upsert and active ads sweep) cost no more than the rescore. Snapshots whose priority now
+        exceeds their batch's priority are removed from it, to be batched again in priority order
+        by make_snapshot_fetch_batches, and the priority of batches with changed snapshots is
+        updated to the max stored priority of their remaining snapshots. Batches left without
+        snapshots to fetch are marked completed.
+
+        Args:
+            modified_since: datetime.datetime. Typically time of previous call, less some overlap.
+            priority_weights: SnapshotFetchPriorityWeights of snapshot priority score.
+        Returns:
+            int number of archive IDs removed from their batch.
+        """
+        cursor = self.get_cursor()
+        start_time = time.monotonic()
+        cursor.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS snapshot_fetch_priority_changes ('
+            '  archive_id bigint NOT NULL, batch_id bigint NOT NULL, '
+            '  priority double precision NOT NULL) ON COMMIT DELETE ROWS')
+        cursor.execute('TRUNCATE snapshot_fetch_priority_changes')
+        score_changed_snapshots_query = sql.SQL(
+            'WITH candidate_archive_ids AS ('
+            '  SELECT archive_id FROM impressions WHERE last_modified_time >= %(modified_since)s '
+            '  UNION '
+            '  SELECT archive_id FROM impressions WHERE '
+            '    last_active_date >= %(modified_since)s::date - %(recently_active_days)s::integer '
+            '      - 1 AND '
+            '    last_active_date < CURRENT_DATE - %(recently_active_days)s::integer '
+            '  UNION '
+            '  SELECT archive_id FROM ads WHERE page_id IN ('
+            '    SELECT page_id FROM ads JOIN ad_snapshot_metadata USING(archive_id) '
+            '    WHERE snapshot_fetch_time >= %(modified_since)s) '
+            '  UNION '
+            '  SELECT ad_snapshot_metadata.archive_id FROM snapshot_fetch_batches '
+            '  JOIN ad_snapshot_metadata ON '
+            '    ad_snapshot_metadata.snapshot_fetch_batch_id = snapshot_fetch_batches.batch_id '
+            '  WHERE snapshot_fetch_batches.priority IS NULL AND '
+            '    snapshot_fetch_batches.time_started IS NULL AND '
+            '    snapshot_fetch_batches.time_completed IS NULL AND '
+            '    ad_snapshot_metadata.needs_scrape = TRUE), '
+            'candidate_snapshots AS ('
+            '  SELECT ad_snapshot_metadata.archive_id, '
+            '    ad_snapshot_metadata.snapshot_fetch_batch_id, '
+            '    ad_snapshot_metadata.snapshot_fetch_priority, ads.page_id '
+            '  FROM candidate_archive_ids JOIN ad_snapshot_metadata USING(archive_id) '
+            '  JOIN ads USING(archive_id) '
+            '  JOIN snapshot_fetch_batches ON '
+            '    snapshot_fetch_batches.batch_id = ad_snapshot_metadata.snapshot_fetch_batch_id '
+            '  WHERE ad_snapshot_metadata.needs_scrape = TRUE AND '
+            '    snapshot_fetch_batches.time_started IS NULL AND '
+            '    snapshot_fetch_batches.time_completed IS NULL), '
+            '{page_fetched_snapshot_counts_cte} '
+            'INSERT INTO snapshot_fetch_priority_changes (archive_id, batch_id, priority) '
+            'SELECT archive_id, batch_id, priority FROM ('
+            '  SELECT candidate_snapshots.archive_id, '
+            '    candidate_snapshots.snapshot_fetch_batch_id AS batch_id, '
+            '    candidate_snapshots.snapshot_fetch_priority AS previous_priority, '
+            '    {priority_expression} AS priority '
+            '  FROM candidate_snapshots '
+            '  LEFT JOIN impressions ON impressions.archive_id = candidate_snapshots.archive_id '
+            '  LEFT JOIN page_fetched_snapshot_counts USING(page_id)) AS candidate_priorities '
+            'WHERE priority IS DISTINCT FROM previous_priority').format(
+                page_fetched_snapshot_counts_cte=_PAGE_FETCHED_SNAPSHOT_COUNTS_CTE.format(
+                    page_id_condition=sql.SQL(
+                        'AND ads.page_id IN (SELECT page_id FROM candidate_snapshots)')),
+                priority_expression=_SNAPSHOT_FETCH_PRIORITY_EXPRESSION)
+        score_changed_snapshots_params = {'modified_since': modified_since}
+        score_changed_snapshots_params.update(priority_weights._asdict())
+        cursor.execute(score_changed_snapshots_query, score_changed_snapshots_params)
+        num_archive_ids_changed = cursor.rowcount
+        # Temp tables are not auto-analyzed, and without statistics the planner assumes few rows.
+        cursor.execute('ANALYZE snapshot_fetch_priority_changes')
+
+        cursor.execute(
+            'WITH updated_snapshots AS ('
+            '  UPDATE ad_snapshot_metadata SET snapshot_fetch_priority = changes.priority, '
+            '    snapshot_fetch_batch_id = CASE '
+            '      WHEN changes.priority > snapshot_fetch_batches.priority THEN NULL '
+            '      ELSE ad_snapshot_metadata.snapshot_fetch_batch_id END '
+            '  FROM snapshot_fetch_priority_changes AS changes '
+            '  JOIN snapshot_fetch_batches USING(batch_id) '
+            '  WHERE ad_snapshot_metadata.archive_id = changes.archive_id AND '
+            '    ad_snapshot_metadata.snapshot_fetch_batch_id = changes.batch_id AND '
+            '    snapshot_fetch_batches.time_started IS NULL '
+            '  RETURNING ad_snapshot_metadata.snapshot_fetch_batch_id) '
+            'SELECT count(*) AS num_archive_ids_removed FROM updated_snapshots '
+            'WHERE snapshot_fetch_batch_id IS NULL')
+        num_archive_ids_removed = cursor.fetchone()['num_archive_ids_removed']
+
+        cursor.execute(
+            'UPDATE snapshot_fetch_batches SET priority = batch_priorities.priority FROM ('
+            '  SELECT snapshot_fetch_batch_id AS batch_id, '
+            '    max(snapshot_fetch_priority) AS priority '
+            '  FROM ad_snapshot_metadata '
+            '  WHERE needs_scrape = TRUE AND snapshot_fetch_batch_id IN ('
+            '    SELECT batch_id FROM snapshot_fetch_priority_changes) '
+            '  GROUP BY snapshot_fetch_batch_id) AS batch_priorities '
+            'WHERE snapshot_fetch_batches.batch_id = batch_priorities.batch_id AND '
+            '  snapshot_fetch_batches.time_started IS NULL AND '
+            '  snapshot_fetch_batches.priority IS DISTINCT FROM batch_priorities.priority')
+        num_batches_reprioritized = cursor.rowcount
+
+        cursor.execute(
+            'UPDATE snapshot_fetch_batches SET time_completed = CURRENT_TIMESTAMP '
+            'WHERE batch_id IN (SELECT batch_id FROM snapshot_fetch_priority_changes) AND '
+            '  time_started IS NULL AND time_completed IS NULL AND NOT EXISTS ('
+            '    SELECT 1 FROM ad_snapshot_metadata WHERE needs_scrape = TRUE AND '
+            '    ad_snapshot_metadata.snapshot_fetch_batch_id = snapshot_fetch_batches.batch_id)')
+        num_batches_emptied = cursor.rowcount
+        logging.info(
+            'Rescored snapshots modified since %s in %.1f seconds. Priority of %d archive IDs '
+            'changed. Updated priority of %d batches. Removed %d archive IDs from their batch '
+            '(emptying %d batches) for rebatching.', modified_since, time.monotonic() - start_time,
+            num_archive_ids_changed, num_batches_reprioritized, num_archive_ids_removed,
+            num_batches_emptied)
+        return num_archive_ids_removed
+
+    def get_archive_id_batch_to_fetch(self, worker_id=None,
+                                      lease_duration=DEFAULT_FETCH_BATCH_LEASE_DURATION):
+        """Claim highest priority (and then largest batch_id) uncompleted batch that is not
+        leased by another worker.
+
+        Concurrent claimers skip (rather than wait for, or both claim) a batch row locked by
+        another claim. The claim holds a lease that must be renewed with renew_fetch_batch_lease
+        before it expires, otherwise the batch can be claimed by another worker (ie if this worker
+        died).
+
+        Args:
+            worker_id: str identifying claiming worker.
+            lease_duration: datetime.timedelta until lease expires.
+        Returns:
+            dict with batch_id and archive_ids (list of archive IDs in batch that need scrape), or
+            None if no batch is available.
+        """
+        cursor = self.get_cursor()
+        # Batches started without a lease (ie claimed before leases existed) are considered
+        # abandoned after 3 days.
         claim_batch_for_fetch_query = (
-            'UPDATE snapshot_fetch_batches SET time_started = CURRENT_TIMESTAMP WHERE batch_id = '
-            '(SELECT max(batch_id) FROM snapshot_fetch_batches WHERE time_completed IS NULL AND '
-            '(time_started IS NULL OR time_started < CURRENT_TIMESTAMP - interval \'3 days\')) '
+            'UPDATE snapshot_fetch_batches SET time_started = CURRENT_TIMESTAMP, '
+            'lease_expiry_time = CURRENT_TIMESTAMP + %(lease_duration)s, '
+            'worker_id = %(worker_id)s WHERE batch_id = ('
+            'SELECT batch_id FROM snapshot_fetch_batches WHERE time_completed IS NULL AND '
+            '(lease_expiry_time < CURRENT_TIMESTAMP OR (lease_expiry_time IS NULL AND '
+            '(time_started IS NULL OR time_started < CURRENT_TIMESTAMP - interval \'3 days\'))) '
+            'ORDER BY priority DESC NULLS LAST, batch_id DESC LIMIT 1 FOR UPDATE SKIP LOCKED) '
             'RETURNING batch_id')
-        cursor.execute(claim_batch_for_fetch_query)
+        cursor.execute(claim_batch_for_fetch_query,
+                       {'lease_duration': lease_duration, 'worker_id': worker_id})
         row = cursor.fetchone()
         # COMMIT transaction to ensure no one else tries to take the same batch
         self.connection.commit()
@@ -745,16 +1472,51 @@ class DBInterface():
         # TODO(macpd): return this as a namedtuple
         return {'batch_id': batch_id, 'archive_ids': archive_ids_batch}
 
-    def mark_fetch_batch_completed(self, batch_id):
+    def renew_fetch_batch_lease(self, batch_id, worker_id,
+                                lease_duration=DEFAULT_FETCH_BATCH_LEASE_DURATION):
+        """Extend lease of batch_id claimed by worker_id to lease_duration from now.
+
+        Returns:
+            bool True if renewed, False if worker_id no longer holds the lease (ie it expired and
+            batch was claimed by another worker) or batch is completed.
+        """
         cursor = self.get_cursor()
-        cursor.execute('UPDATE snapshot_fetch_batches SET time_completed = CURRENT_TIMESTAMP WHERE '
-                       'batch_id = %s', (batch_id,))
+        cursor.execute(
+            'UPDATE snapshot_fetch_batches SET lease_expiry_time = CURRENT_TIMESTAMP + %s WHERE '
+            'batch_id = %s AND worker_id IS NOT DISTINCT FROM %s AND time_completed IS NULL',
+            (lease_duration, batch_id, worker_id))
+        return cursor.rowcount == 1
+
+    def mark_fetch_batch_completed(self, batch_id, worker_id=None):
+        """Mark uncompleted batch_id claimed by worker_id completed.
 
-    def release_uncompleted_fetch_batch(self, batch_id):
+        Returns:
+            bool True if marked completed, False if worker_id no longer holds the claim (ie its
+            lease expired and batch was claimed by another worker) or batch is already completed.
+        """
         cursor = self.get_cursor()
         cursor.execute(
-            'UPDATE snapshot_fetch_batches SET time_started = NULL, time_completed = NULL WHERE '
-            'time_completed IS NULL AND batch_id = %s', (batch_id,))
+            'UPDATE snapshot_fetch_batches SET time_completed = CURRENT_TIMESTAMP, '
+            'lease_expiry_time = NULL WHERE batch_id = %s AND '
+            'worker_id IS NOT DISTINCT FROM %s AND time_completed IS NULL',
+            (batch_id, worker_id))
+        return cursor.rowcount == 1
+
+    def release_uncompleted_fetch_batch(self, batch_id, worker_id=None):
+        """Release claim of uncompleted batch_id so that it can be claimed immediately.
+
+        Args:
+            batch_id: int batch to release.
+            worker_id: str if provided, only release batch if its lease is held by worker_id.
+        """
+        cursor = self.get_cursor()
+        release_query = (
+            'UPDATE snapshot_fetch_batches SET time_started = NULL, time_completed = NULL, '
+            'lease_expiry_time = NULL, worker_id = NULL WHERE time_completed IS NULL AND '
+            'batch_id = %(batch_id)s')
+        if worker_id is not None:
+            release_query += ' AND worker_id = %(worker_id)s'
+        cursor.execute(release_query, {'batch_id': batch_id, 'worker_id': worker_id})
 
 
     def advertisers_age_and_sum_min_impressions(self, min_ad_creation_time):
@@ -913,15 +1675,32 @@ class DBInterface():
                                        template=insert_template,
                                        page_size=_DEFAULT_PAGE_SIZE)
 
-    def update_ad_last_active_date(self, last_active_date, archive_ids):
+    def update_ad_last_active_date(self, last_active_date, archive_ids,
+                                   batch_size=_DEFAULT_LAST_ACTIVE_DATE_BATCH_SIZE):
+        """Set impressions last_active_date of archive_ids.
+
+        IDs are sent as one bigint array per batch_size IDs, and each batch is applied with a single
+        UPDATE joined against the unnested array, rather than one UPDATE per ad. Rows that already
+        have last_active_date are not rewritten.
+
+        Args:
+            last_active_date: datetime.date ads were last active.
+            archive_ids: iterable of int archive IDs.
+            batch_size: int max number of archive IDs per UPDATE statement.
+        Returns:
+            int number of impressions rows updated.
+        """
         cursor = self.get_cursor()
         update_last_active_field_query = (
-            'UPDATE impressions SET last_active_date = %(last_active_date)s WHERE archive_id = '
-            '%(archive_id)s')
-        # execute_batch requires an interable of iterables for arglist
-        archive_id_arg_list = [{'last_active_date': last_active_date, 'archive_id': archive_id}
-                               for archive_id in archive_ids]
-        psycopg2.extras.execute_batch(cursor,
-                                      update_last_active_field_query,
-                                      archive_id_arg_list,
-                                      page_size=_DEFAULT_PAGE_SIZE)
+            'UPDATE impressions SET last_active_date = %(last_active_date)s '
+            'FROM unnest(%(archive_ids)s::bigint[]) AS active_ads(archive_id) '
+            'WHERE impressions.archive_id = active_ads.archive_id AND '
+            'impressions.last_active_date IS DISTINCT FROM %(last_active_date)s')
+        archive_ids = list(archive_ids)
+        num_rows_updated = 0
+        for i in range(0, len(archive_ids), batch_size):
+            cursor.execute(update_last_active_field_query,
+                           {'last_active_date': last_active_date,
+                            'archive_ids': archive_ids[i:i + batch_size]})
+            num_rows_updated += cursor.rowcount
+        return num_rows_updated
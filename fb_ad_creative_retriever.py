@@ -8,23 +8,21 @@
 4. Install package's dependencies (pip install -r path/to/fbactiveads/requirements.txt)
 """
 import collections
+import concurrent.futures
 import datetime
 import enum
 import hashlib
 import logging
-import io
 import os.path
+import queue
 import socket
 import sys
+import tempfile
+import threading
 import time
 
-import dhash
 from google.cloud import storage
-from langdetect import detect
-from langdetect import DetectorFactory
-from langdetect.lang_detect_exception import LangDetectException
 import requests
-from PIL import Image
 import tenacity
 
 from fbactiveads.adsnapshots import ad_creative_retriever
@@ -33,9 +31,10 @@ from fbactiveads.common import config as fbactiveads_config
 from fbactiveads.common.crawler import EndBatchCrawlerException
 from selenium.common.exceptions import WebDriverException
 
+import ad_creative_features
+import blob_uploader
 import config_utils
 import db_functions
-import sim_hash_ad_creative_text
 import slack_notifier
 
 
@@ -47,9 +46,18 @@ CONTENT_LENGTH_HEADER = 'content-length'
 GCS_CREDENTIALS_FILE = 'gcs_credentials.json'
 VIDEO_HASH_PATH_DIR_NAME_LENGTH = 4
 DEFAULT_MAX_VIDEO_DOWNLOAD_SIZE = 512000000 # approx 512 MB
+VIDEO_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Downloaded videos larger than this are spooled to disk instead of memory.
+VIDEO_SPOOL_MAX_MEMORY_SIZE = 8 * 1024 * 1024
 DEFAULT_MAX_ARCHIVE_IDS = 200
 DEFAULT_BATCH_SIZE = 20
+DEFAULT_NUM_CREATIVE_FEATURE_WORKERS = 2
+DEFAULT_NUM_BROWSERS = 1
 RESET_BROWSER_AFTER_PROCESSING_N_SNAPSHOTS = 2000
+DEFAULT_FETCH_BATCH_LEASE_MINUTES = 10
+# Number of times a fetch batch lease is renewed per lease duration, so that a few failed renewals
+# (ie transient DB errors) do not lose the lease.
+FETCH_BATCH_LEASE_RENEWALS_PER_LEASE_DURATION = 3
 TOO_MANY_REQUESTS_SLEEP_TIME = 4 * 60 * 60 # 4 hours
 NO_AVAILABLE_WORK_SLEEP_TIME = 1 * 60 * 60 # 1 hour
 
@@ -89,7 +97,9 @@ AdSnapshotMetadataRecord = collections.namedtuple('AdSnapshotMetadataRecord', [
 
 DownloadedVideoAttributes = collections.namedtuple('DownloadedVideoAttributes',
                                                    ['video_sha256_hash',
-                                                    'video_bucket_path'])
+                                                    'video_bucket_path',
+                                                    'video_file',
+                                                    'video_size'])
 
 
 class Error(Exception):
@@ -120,6 +130,17 @@ def make_gcs_bucket_client(bucket_name, credentials_file):
     return bucket_client
 
 
+def make_bucket_client(bucket_name, config):
+    """Get GCS client of bucket_name, or a local filesystem bucket client if STORAGE
+    LOCAL_BUCKETS_DIR is configured."""
+    local_buckets_dir = config.get('STORAGE', 'LOCAL_BUCKETS_DIR', fallback=None)
+    if local_buckets_dir:
+        logging.info('Storing %s blobs under local directory %s', bucket_name, local_buckets_dir)
+        return blob_uploader.LocalFilesystemBucketClient(
+            os.path.join(local_buckets_dir, bucket_name))
+    return make_gcs_bucket_client(bucket_name, GCS_CREDENTIALS_FILE)
+
+
 def make_image_hash_file_path(image_hash):
     base_file_name = '%s.jpg' % image_hash
     return os.path.join(image_hash[:4], image_hash[4:8], image_hash[8:12],
@@ -134,20 +155,17 @@ def make_video_sha256_hash_file_path(video_sha256_hash):
     return os.path.join(*dirs, base_file_name)
 
 
-def get_image_dhash(image_bytes):
-    image_file = io.BytesIO(image_bytes)
-    image = Image.open(image_file)
-    dhash.force_pil()
-    row, col = dhash.dhash_row_col(image)
-    image_dhash = dhash.format_hex(row, col)
-    return image_dhash
-
 @tenacity.retry(stop=tenacity.stop_after_attempt(4),
                 wait=tenacity.wait_random_exponential(multiplier=1, max=30),
                 before_sleep=tenacity.before_sleep_log(LOGGER, logging.INFO))
 def upload_blob(bucket_client, blob_path, blob_data):
+    """Upload blob_data (bytes or binary file object) to blob_path."""
     blob = bucket_client.blob(blob_path)
-    blob.upload_from_string(blob_data)
+    if isinstance(blob_data, bytes):
+        blob.upload_from_string(blob_data)
+    else:
+        # Rewind so that retries upload the whole file.
+        blob.upload_from_file(blob_data, rewind=True)
     return blob.id
 
 def send_slack_message(slack_url, msg, slack_user_id_to_include=None):
@@ -156,13 +174,92 @@ def send_slack_message(slack_url, msg, slack_user_id_to_include=None):
     slack_notifier.notify_slack(slack_url, msg)
 
 
+class BrowserWorker:
+    """A browser context and the creative retriever driving it. Used by one thread at a time."""
+
+    def __init__(self, browser_id, creative_retriever_generator):
+        """
+        Args:
+            browser_id: int identifying browser in log messages.
+            creative_retriever_generator: generator yielding a creative retriever with a new
+                browser context on each iteration (ie
+                FacebookAdCreativeRetriever.make_creative_retriever_generator).
+        """
+        self.browser_id = browser_id
+        self.creative_retriever_generator = creative_retriever_generator
+        self.creative_retriever = None
+        self.num_snapshots_processed_since_reset = 0
+
+    def reset(self):
+        logging.info('Resetting creative retriever instance of browser %d', self.browser_id)
+        self.creative_retriever = next(self.creative_retriever_generator)
+        self.num_snapshots_processed_since_reset = 0
+
+    def reset_if_processed_limit_reached(self):
+        if self.num_snapshots_processed_since_reset >= RESET_BROWSER_AFTER_PROCESSING_N_SNAPSHOTS:
+            logging.info('Browser %d processed %d snapshots since last reset (limit: %d)',
+                         self.browser_id, self.num_snapshots_processed_since_reset,
+                         RESET_BROWSER_AFTER_PROCESSING_N_SNAPSHOTS)
+            self.reset()
+
+
+class FetchBatchLeaseHeartbeat:
+    """Renews lease of a claimed snapshot fetch batch from a background thread until stopped.
+
+    If renewal finds that the lease is no longer held by worker_id (ie this worker stalled past
+    lease expiry and another worker claimed the batch) lease_lost is set.
+    """
+
+    def __init__(self, database_connection_params, batch_id, worker_id, lease_duration):
+        self.database_connection_params = database_connection_params
+        self.batch_id = batch_id
+        self.worker_id = worker_id
+        self.lease_duration = lease_duration
+        self.lease_lost = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._renew_lease_until_stopped,
+                                        name='fetch_batch_lease_heartbeat', daemon=True)
+
+    def _renew_lease_until_stopped(self):
+        renewal_interval = (self.lease_duration.total_seconds() /
+                            FETCH_BATCH_LEASE_RENEWALS_PER_LEASE_DURATION)
+        while not self._stopped.wait(renewal_interval):
+            try:
+                with db_functions.db_interface_context(self.database_connection_params) \
+                    as db_interface:
+                    lease_renewed = db_interface.renew_fetch_batch_lease(
+                        self.batch_id, self.worker_id, lease_duration=self.lease_duration)
+            except Exception as error:
+                logging.warning('Unable to renew lease of snapshot_fetch_batch_id %s: %r',
+                                self.batch_id, error)
+                continue
+            if not lease_renewed:
+                logging.error('Lost lease of snapshot_fetch_batch_id %s (worker ID %s).',
+                              self.batch_id, self.worker_id)
+                self.lease_lost.set()
+                return
+            logging.debug('Renewed lease of snapshot_fetch_batch_id %s', self.batch_id)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
 class FacebookAdCreativeRetriever:
 
     def __init__(self, database_connection_params, creative_retriever_factory,
                  browser_context_factory, ad_creative_images_bucket_client,
                  ad_creative_videos_bucket_client, archive_screenshots_bucket_client,
                  commit_to_db_every_n_processed, slack_url, slack_user_id_to_include,
-                 max_video_download_size=DEFAULT_MAX_VIDEO_DOWNLOAD_SIZE):
+                 max_video_download_size=DEFAULT_MAX_VIDEO_DOWNLOAD_SIZE,
+                 num_creative_feature_workers=0,
+                 max_upload_workers=blob_uploader.DEFAULT_MAX_UPLOAD_WORKERS,
+                 max_pending_upload_bytes=blob_uploader.DEFAULT_MAX_PENDING_BYTES,
+                 num_browsers=DEFAULT_NUM_BROWSERS,
+                 fetch_batch_lease_duration=db_functions.DEFAULT_FETCH_BATCH_LEASE_DURATION):
         self.ad_creative_images_bucket_client = ad_creative_images_bucket_client
         self.ad_creative_videos_bucket_client = ad_creative_videos_bucket_client
         self.archive_screenshots_bucket_client = archive_screenshots_bucket_client
@@ -177,7 +274,13 @@ class FacebookAdCreativeRetriever:
         self.num_video_download_success = 0
         self.num_video_download_failure = 0
         self.num_video_uploade_to_gcs_bucket = 0
+        self.num_uploads_skipped_already_stored = 0
+        self.num_upload_bytes_saved = 0
         self.current_batch_id = None
+        # Identifies this process in snapshot_fetch_batches claims, so that several retrievers
+        # (on one or more hosts) can claim batches concurrently.
+        self.worker_id = '%s:%d' % (socket.getfqdn(), os.getpid())
+        self.fetch_batch_lease_duration = fetch_batch_lease_duration
         self.database_connection_params = database_connection_params
         self.commit_to_db_every_n_processed = commit_to_db_every_n_processed
         self.start_time = None
@@ -185,8 +288,43 @@ class FacebookAdCreativeRetriever:
         self.slack_user_id_to_include = slack_user_id_to_include
         self.creative_retriever_factory = creative_retriever_factory
         self.browser_context_factory = browser_context_factory
-        self.creative_retriever_generator = self.make_creative_retriever_generator()
-        self.creative_retriever = None
+        # Snapshots are retrieved concurrently by num_browsers browsers. Each retrieval checks out
+        # an idle browser, so no browser is used by more than one thread at a time.
+        self.browser_workers = [
+            BrowserWorker(browser_id, self.make_creative_retriever_generator())
+            for browser_id in range(num_browsers)]
+        self.idle_browser_workers = queue.Queue()
+        for browser_worker in self.browser_workers:
+            self.idle_browser_workers.put(browser_worker)
+        self.retrieval_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_browsers, thread_name_prefix='snapshot_retriever')
+        # Guards counters updated by retrieval threads.
+        self.retrieval_stats_lock = threading.Lock()
+        # Image decoding, hashing, and language detection run in these worker processes so that
+        # retrieval of the next snapshot is not blocked on them. 0 computes features inline.
+        self.creative_features_executor = None
+        if num_creative_feature_workers:
+            self.creative_features_executor = (
+                ad_creative_features.make_creative_features_executor(
+                    num_creative_feature_workers))
+        # Media and screenshots are uploaded in the background. Uploads are waited for before
+        # records referencing their bucket paths are committed.
+        self.blob_uploader = blob_uploader.BlobUploader(
+            upload_blob, max_workers=max_upload_workers,
+            max_pending_bytes=max_pending_upload_bytes)
+        # Images and videos are stored at paths derived from their content hash, so uploads of
+        # paths known to be stored (recently uploaded, or referenced by a committed ad_creatives
+        # record) are skipped.
+        self.stored_image_bucket_paths = blob_uploader.StoredBlobPathCache()
+        self.stored_video_bucket_paths = blob_uploader.StoredBlobPathCache()
+        # (StoredBlobPathCache, blob path) of uploads not yet known to have succeeded.
+        self.pending_stored_blob_paths = []
+
+    def shutdown(self):
+        self.retrieval_executor.shutdown()
+        if self.creative_features_executor:
+            self.creative_features_executor.shutdown()
+        self.blob_uploader.shutdown()
 
     def get_seconds_elapsed_procesing(self):
         if not self.start_time:
@@ -210,6 +348,7 @@ class FacebookAdCreativeRetriever:
             'Videos downloads successful: %d\n'
             'Videos downloads failed: %d\n'
             'Videos uploaded to GCS bucket: %d\n'
+            'Uploads skipped (already stored): %d (%d bytes saved)\n'
             'Average time spent per ad creative: %f seconds\n'
             'Current batch ID: %s',
             self.num_snapshots_processed, seconds_elapsed_procesing,
@@ -221,6 +360,7 @@ class FacebookAdCreativeRetriever:
             self.num_video_download_success,
             self.num_video_download_failure,
             self.num_video_uploade_to_gcs_bucket,
+            self.num_uploads_skipped_already_stored, self.num_upload_bytes_saved,
             seconds_elapsed_procesing / (self.num_ad_creatives_found or 1),
             self.current_batch_id)
 
@@ -228,7 +368,8 @@ class FacebookAdCreativeRetriever:
         """Get batch of archive IDs to fetch. Block until results are available."""
         while True:
             with db_functions.db_interface_context(self.database_connection_params) as db_interface:
-                batch_and_archive_ids = db_interface.get_archive_id_batch_to_fetch()
+                batch_and_archive_ids = db_interface.get_archive_id_batch_to_fetch(
+                    worker_id=self.worker_id, lease_duration=self.fetch_batch_lease_duration)
 
             if batch_and_archive_ids:
                 return batch_and_archive_ids
@@ -250,15 +391,18 @@ class FacebookAdCreativeRetriever:
                 yield new_creative_retriever
 
     def reset_creative_retriever(self):
-        logging.info('Resetting creative retriever instance')
-        self.creative_retriever = next(self.creative_retriever_generator)
+        """Reset creative retriever instances of all browsers. Must not be called while snapshots
+        are being retrieved."""
+        for browser_worker in self.browser_workers:
+            browser_worker.reset()
 
 
     def retreive_and_store_ad_creatives(self):
         logging.info('Max video download size %d bytes', self.max_video_download_size)
+        logging.info('Claiming snapshot fetch batches as worker ID %s with %s lease.',
+                     self.worker_id, self.fetch_batch_lease_duration)
         self.reset_creative_retriever()
         self.reset_start_time()
-        num_snapshots_processed_since_chromedriver_reset = 0
         while True:
             try:
                 batch_and_archive_ids = self.get_archive_id_batch_or_wait_until_available()
@@ -268,10 +412,16 @@ class FacebookAdCreativeRetriever:
                     'Processing batch ID %d of %d archive snapshots in chunks of %d',
                     self.current_batch_id, len(archive_id_batch),
                     self.commit_to_db_every_n_processed)
+                lease_heartbeat = FetchBatchLeaseHeartbeat(
+                    self.database_connection_params, self.current_batch_id, self.worker_id,
+                    self.fetch_batch_lease_duration)
+                lease_heartbeat.start()
                 try:
                     num_snapshots_processed_in_current_batch = 0
                     for archive_id_chunk in chunks(archive_id_batch,
                                                    self.commit_to_db_every_n_processed):
+                        if lease_heartbeat.lease_lost.is_set():
+                            break
                         self.process_archive_ids(archive_id_chunk)
                         #  self.db_connection.commit()
                         num_snapshots_processed_in_current_batch += len(archive_id_chunk)
@@ -285,21 +435,30 @@ class FacebookAdCreativeRetriever:
                         '%s', self.current_batch_id, error)
                     with db_functions.db_interface_context(self.database_connection_params) \
                         as db_interface:
-                        db_interface.release_uncompleted_fetch_batch(self.current_batch_id)
+                        db_interface.release_uncompleted_fetch_batch(
+                            self.current_batch_id, worker_id=self.worker_id)
                     raise
-                num_snapshots_processed_since_chromedriver_reset += len(archive_id_batch)
+                finally:
+                    lease_heartbeat.stop()
+
+                if lease_heartbeat.lease_lost.is_set():
+                    # Batch was claimed by another worker after our lease expired, so leave it
+                    # uncompleted for that worker.
+                    logging.warning('Abandoning snapshot_fetch_batch_id %s after %d of %d '
+                                    'archive snapshots.', self.current_batch_id,
+                                    num_snapshots_processed_in_current_batch,
+                                    len(archive_id_batch))
+                    continue
 
                 with db_functions.db_interface_context(self.database_connection_params) \
                     as db_interface:
-                    db_interface.mark_fetch_batch_completed(self.current_batch_id)
-
-                if (num_snapshots_processed_since_chromedriver_reset >=
-                    RESET_BROWSER_AFTER_PROCESSING_N_SNAPSHOTS):
-                    logging.info('Processed %d snapshots since last reset (limit: %d)',
-                                 num_snapshots_processed_since_chromedriver_reset,
-                                 RESET_BROWSER_AFTER_PROCESSING_N_SNAPSHOTS)
-                    self.reset_creative_retriever()
-                    num_snapshots_processed_since_chromedriver_reset = 0
+                    batch_completed = db_interface.mark_fetch_batch_completed(
+                        self.current_batch_id, worker_id=self.worker_id)
+                if not batch_completed:
+                    # Lease expired and batch was claimed by another worker before the heartbeat
+                    # noticed, so leave it for that worker to complete.
+                    logging.warning('Not marking snapshot_fetch_batch_id %s completed, its lease '
+                                    'is held by another worker.', self.current_batch_id)
 
             except (ad_creative_retriever.TooManyRequestsError, EndBatchCrawlerException) as error:
                 suggested_sleep_time = getattr(error, 'wait_before_next_batch_seconds',
@@ -317,39 +476,142 @@ class FacebookAdCreativeRetriever:
             finally:
                 self.log_stats()
 
+    def load_stored_image_bucket_paths(self, image_bucket_paths):
+        """Add image_bucket_paths referenced by committed ad_creatives records to
+        stored_image_bucket_paths, with one query for all paths not already cached."""
+        uncached_image_bucket_paths = {
+            image_bucket_path for image_bucket_path in image_bucket_paths
+            if image_bucket_path not in self.stored_image_bucket_paths}
+        if not uncached_image_bucket_paths:
+            return
+        with db_functions.db_interface_context(self.database_connection_params) as db_interface:
+            stored_image_bucket_paths = db_interface.stored_ad_creative_image_bucket_paths(
+                uncached_image_bucket_paths)
+        for image_bucket_path in stored_image_bucket_paths:
+            self.stored_image_bucket_paths.add(image_bucket_path)
+
+    def load_stored_video_bucket_paths(self, video_bucket_paths):
+        """Add video_bucket_paths referenced by committed ad_creatives records to
+        stored_video_bucket_paths, with one query for all paths not already cached."""
+        uncached_video_bucket_paths = {
+            video_bucket_path for video_bucket_path in video_bucket_paths
+            if video_bucket_path not in self.stored_video_bucket_paths}
+        if not uncached_video_bucket_paths:
+            return
+        with db_functions.db_interface_context(self.database_connection_params) as db_interface:
+            stored_video_bucket_paths = db_interface.stored_ad_creative_video_bucket_paths(
+                uncached_video_bucket_paths)
+        for video_bucket_path in stored_video_bucket_paths:
+            self.stored_video_bucket_paths.add(video_bucket_path)
+
+    def upload_unless_stored(self, bucket_client, stored_blob_paths, blob_path, blob_data,
+                             blob_size=None):
+        """Submit upload of blob_data to blob_path unless it is in stored_blob_paths.
+
+        Args:
+            blob_data: bytes, or binary file object which is closed once uploaded or skipped.
+            blob_size: int size of blob_data. Required if blob_data is a file object.
+        Returns:
+            bool True if upload was submitted, False if skipped.
+        """
+        if blob_size is None:
+            blob_size = len(blob_data)
+        if blob_path in stored_blob_paths:
+            self.num_uploads_skipped_already_stored += 1
+            self.num_upload_bytes_saved += blob_size
+            logging.debug('Skipping upload of already stored %s', blob_path)
+            if not isinstance(blob_data, bytes):
+                blob_data.close()
+            return False
+        self.blob_uploader.submit(bucket_client, blob_path, blob_data, blob_size=blob_size)
+        stored_blob_paths.add(blob_path)
+        self.pending_stored_blob_paths.append((stored_blob_paths, blob_path))
+        return True
+
+    def wait_for_uploads(self):
+        """Wait for all submitted uploads. If any failed, their paths are forgotten so that they
+        are uploaded again when next seen."""
+        pending_stored_blob_paths = self.pending_stored_blob_paths
+        self.pending_stored_blob_paths = []
+        try:
+            self.blob_uploader.wait_for_uploads()
+        except BaseException:
+            for stored_blob_paths, blob_path in pending_stored_blob_paths:
+                stored_blob_paths.discard(blob_path)
+            raise
+
     def store_image_in_google_bucket(self, image_dhash, image_bytes):
         image_bucket_path = make_image_hash_file_path(image_dhash)
-        blob_id = upload_blob(self.ad_creative_images_bucket_client, image_bucket_path, image_bytes)
-        self.num_image_uploade_to_gcs_bucket += 1
-        logging.debug('Image dhash: %s; uploaded to: %s', image_dhash, blob_id)
+        if self.upload_unless_stored(self.ad_creative_images_bucket_client,
+                                     self.stored_image_bucket_paths, image_bucket_path,
+                                     image_bytes):
+            self.num_image_uploade_to_gcs_bucket += 1
+            logging.debug('Image dhash: %s; uploading to: %s', image_dhash, image_bucket_path)
         return image_bucket_path
 
-    def store_video_in_google_bucket(self, video_sha256_hash, video_bytes):
-        video_bucket_path = make_video_sha256_hash_file_path(video_sha256_hash)
-        blob_id = upload_blob(self.ad_creative_videos_bucket_client, video_bucket_path, video_bytes)
-        self.num_video_uploade_to_gcs_bucket += 1
-        logging.debug('Video sha256_hash: %s; uploaded to: %s', video_sha256_hash, blob_id)
-        return video_bucket_path
+    def store_video_in_google_bucket(self, downloaded_video):
+        """Upload downloaded video unless already stored. Its video file is closed once uploaded
+        or skipped, or if an error is raised.
+
+        Args:
+            downloaded_video: DownloadedVideoAttributes.
+        """
+        try:
+            self.load_stored_video_bucket_paths([downloaded_video.video_bucket_path])
+            if self.upload_unless_stored(self.ad_creative_videos_bucket_client,
+                                         self.stored_video_bucket_paths,
+                                         downloaded_video.video_bucket_path,
+                                         downloaded_video.video_file,
+                                         blob_size=downloaded_video.video_size):
+                self.num_video_uploade_to_gcs_bucket += 1
+                logging.debug('Video sha256_hash: %s; uploading to: %s',
+                              downloaded_video.video_sha256_hash,
+                              downloaded_video.video_bucket_path)
+        except BaseException:
+            downloaded_video.video_file.close()
+            raise
 
     def store_snapshot_screenshot(self, archive_id, screenshot_binary_data):
         bucket_path = '%d.png' % archive_id
-        blob_id = upload_blob(self.archive_screenshots_bucket_client, bucket_path,
-                              screenshot_binary_data)
-        logging.debug('Uploaded %d archive_id snapshot to %s', archive_id, blob_id)
+        self.blob_uploader.submit(self.archive_screenshots_bucket_client, bucket_path,
+                                  screenshot_binary_data)
+        logging.debug('Uploading %d archive_id snapshot to %s', archive_id, bucket_path)
 
-    def retrieve_ad(self, archive_id):
+    def retrieve_ad_with_idle_browser(self, archive_id):
+        """Retrieve archive_id with the next idle browser. Blocks until a browser is idle."""
+        browser_worker = self.idle_browser_workers.get()
+        try:
+            browser_worker.reset_if_processed_limit_reached()
+            return self.retrieve_ad(archive_id, browser_worker=browser_worker)
+        finally:
+            self.idle_browser_workers.put(browser_worker)
+
+    def retrieve_ad(self, archive_id, browser_worker=None):
+        """Retrieve screenshot and creatives of archive_id.
+
+        Args:
+            archive_id: int archive ID to retrieve.
+            browser_worker: BrowserWorker to retrieve with. Defaults to first browser.
+        Returns:
+            (screenshot and creatives or None, AdSnapshotMetadataRecord)
+        """
+        browser_worker = browser_worker or self.browser_workers[0]
         snapshot_fetch_status = SnapshotFetchStatus.UNKNOWN
         screenshot_and_creatives = None
+        num_snapshots_fetch_failed = 0
         try:
-            logging.info('Retrieving creatives for archive ID %s', archive_id)
+            logging.info('Retrieving creatives for archive ID %s with browser %d', archive_id,
+                         browser_worker.browser_id)
             try:
                 fetch_time = datetime.datetime.now()
-                screenshot_and_creatives = self.creative_retriever.retrieve_ad(str(archive_id))
+                screenshot_and_creatives = browser_worker.creative_retriever.retrieve_ad(
+                    str(archive_id))
             except (ad_creative_retriever.BrowserTimeoutError, WebDriverException) as error:
                 logging.info('Browser error (%s), resetting ad creative retriever', error)
-                self.reset_creative_retriever()
+                browser_worker.reset()
                 fetch_time = datetime.datetime.now()
-                screenshot_and_creatives = self.creative_retriever.retrieve_ad(str(archive_id))
+                screenshot_and_creatives = browser_worker.creative_retriever.retrieve_ad(
+                    str(archive_id))
 
             logging.debug('%s creatives:\n%s', archive_id, screenshot_and_creatives.creatives)
 
@@ -364,7 +626,7 @@ class FacebookAdCreativeRetriever:
             logging.info(
                 'Request exception while processing archive id:%s\n%s',
                 archive_id, request_exception)
-            self.num_snapshots_fetch_failed += 1
+            num_snapshots_fetch_failed += 1
             # TODO(macpd): decide how to count the errors below
         except (ad_creative_retriever.SnapshotNoContentFoundError,
                 ad_creative_retriever.SnapshotMissingMediaError):
@@ -384,44 +646,101 @@ class FacebookAdCreativeRetriever:
         snapshot_metadata_record = AdSnapshotMetadataRecord(
             archive_id=archive_id, snapshot_fetch_time=fetch_time,
             snapshot_fetch_status=snapshot_fetch_status)
-        self.num_snapshots_processed += 1
+        browser_worker.num_snapshots_processed_since_reset += 1
+        with self.retrieval_stats_lock:
+            self.num_snapshots_processed += 1
+            self.num_snapshots_fetch_failed += num_snapshots_fetch_failed
 
         return screenshot_and_creatives, snapshot_metadata_record
 
+    def submit_creative_features(self, creatives):
+        """Start computing ad_creative_features.CreativeFeatures of creatives.
+
+        Args:
+            creatives: list of creatives from fetched ad data.
+        Returns:
+            list of concurrent.futures.Future of CreativeFeatures in creatives order.
+        """
+        feature_futures = []
+        for creative in creatives:
+            image_bytes = creative.image.binary_data if creative.image else None
+            if self.creative_features_executor:
+                feature_futures.append(self.creative_features_executor.submit(
+                    ad_creative_features.compute_creative_features, image_bytes, creative.body))
+                continue
+            feature_future = concurrent.futures.Future()
+            feature_future.set_result(
+                ad_creative_features.compute_creative_features(image_bytes, creative.body))
+            feature_futures.append(feature_future)
+        return feature_futures
+
     def process_archive_ids(self, archive_ids):
         archive_ids_without_creative_found = 0
         snapshot_metadata_records = []
         ad_creative_records = []
-        for archive_id in archive_ids:
-            screenshot_and_creatives, snapshot_metadata_record = self.retrieve_ad(archive_id)
-            snapshot_metadata_records.append(snapshot_metadata_record)
-            if not screenshot_and_creatives:
-                archive_ids_without_creative_found += 1
-                logging.info(
-                    'Unable to get screenshot or creative(s) for archive_id: %s', archive_id)
-                continue
+        # (archive_id, fetched data, creative features futures) of snapshots with creatives, in
+        # order retrieved. Features are computed while the following snapshots are retrieved.
+        fetched_creatives = []
+        # Archive IDs are dispatched to idle browsers, and results handled in archive ID order.
+        retrieval_futures = [
+            self.retrieval_executor.submit(self.retrieve_ad_with_idle_browser, archive_id)
+            for archive_id in archive_ids]
+        try:
+            for archive_id, retrieval_future in zip(archive_ids, retrieval_futures):
+                screenshot_and_creatives, snapshot_metadata_record = retrieval_future.result()
+                snapshot_metadata_records.append(snapshot_metadata_record)
+                if not screenshot_and_creatives:
+                    archive_ids_without_creative_found += 1
+                    logging.info(
+                        'Unable to get screenshot or creative(s) for archive_id: %s', archive_id)
+                    continue
 
-            if screenshot_and_creatives.screenshot_binary_data:
-                self.store_snapshot_screenshot(archive_id,
-                                               screenshot_and_creatives.screenshot_binary_data)
-            else:
-                logging.info('No screenshot for archive ID: %s', archive_id)
+                if screenshot_and_creatives.screenshot_binary_data:
+                    self.store_snapshot_screenshot(
+                        archive_id, screenshot_and_creatives.screenshot_binary_data)
+                else:
+                    logging.info('No screenshot for archive ID: %s', archive_id)
 
-            if screenshot_and_creatives.creatives:
-                new_ad_creative_recoreds = self.process_fetched_ad_creative_data(
-                    archive_id, screenshot_and_creatives)
-                if new_ad_creative_recoreds:
-                    ad_creative_records.extend(new_ad_creative_recoreds)
+                if screenshot_and_creatives.creatives:
+                    fetched_creatives.append(
+                        (archive_id, screenshot_and_creatives,
+                         self.submit_creative_features(screenshot_and_creatives.creatives)))
                 else:
-                    logging.info('No ad creative records generated for archive ID: %s', archive_id)
+                    archive_ids_without_creative_found += 1
+                    logging.info(
+                        'Unable to find ad creative(s) for archive_id: %s', archive_id)
+        finally:
+            # If a retrieval raised (ie TooManyRequestsError) stop dispatching the rest, and let
+            # browsers finish in flight retrievals before backing off.
+            for retrieval_future in retrieval_futures:
+                retrieval_future.cancel()
+            concurrent.futures.wait(retrieval_futures)
+
+        fetched_creatives = [
+            (archive_id, screenshot_and_creatives,
+             [feature_future.result() for feature_future in feature_futures])
+            for archive_id, screenshot_and_creatives, feature_futures in fetched_creatives]
+        self.load_stored_image_bucket_paths(
+            make_image_hash_file_path(features.image_dhash)
+            for _, _, creative_features in fetched_creatives for features in creative_features
+            if features.image_dhash)
+        for archive_id, screenshot_and_creatives, creative_features in fetched_creatives:
+            new_ad_creative_recoreds = self.process_fetched_ad_creative_data(
+                archive_id, screenshot_and_creatives, creative_features=creative_features)
+            if new_ad_creative_recoreds:
+                ad_creative_records.extend(new_ad_creative_recoreds)
             else:
-                archive_ids_without_creative_found += 1
-                logging.info(
-                    'Unable to find ad creative(s) for archive_id: %s', archive_id)
+                logging.info('No ad creative records generated for archive ID: %s', archive_id)
 
         self.num_ad_creatives_found += len(ad_creative_records)
         self.num_snapshots_without_creative_found += archive_ids_without_creative_found
 
+        # Records must not reference bucket paths that failed to upload.
+        upload_wait_start_time = time.monotonic()
+        self.wait_for_uploads()
+        logging.info('Waited %.1f seconds for pending uploads.',
+                     time.monotonic() - upload_wait_start_time)
+
         logging.info('Inserting %d AdCreativeRecords to to DB.',
                      len(ad_creative_records))
         logging.debug('Inserting AdCreativeRecords to DB: %r',
@@ -433,7 +752,17 @@ class FacebookAdCreativeRetriever:
             db_interface.update_ad_snapshot_metadata(snapshot_metadata_records)
 
     def download_video(self, archive_id, video_url):
-        video_bytes = None
+        """Download video in chunks to a spooled temporary file while hashing it. Memory use is
+        bounded by VIDEO_SPOOL_MAX_MEMORY_SIZE rather than video size.
+
+        Returns:
+            DownloadedVideoAttributes, or None if download failed. Its video_file is positioned at
+            the start, and must be stored (ie with store_video_in_google_bucket) or closed by the
+            caller.
+        """
+        video_file = None
+        video_sha256 = hashlib.sha256()
+        video_size = 0
         try:
             with requests.get(video_url, timeout=30, stream=True) as video_request:
                 # TODO(macpd): handle this more gracefully
@@ -462,34 +791,68 @@ class FacebookAdCreativeRetriever:
                     self.num_video_download_failure += 1
                     return None
 
-                video_bytes = video_request.content
+                video_file = tempfile.SpooledTemporaryFile(max_size=VIDEO_SPOOL_MAX_MEMORY_SIZE)
+                for chunk in video_request.iter_content(chunk_size=VIDEO_DOWNLOAD_CHUNK_SIZE):
+                    video_size += len(chunk)
+                    if video_size > self.max_video_download_size:
+                        logging.info(
+                            '%s video download exceeded max_video_download_size %s (%s: %s)',
+                            archive_id, self.max_video_download_size, CONTENT_LENGTH_HEADER,
+                            video_content_len)
+                        self.num_video_download_failure += 1
+                        video_file.close()
+                        return None
+                    video_sha256.update(chunk)
+                    video_file.write(chunk)
 
         except requests.RequestException as request_exception:
             logging.info('Exception %s when requesting video_url: %s',
                          request_exception, video_url)
             self.num_video_download_failure += 1
+            if video_file:
+                video_file.close()
             # TODO(macpd): handle all error types
             return None
+        except BaseException:
+            if video_file:
+                video_file.close()
+            raise
 
         self.num_video_download_success += 1
-        video_sha256 = hashlib.sha256(video_bytes).hexdigest()
-        video_bucket_path = self.store_video_in_google_bucket(
-            video_sha256, video_bytes)
-        return DownloadedVideoAttributes(video_sha256_hash=video_sha256,
-                                         video_bucket_path=video_bucket_path)
-
-
-    def process_fetched_ad_creative_data(self, archive_id, fetched_data):
+        video_sha256 = video_sha256.hexdigest()
+        video_file.seek(0)
+        return DownloadedVideoAttributes(
+            video_sha256_hash=video_sha256,
+            video_bucket_path=make_video_sha256_hash_file_path(video_sha256),
+            video_file=video_file, video_size=video_size)
+
+
+    def process_fetched_ad_creative_data(self, archive_id, fetched_data, creative_features=None):
+        """Store creative media and make AdCreativeRecords of fetched_data creatives.
+
+        Args:
+            archive_id: int archive ID of fetched_data.
+            fetched_data: screenshot and creatives retrieved for archive_id.
+            creative_features: list of ad_creative_features.CreativeFeatures of each creative (ie
+                from submit_creative_features). Computed if None.
+        Returns:
+            list of AdCreativeRecord.
+        """
         if not fetched_data.creatives:
             logging.warning('No creatives for %s', archive_id)
             return None
 
+        if creative_features is None:
+            creative_features = [
+                feature_future.result()
+                for feature_future in self.submit_creative_features(fetched_data.creatives)]
+
         # Used to prevent sending multiple records for upsert in same batch that have duplicate
         # attributes the database requires to be unique.
         seen_unique_constraint_attrs = set()
         ad_creative_records = []
 
-        for creative in fetched_data.creatives:
+        for creative, features in zip(fetched_data.creatives, creative_features):
             image_dhash = None
             image_sha256 = None
             image_bucket_path = None
@@ -497,44 +860,36 @@ class FacebookAdCreativeRetriever:
             video_sha256 = None
             video_bucket_path = None
             if creative.image:
-                try:
-                    image_dhash = get_image_dhash(creative.image.binary_data)
-                except OSError as error:
+                if features.image_error:
                     logging.warning(
                         "Error generating dhash for archive ID: %s, image_url: %s. "
                         "images_bytes len: %d\n%s", archive_id,
-                        creative.image.url, len(creative.image.binary_data), error)
+                        creative.image.url, len(creative.image.binary_data), features.image_error)
                     self.num_image_download_failure += 1
                     continue
 
                 self.num_image_download_success += 1
                 image_url = creative.image.url
-                image_sha256 = hashlib.sha256(creative.image.binary_data).hexdigest()
+                image_dhash = features.image_dhash
+                image_sha256 = features.image_sha256_hash
                 image_bucket_path = self.store_image_in_google_bucket(
                     image_dhash, creative.image.binary_data)
             if creative.video_url:
                 downloaded_video_attributes = self.download_video(archive_id, creative.video_url)
                 if downloaded_video_attributes:
+                    # Stored as soon as downloaded, so that only pending uploads (bounded by
+                    # blob_uploader max_pending_bytes) hold videos open.
+                    self.store_video_in_google_bucket(downloaded_video_attributes)
                     video_sha256 = downloaded_video_attributes.video_sha256_hash
                     video_bucket_path = downloaded_video_attributes.video_bucket_path
 
-            text = None
-            text_sim_hash = None
-            text_sha256_hash = None
-            ad_creative_body_language = None
-            if creative.body:
-                text = creative.body
-                # Get simhash as hex without leading '0x'
-                text_sim_hash = '%x' % sim_hash_ad_creative_text.hash_ad_creative_text(
-                    text)
-                text_sha256_hash = hashlib.sha256(bytes(
-                    text, encoding='UTF-32')).hexdigest()
-                try:
-                    ad_creative_body_language = detect(text)
-                except LangDetectException as error:
-                    logging.info('Unable to determine language of ad creative body from %s',
-                                 archive_id)
-                    ad_creative_body_language = None
+            text = creative.body or None
+            text_sim_hash = features.text_sim_hash
+            text_sha256_hash = features.text_sha256_hash
+            ad_creative_body_language = features.text_language
+            if text and ad_creative_body_language is None:
+                logging.info('Unable to determine language of ad creative body from %s',
+                             archive_id)
 
             unique_constraint_attrs = AdCreativeRecordUniqueConstraintAttributes(
                 archive_id=archive_id, text_sha256_hash=text_sha256_hash,
@@ -586,8 +941,8 @@ class FacebookAdCreativeRetriever:
 def main(argv):
     config = fbactiveads_config.load_config(argv[0])
 
-    # Force consistent langdetect results. https://pypi.org/project/langdetect/
-    DetectorFactory.seed = 0
+    # Force consistent langdetect results when features are computed inline.
+    ad_creative_features.init_worker()
 
     commit_to_db_every_n_processed = config.getint('LIMITS', 'BATCH_SIZE',
                                                    fallback=DEFAULT_BATCH_SIZE)
@@ -596,22 +951,31 @@ def main(argv):
     slack_user_id_to_include = config.get('LOGGING', 'SLACK_USER_ID_TO_INCLUDE', fallback=None)
     max_video_download_size = config.getint('LIMITS', 'max_video_download_size',
                                             fallback=DEFAULT_MAX_VIDEO_DOWNLOAD_SIZE)
+    num_creative_feature_workers = config.getint(
+        'LIMITS', 'NUM_CREATIVE_FEATURE_WORKERS', fallback=DEFAULT_NUM_CREATIVE_FEATURE_WORKERS)
+    max_upload_workers = config.getint('LIMITS', 'MAX_UPLOAD_WORKERS',
+                                       fallback=blob_uploader.DEFAULT_MAX_UPLOAD_WORKERS)
+    max_pending_upload_bytes = config.getint(
+        'LIMITS', 'MAX_PENDING_UPLOAD_BYTES', fallback=blob_uploader.DEFAULT_MAX_PENDING_BYTES)
+    num_browsers = config.getint('LIMITS', 'NUM_BROWSERS', fallback=DEFAULT_NUM_BROWSERS)
+    fetch_batch_lease_duration = datetime.timedelta(minutes=config.getint(
+        'LIMITS', 'FETCH_BATCH_LEASE_MINUTES', fallback=DEFAULT_FETCH_BATCH_LEASE_MINUTES))
 
     database_connection_params = config_utils.get_database_connection_params_from_config(config)
     creative_retriever_factory = ad_creative_retriever.FacebookAdCreativeRetrieverFactory(config)
     browser_context_factory = browser_context.DockerSeleniumBrowserContextFactory(config)
 
-    ad_creative_images_bucket_client = make_gcs_bucket_client(AD_CREATIVE_IMAGES_BUCKET,
-                                                              GCS_CREDENTIALS_FILE)
-    ad_creative_video_bucket_client = make_gcs_bucket_client(AD_CREATIVE_VIDEOS_BUCKET,
-                                                             GCS_CREDENTIALS_FILE)
-    archive_screenshots_bucket_client = make_gcs_bucket_client(ARCHIVE_SCREENSHOTS_BUCKET,
-                                                               GCS_CREDENTIALS_FILE)
+    ad_creative_images_bucket_client = make_bucket_client(AD_CREATIVE_IMAGES_BUCKET, config)
+    ad_creative_video_bucket_client = make_bucket_client(AD_CREATIVE_VIDEOS_BUCKET, config)
+    archive_screenshots_bucket_client = make_bucket_client(ARCHIVE_SCREENSHOTS_BUCKET, config)
     image_retriever = FacebookAdCreativeRetriever(
         database_connection_params, creative_retriever_factory, browser_context_factory,
         ad_creative_images_bucket_client, ad_creative_video_bucket_client,
         archive_screenshots_bucket_client, commit_to_db_every_n_processed, slack_url,
-        slack_user_id_to_include, max_video_download_size=max_video_download_size)
+        slack_user_id_to_include, max_video_download_size=max_video_download_size,
+        num_creative_feature_workers=num_creative_feature_workers,
+        max_upload_workers=max_upload_workers, max_pending_upload_bytes=max_pending_upload_bytes,
+        num_browsers=num_browsers, fetch_batch_lease_duration=fetch_batch_lease_duration)
     try:
         image_retriever.retreive_and_store_ad_creatives()
     except KeyboardInterrupt:
@@ -626,6 +990,8 @@ def main(argv):
         send_slack_message(slack_url, slack_msg,
                            slack_user_id_to_include=slack_user_id_to_include)
         raise
+    finally:
+        image_retriever.shutdown()
 
 
 if __name__ == '__main__':
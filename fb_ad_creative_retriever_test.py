@@ -2,8 +2,11 @@
 facebook's ad archive to confirm that changes to that page's structure does not break collection.
 """
 
+import collections
+import contextlib
 import logging
 import sys
+import threading
 import time
 import unittest
 import unittest.mock
@@ -529,5 +532,110 @@ class FacebookAdCreativeRetrieverTest(unittest.TestCase):
         self.assertCreativeImagesUploaded(ad_creative_records)
 
 
+StubScreenshotAndCreatives = collections.namedtuple('StubScreenshotAndCreatives',
+                                                    ['screenshot_binary_data', 'creatives'])
+
+
+class StubCreativeRetriever:
+    """Retrieves snapshots without creatives after a delay, recording calls in retrieval_log."""
+
+    def __init__(self, retrieval_log, retrieval_seconds, raise_for_archive_ids):
+        self.retrieval_log = retrieval_log
+        self.retrieval_seconds = retrieval_seconds
+        self.raise_for_archive_ids = raise_for_archive_ids
+        self.in_use = threading.Lock()
+
+    def retrieve_ad(self, archive_id):
+        if not self.in_use.acquire(blocking=False):
+            raise AssertionError('Creative retriever used by more than one thread at a time.')
+        try:
+            self.retrieval_log.append((int(archive_id), self))
+            if int(archive_id) in self.raise_for_archive_ids:
+                raise ad_creative_retriever.TooManyRequestsError()
+            time.sleep(self.retrieval_seconds(int(archive_id)))
+            return StubScreenshotAndCreatives(screenshot_binary_data=None, creatives=[])
+        finally:
+            self.in_use.release()
+
+
+class StubCreativeRetrieverFactory:
+
+    def __init__(self, retrieval_seconds, raise_for_archive_ids=()):
+        self.retrieval_log = []
+        self.retrieval_seconds = retrieval_seconds
+        self.raise_for_archive_ids = raise_for_archive_ids
+
+    def build(self, chrome_driver):
+        return StubCreativeRetriever(self.retrieval_log, self.retrieval_seconds,
+                                     self.raise_for_archive_ids)
+
+
+class StubBrowserContextFactory:
+
+    def web_browser(self):
+        return contextlib.nullcontext()
+
+
+class BrowserPoolTest(unittest.TestCase):
+    """Tests of concurrent snapshot retrieval with stub creative retrievers (no browsers)."""
+
+    NUM_BROWSERS = 3
+
+    def make_retriever(self, creative_retriever_factory):
+        retriever = fb_ad_creative_retriever.FacebookAdCreativeRetriever(
+            database_connection_params=None, creative_retriever_factory=creative_retriever_factory,
+            browser_context_factory=StubBrowserContextFactory(),
+            ad_creative_images_bucket_client=unittest.mock.Mock(),
+            ad_creative_videos_bucket_client=unittest.mock.Mock(),
+            archive_screenshots_bucket_client=unittest.mock.Mock(),
+            commit_to_db_every_n_processed=None, slack_url=None, slack_user_id_to_include=None,
+            num_browsers=self.NUM_BROWSERS)
+        self.addCleanup(retriever.shutdown)
+        retriever.reset_creative_retriever()
+        return retriever
+
+    def process_archive_ids(self, retriever, archive_ids):
+        db_interface = unittest.mock.Mock()
+        with unittest.mock.patch('db_functions.db_interface_context',
+                                 return_value=contextlib.nullcontext(db_interface)):
+            retriever.process_archive_ids(archive_ids)
+        return db_interface
+
+    def testArchiveIdsDispatchedToAllBrowsersAndHandledInOrder(self):
+        archive_ids = list(range(12))
+        # Earlier archive IDs take longer, so retrievals complete out of order.
+        creative_retriever_factory = StubCreativeRetrieverFactory(
+            lambda archive_id: 0.01 * (len(archive_ids) - archive_id))
+        retriever = self.make_retriever(creative_retriever_factory)
+
+        db_interface = self.process_archive_ids(retriever, archive_ids)
+
+        retrieval_log = creative_retriever_factory.retrieval_log
+        self.assertCountEqual([archive_id for archive_id, _ in retrieval_log], archive_ids)
+        self.assertEqual(len({creative_retriever for _, creative_retriever in retrieval_log}),
+                         self.NUM_BROWSERS)
+        (snapshot_metadata_records,), _ = db_interface.update_ad_snapshot_metadata.call_args
+        self.assertEqual([record.archive_id for record in snapshot_metadata_records],
+                         archive_ids)
+        self.assertEqual(retriever.idle_browser_workers.qsize(), self.NUM_BROWSERS)
+
+    def testRetrievalErrorCancelsUndispatchedArchiveIds(self):
+        archive_ids = list(range(30))
+        creative_retriever_factory = StubCreativeRetrieverFactory(
+            lambda archive_id: 0.05, raise_for_archive_ids={0})
+        retriever = self.make_retriever(creative_retriever_factory)
+
+        with self.assertRaises(ad_creative_retriever.TooManyRequestsError):
+            self.process_archive_ids(retriever, archive_ids)
+
+        # Only retrievals already dispatched to a browser when the error was raised run, and they
+        # finish before process_archive_ids returns.
+        num_retrieved = len(creative_retriever_factory.retrieval_log)
+        self.assertLess(num_retrieved, 2 * self.NUM_BROWSERS)
+        time.sleep(0.2)
+        self.assertEqual(len(creative_retriever_factory.retrieval_log), num_retrieved)
+        self.assertEqual(retriever.idle_browser_workers.qsize(), self.NUM_BROWSERS)
+
+
 if __name__ == '__main__':
     unittest.main()
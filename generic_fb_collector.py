@@ -1,27 +1,54 @@
 import csv
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import operator
+import queue
+import re
 import sys
+import threading
 import time
 from collections import defaultdict, namedtuple
 from time import sleep
-from urllib.parse import parse_qs, urlparse
 
 import facebook
 import psycopg2
 import psycopg2.extras
 from OpenSSL import SSL
 
+from archive_id_index import ArchiveIdIndex
 import db_functions
+import rate_limiter
+import raw_results_archive as raw_results_archive_writer
+import results_page_parser
 from slack_notifier import notify_slack
 import config_utils
+import graph_api_client
 
 DEFAULT_MINIMUM_EXPECTED_NEW_ADS = 10000
 DEFAULT_MINIMUM_EXPECTED_NEW_IMPRESSIONS = 10000
 BAD_PAGE_ID = 0
 DATETIME_MIN_UTC = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+# API result datetime formats, ie 2020-10-01T12:34:56+0000 and 2020-10-01.
+_API_DATETIME_RE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})([+-])(\d{2})(\d{2})', re.ASCII)
+_API_DATE_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})', re.ASCII)
+DATETIME_PARSE_CACHE_SIZE = 4096
+# State refreshes re-read rows modified this long before the previous refresh so that rows from
+# transactions that were in flight during the previous refresh are not missed.
+STATE_REFRESH_OVERLAP = datetime.timedelta(minutes=10)
+# Sentinel put on results queue by fetcher thread when there are no more results.
+_END_OF_RESULTS = object()
+# ads_archive search_page_ids accepts at most this many page IDs.
+MAX_PAGE_IDS_PER_REQUEST = 10
+# Checkpointing requires the crawl_checkpoints table, so it is disabled unless configured.
+DEFAULT_CHECKPOINT_MAX_AGE_HOURS = 0
+DEFAULT_INCREMENTAL_OVERLAP_DAYS = 2
+DEFAULT_REPLAY_PAGES_PER_BATCH = 20
+# Earliest delivery date of ads in the ads_archive.
+ARCHIVE_START_DATE = datetime.date(2018, 5, 7)
 
 #data structures to hold new ads
 AdRecord = namedtuple(
@@ -85,7 +112,20 @@ SearchRunnerParams = namedtuple(
          'request_limit',
          'max_requests',
          'stop_at_datetime',
-         ])
+         'use_bulk_writes',
+         'pipeline_queue_size',
+         'rate_limiter',
+         'graph_api_pool_size',
+         'graph_api_max_retries',
+         'checkpoint_max_age',
+         'incremental_overlap',
+         'raw_results_archive',
+         ],
+        defaults=[False, 0, None, graph_api_client.DEFAULT_POOL_SIZE,
+                  graph_api_client.DEFAULT_MAX_RETRIES, None, None, None])
+
+
+SearchStats = namedtuple('SearchStats', ['num_requests', 'num_ads', 'seconds'])
 
 
 FIELDS_TO_REQUEST = [
@@ -121,6 +161,33 @@ def get_int_with_default(val, default):
         pass
     return default
 
+def _parse_api_result_datetime_fast(datetime_str):
+    """Parse datetime in exact formats returned by the API (ie 2020-10-01T12:34:56+0000 or
+    2020-10-01) without strptime.
+
+    Returns:
+        timezone aware datetime.datetime, or None if datetime_str is not in one of those formats.
+    """
+    match = _API_DATETIME_RE.fullmatch(datetime_str)
+    if match:
+        year, month, day, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+        utc_offset_minutes = int(offset_hours) * 60 + int(offset_minutes)
+        if utc_offset_minutes:
+            if sign == '-':
+                utc_offset_minutes = -utc_offset_minutes
+            tzinfo = datetime.timezone(datetime.timedelta(minutes=utc_offset_minutes))
+        else:
+            tzinfo = datetime.timezone.utc
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute),
+                                 int(second), tzinfo=tzinfo)
+    match = _API_DATE_RE.fullmatch(datetime_str)
+    if match:
+        year, month, day = match.groups()
+        return datetime.datetime(int(year), int(month), int(day), tzinfo=datetime.timezone.utc)
+    return None
+
+# Many ads in a results page share creation and delivery start times, so parsed values are cached.
+@functools.lru_cache(maxsize=DATETIME_PARSE_CACHE_SIZE)
 def parse_api_result_datetime(datetime_str):
     """Parse datetime from API result field. Attempts to parse first as datetime, then date. If
     parsing fails returns datetime.datetime.min with timezon UTC.
@@ -131,6 +198,14 @@ def parse_api_result_datetime(datetime_str):
         datetime.datetime parsed from arg. If parsing fails returns datetime.datetime.min with
         timezon UTC.
     """
+    try:
+        parsed_datetime = _parse_api_result_datetime_fast(datetime_str)
+        if parsed_datetime:
+            return parsed_datetime
+    except ValueError:
+        # Out of range field values. Fall through to strptime so errors are handled the same way.
+        pass
+
     try:
         parsed_datetime = datetime.datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%S%z')
         return parsed_datetime
@@ -165,6 +240,58 @@ def parse_api_result_datetime_with_fallback_to_input(datetime_str):
 
     return parsed_result
 
+def get_checkpoint_query(page_id=None, page_name=None, ad_delivery_date_min=None,
+                         ad_delivery_date_max=None):
+    """Get str identifying an ads_archive search for crawl checkpoints."""
+    if page_name is not None:
+        query = 'search_terms:%s' % page_name
+    else:
+        query = 'search_page_ids:%s' % page_id
+    if ad_delivery_date_min:
+        query += ' ad_delivery_date_min:%s' % ad_delivery_date_min.isoformat()
+    if ad_delivery_date_max:
+        query += ' ad_delivery_date_max:%s' % ad_delivery_date_max.isoformat()
+    return query
+
+def get_page_ids_crawl_query(page_ids):
+    """Get str identifying a crawl of page_ids for completed crawl markers. Page IDs are
+    identified by a hash, since a crawl can search thousands of them."""
+    page_ids_hash = hashlib.sha256(
+        ','.join(sorted(str(page_id) for page_id in page_ids)).encode()).hexdigest()
+    return 'search_page_ids_sha256:%s' % page_ids_hash
+
+def get_date_windows(start_date, end_date, num_windows):
+    """Split start_date to end_date (inclusive) into up to num_windows contiguous, non-overlapping
+    date windows of (nearly) equal length.
+
+    Returns:
+        list of (datetime.date window start, datetime.date window end) tuples, both inclusive.
+    """
+    num_days = (end_date - start_date).days + 1
+    num_windows = max(1, min(num_windows, num_days))
+    windows = []
+    window_start = start_date
+    for i in range(1, num_windows + 1):
+        window_end = start_date + datetime.timedelta(days=num_days * i // num_windows - 1)
+        windows.append((window_start, window_end))
+        window_start = window_end + datetime.timedelta(days=1)
+    return windows
+
+def get_incremental_ad_delivery_date_min(last_completed_crawl_date, overlap):
+    """Get earliest delivery date of ads that may be new or changed since the previous crawl.
+
+    Args:
+        last_completed_crawl_date: datetime.date previous completed crawl finished, or None.
+        overlap: datetime.timedelta subtracted from last_completed_crawl_date to pick up ads that
+            were delivered while the previous crawl ran, appeared in the archive late, or changed
+            after the previous crawl. Should exceed crawl duration.
+    Returns:
+        datetime.date, or None if there are no previous completed crawls.
+    """
+    if last_completed_crawl_date is None:
+        return None
+    return last_completed_crawl_date - overlap
+
 class SearchRunner():
 
     def __init__(self, crawl_date, database_connection_params, search_runner_params):
@@ -175,18 +302,52 @@ class SearchRunner():
         self.sleep_time = search_runner_params.sleep_time
         self.request_limit = search_runner_params.request_limit
         self.max_requests = search_runner_params.max_requests
+        self.use_bulk_writes = search_runner_params.use_bulk_writes
+        # Max number of results pages buffered between fetcher and writer. 0 disables pipelining.
+        self.pipeline_queue_size = search_runner_params.pipeline_queue_size
+        # Optional rate_limiter.AdaptiveRateController shared by all fetchers. If set it replaces
+        # sleeping sleep_time after every request.
+        self.rate_limiter = search_runner_params.rate_limiter
+        # Shared by all fetchers, and kept across errors so connections are reused.
+        self.graph = graph_api_client.make_graph_api(
+            self.fb_access_token, rate_limiter=self.rate_limiter,
+            pool_size=search_runner_params.graph_api_pool_size,
+            max_retries=search_runner_params.graph_api_max_retries)
+        # datetime.timedelta max age of crawl checkpoints to resume from. None disables
+        # checkpointing.
+        self.checkpoint_max_age = search_runner_params.checkpoint_max_age
+        # dict of query -> db_functions.CrawlCheckpoint loaded at start of search.
+        self.checkpoints = dict()
+        # datetime.timedelta, if set only ads delivered since the last completed crawl minus this
+        # overlap are requested. None crawls all ads.
+        self.incremental_overlap = search_runner_params.incremental_overlap
+        # datetime.date passed as ad_delivery_date_min, set by load_state in incremental mode.
+        self.ad_delivery_date_min = None
+        # str identifying the ads of the current crawl (see record_completed_crawl), or None.
+        self.crawl_query = None
+        # Queries of searches paged through to the end in the current crawl.
+        self.completed_search_queries = set()
+        # dict of query -> datetime.date window_start of date window searches of the current crawl
+        # (see run_date_window_search).
+        self.date_window_starts = dict()
+        # Optional raw_results_archive.RawResultsArchiveWriter every fetched results page is
+        # appended to.
+        self.raw_results_archive = search_runner_params.raw_results_archive
         self.new_ads = set()
         self.new_funding_entities = set()
         self.new_pages = set()
         self.new_page_record_to_max_last_seen_time = dict()
         self.new_regions = set()
-        self.new_impressions = set()
+        self.new_impressions = dict()
         self.new_ad_region_impressions = list()
         self.new_ad_demo_impressions = list()
         self.existing_page_ids = set()
         self.existing_page_record_to_max_last_seen_time = dict()
-        self.existing_funding_entities = set()
-        self.existing_ads_to_end_time_map = dict()
+        self.existing_funding_entities = dict()
+        # DB timestamp of last refresh_state. None until caches are populated.
+        self.state_watermark = None
+        # Built once per process on first search, then kept up to date as new ads are processed.
+        self.existing_archive_ids = None
         self.total_ads_added_to_db = 0
         self.total_impressions_added_to_db = 0
         self.graph_error_counts = defaultdict(int)
@@ -203,8 +364,7 @@ class SearchRunner():
         return self.total_impressions_added_to_db
 
     def get_ad_from_result(self, result):
-        url_parts = urlparse(result['ad_snapshot_url'])
-        archive_id = int(parse_qs(url_parts.query)['id'][0])
+        archive_id = results_page_parser.archive_id_from_snapshot_url(result['ad_snapshot_url'])
         ad_status = 1
         if  'ad_delivery_stop_time' in result:
             ad_status = 0
@@ -303,100 +463,395 @@ class SearchRunner():
 
 
     def process_ad(self, ad):
-        if ad.archive_id not in self.existing_ads_to_end_time_map:
+        if ad.archive_id not in self.existing_archive_ids:
             self.new_ads.add(ad)
-            self.existing_ads_to_end_time_map[ad.archive_id] = ad.ad_delivery_stop_time
+            self.existing_archive_ids.add(ad.archive_id)
 
     def process_impressions(self, ad):
-        self.new_impressions.add(ad)
+        self.new_impressions[ad.archive_id] = ad
 
-    def process_demo_impressions(self, demographic_distribution, curr_ad):
-        if not demographic_distribution:
-            logging.info("no demo impression information for: %s", curr_ad.archive_id)
+    def process_demo_impressions(self, ads, results):
+        """Add demographic DistributionColumns of ads (parsed from results in same order)."""
+        self.new_ad_demo_impressions.append(
+            results_page_parser.parse_demographic_distributions(ads, results))
 
-        for demo_result in demographic_distribution:
-            try:
-                self.new_ad_demo_impressions.append(SnapshotDemoRecord(
-                    curr_ad.archive_id,
-                    demo_result['age'],
-                    demo_result['gender'],
-                    demo_result['percentage'],
-                    float(demo_result['percentage']) * int(curr_ad.impressions__lower_bound),
-                    float(demo_result['percentage']) * int(curr_ad.impressions__upper_bound),
-                    float(demo_result['percentage']) * int(curr_ad.spend__lower_bound),
-                    float(demo_result['percentage']) * int(curr_ad.spend__upper_bound)))
-            except KeyError as key_error:
-                logging.warning(
-                        '%s error while processing ad archive ID %s demographic_distribution: %s',
-                        key_error, curr_ad.archive_id, demo_result)
-
-    def process_region_impressions(self, region_distribution, curr_ad):
-        if not region_distribution:
-            logging.info("no region impression information for: %s", curr_ad.archive_id)
-
-        regions = set()
-        for region_result in region_distribution:
-            # If we get the same region more than once for an ad, the second occurance
-            # This is a data losing proposition but can't be helped till FB fixes the results
-            # They provide on the API
-            try:
-                if region_result['region'] in regions:
-                    continue
-                else:
-                    regions.add(region_result['region'])
-                    self.new_ad_region_impressions.append(SnapshotRegionRecord(
-                    curr_ad.archive_id,
-                    region_result['region'],
-                    region_result['percentage'],
-                    float(region_result['percentage']) * int(curr_ad.impressions__lower_bound),
-                    float(region_result['percentage']) * int(curr_ad.impressions__upper_bound),
-                    float(region_result['percentage']) * int(curr_ad.spend__lower_bound),
-                    float(region_result['percentage']) * int(curr_ad.spend__upper_bound)))
-            except KeyError as key_error:
-                logging.warning(
-                        '%s error while processing ad archive ID %s region_distribution: %s',
-                        key_error, curr_ad.archive_id, region_result)
+    def process_region_impressions(self, ads, results):
+        """Add region DistributionColumns of ads (parsed from results in same order)."""
+        self.new_ad_region_impressions.append(
+            results_page_parser.parse_region_distributions(ads, results))
 
+    def load_state(self, crawl_query=None):
+        """Load caches and crawl checkpoints before a crawl.
+
+        Args:
+            crawl_query: str identifying the ads crawled, regardless of delivery dates (ie
+                get_checkpoint_query without dates, or get_page_ids_crawl_query). In incremental
+                mode only ads delivered since the previous completed crawl with the same
+                crawl_query are requested. None crawls all dates.
+        """
+        self.completed_search_queries = set()
+        self.date_window_starts = dict()
+        self.crawl_query = crawl_query
+        #cache of ads/pages/regions/demo_groups we've already seen so we don't reinsert them
+        with db_functions.db_interface_context(self.database_connection_params) as db_interface:
+            if self.existing_archive_ids is None:
+                self.existing_archive_ids = ArchiveIdIndex.from_sorted_ids(
+                    db_interface.stream_archive_ids())
+            if self.checkpoint_max_age is not None:
+                self.checkpoints = db_interface.crawl_checkpoints(self.country_code,
+                                                                  self.checkpoint_max_age)
+                logging.info('Loaded %d resumable crawl checkpoints.', len(self.checkpoints))
+            self.ad_delivery_date_min = None
+            if self.incremental_overlap is not None and crawl_query is not None:
+                self.ad_delivery_date_min = get_incremental_ad_delivery_date_min(
+                    db_interface.last_completed_crawl_date(self.country_code, crawl_query),
+                    self.incremental_overlap)
+                logging.info('Incremental crawl of ads delivered since %s.',
+                             self.ad_delivery_date_min or 'the beginning (no previous crawl)')
+        self.refresh_state()
 
     def run_search(self, page_id=None, page_name=None):
         self.crawl_date = datetime.date.today()
 
-        #cache of ads/pages/regions/demo_groups we've already seen so we don't reinsert them
+        self.load_state(crawl_query=get_checkpoint_query(page_id=page_id, page_name=page_name))
+
+        logging.info(datetime.datetime.now())
+        logging.info("page_id = %s", page_id)
+        logging.info("page_name = %s", page_name)
+        if self.pipeline_queue_size:
+            # Fetch results pages on a background thread while this thread parses and writes them,
+            # so that rate limit sleeps overlap with DB writes.
+            self.run_concurrent_searches([{'page_id': page_id, 'page_name': page_name}],
+                                         num_workers=1)
+        else:
+            for results, checkpoint in self.fetch_results_pages(page_id=page_id,
+                                                                page_name=page_name):
+                self.process_results_pages([results], checkpoints=[checkpoint])
+
+        self.record_completed_crawl([{'page_id': page_id, 'page_name': page_name}])
+        self.perfrom_post_collection_actions()
+
+    def run_page_id_search(self, page_ids, num_workers=1,
+                           page_ids_per_request=MAX_PAGE_IDS_PER_REQUEST):
+        """Search for ads from page_ids with num_workers concurrent fetchers.
+
+        Page IDs are searched in groups of up to page_ids_per_request per request.
+
+        Args:
+            page_ids: list of page IDs in order they should be searched.
+            num_workers: int number of concurrent fetcher threads.
+            page_ids_per_request: int max number of page IDs per API request.
+        """
+        searches = [
+            {'page_id': ','.join(str(page_id) for page_id in page_ids[i:i + page_ids_per_request])}
+            for i in range(0, len(page_ids), page_ids_per_request)]
+        logging.info('Searching %d page IDs in %d groups with %d workers.', len(page_ids),
+                     len(searches), num_workers)
+        self.crawl_date = datetime.date.today()
+        self.load_state(crawl_query=get_page_ids_crawl_query(page_ids))
+        self.run_concurrent_searches(searches, num_workers=num_workers)
+        self.record_completed_crawl(searches)
+        self.perfrom_post_collection_actions()
+
+    def run_date_window_search(self, page_name, num_windows, num_workers=1, start_date=None,
+                               end_date=None):
+        """Search for ads delivered between start_date and end_date, split into num_windows date
+        windows that are each paged through as an independent search by num_workers concurrent
+        fetchers.
+
+        Ads delivered in more than one window are returned by each of them, but only written once.
+        Windows are recorded in the crawl_date_windows table, and completed windows are not
+        crawled again until all windows of the crawl have completed. An interrupted crawl resumes
+        with the windows it started with (regardless of start_date, end_date, and num_windows), and
+        interrupted windows resume from their crawl checkpoint (if enabled).
+
+        Args:
+            page_name: str search terms.
+            num_windows: int number of date windows.
+            num_workers: int number of concurrent fetcher threads.
+            start_date: datetime.date earliest ad delivery date. Defaults to the incremental crawl
+                start date, or ARCHIVE_START_DATE.
+            end_date: datetime.date latest ad delivery date. Defaults to none, ie the latest
+                window is open-ended and crawled by every run of the crawl.
+        """
+        self.crawl_date = datetime.date.today()
+        # Same crawl query as run_search of page_name, since both crawl all ads of page_name.
+        self.load_state(crawl_query=get_checkpoint_query(page_name=page_name))
+        with db_functions.db_interface_context(self.database_connection_params) as db_interface:
+            date_windows = db_interface.uncompleted_crawl_date_windows(self.country_code,
+                                                                       self.crawl_query)
+            if date_windows:
+                logging.info('Resuming date windowed crawl with %d uncompleted windows.',
+                             len(date_windows))
+            else:
+                start_date = start_date or self.ad_delivery_date_min or ARCHIVE_START_DATE
+                date_windows = [
+                    db_functions.CrawlDateWindow(window_start, window_end) for window_start,
+                    window_end in get_date_windows(start_date, end_date or self.crawl_date,
+                                                   num_windows)]
+                if end_date is None:
+                    date_windows[-1] = date_windows[-1]._replace(window_end=None)
+                db_interface.replace_crawl_date_windows(self.country_code, self.crawl_query,
+                                                        date_windows)
+        searches = [{'page_name': page_name, 'ad_delivery_date_min': window.window_start,
+                     'ad_delivery_date_max': window.window_end} for window in date_windows]
+        self.date_window_starts = {self.get_search_query(**search): search['ad_delivery_date_min']
+                                   for search in searches}
+        logging.info('Searching from %s in %d date windows with %d workers.',
+                     date_windows[0].window_start, len(searches), num_workers)
+        self.run_concurrent_searches(searches, num_workers=num_workers)
+        self.record_completed_crawl(searches)
+        self.perfrom_post_collection_actions()
+
+    def run_concurrent_searches(self, searches, num_workers=1):
+        """Run searches with num_workers concurrent fetchers.
+
+        Fetchers push results pages to a shared bounded queue. This thread drains all pages
+        available in the queue and writes them as one batch. All fetchers share self.rate_limiter
+        (if set).
+
+        Args:
+            searches: list of dict of fetch_results_pages keyword args, in order they should be
+                searched.
+            num_workers: int number of concurrent fetcher threads.
+        """
+        pending_searches = queue.Queue()
+        for search in searches:
+            pending_searches.put(search)
+        results_queue = queue.Queue(maxsize=max(self.pipeline_queue_size, num_workers))
+        stop_fetching = threading.Event()
+        fetch_errors = []
+        search_stats = {}
+
+        def put_until_stopped(item):
+            while not stop_fetching.is_set():
+                try:
+                    results_queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def fetch_searches_to_queue():
+            try:
+                while not stop_fetching.is_set():
+                    try:
+                        search = pending_searches.get_nowait()
+                    except queue.Empty:
+                        return
+                    start_time = time.monotonic()
+                    num_requests = 0
+                    num_ads = 0
+                    for results, checkpoint in self.fetch_results_pages(
+                            stop_event=stop_fetching, **search):
+                        num_requests += 1
+                        num_ads += len(results['data'])
+                        put_until_stopped((results, checkpoint))
+                    search_stats[self.get_search_query(**search)] = SearchStats(
+                        num_requests=num_requests, num_ads=num_ads,
+                        seconds=time.monotonic() - start_time)
+            except BaseException as error:
+                fetch_errors.append(error)
+            finally:
+                put_until_stopped(_END_OF_RESULTS)
+
+        fetchers = [threading.Thread(target=fetch_searches_to_queue,
+                                     name='ads_archive_fetcher_%d' % i, daemon=True)
+                    for i in range(num_workers)]
+        for fetcher in fetchers:
+            fetcher.start()
+        try:
+            num_fetchers_running = len(fetchers)
+            while num_fetchers_running:
+                results_pages = [results_queue.get()]
+                while True:
+                    try:
+                        results_pages.append(results_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                num_fetchers_finished = sum(1 for results in results_pages
+                                            if results is _END_OF_RESULTS)
+                num_fetchers_running -= num_fetchers_finished
+                results_pages_and_checkpoints = [item for item in results_pages
+                                                 if item is not _END_OF_RESULTS]
+                if results_pages_and_checkpoints:
+                    logging.info('Writing batch of %d results pages. %d pages waiting in queue.',
+                                 len(results_pages_and_checkpoints), results_queue.qsize())
+                    results_pages, checkpoints = zip(*results_pages_and_checkpoints)
+                    self.process_results_pages(results_pages, checkpoints=checkpoints)
+                if fetch_errors:
+                    break
+        finally:
+            stop_fetching.set()
+            for fetcher in fetchers:
+                fetcher.join()
+            self.log_search_stats(search_stats)
+        if fetch_errors:
+            raise fetch_errors[0]
+
+    def record_completed_crawl(self, searches):
+        """In incremental mode, record that the crawl completed if all searches were paged through
+        to the end (ie not stopped by max_requests or STOP_AT_CLOCK_TIME), so the next incremental
+        crawl of the same crawl_query (see load_state) only requests ads delivered since.
+
+        Args:
+            searches: list of dict of fetch_results_pages keyword args of the crawl.
+        """
+        if self.incremental_overlap is None or self.crawl_query is None:
+            return
+        num_incomplete_searches = sum(
+            1 for search in searches
+            if self.get_search_query(**search) not in self.completed_search_queries)
+        if num_incomplete_searches:
+            logging.info('Crawl not recorded as completed. %d of %d searches incomplete.',
+                         num_incomplete_searches, len(searches))
+            return
         with db_functions.db_interface_context(self.database_connection_params) as db_interface:
-            self.existing_ads_to_end_time_map = db_interface.existing_ads()
-            self.existing_page_ids = db_interface.existing_pages()
-            self.existing_page_record_to_max_last_seen_time = (
-                db_interface.page_records_to_max_last_seen())
-            self.existing_funding_entities = db_interface.existing_funding_entities()
+            db_interface.record_completed_crawl(self.country_code, self.crawl_query)
+
+    def log_search_stats(self, search_stats):
+        for query, stats in search_stats.items():
+            logging.info(
+                '%s: %d ads in %d requests over %.1f seconds (%.2f ads/second)',
+                query, stats.num_ads, stats.num_requests, stats.seconds,
+                stats.num_ads / (stats.seconds or 1))
+
+    def replay_raw_results(self, records, pages_per_batch=DEFAULT_REPLAY_PAGES_PER_BATCH):
+        """Parse and write archived API results pages without making any API requests.
+
+        Args:
+            records: iterable of raw_results_archive records (ie from
+                raw_results_archive.read_records).
+            pages_per_batch: int max number of results pages written per transaction.
+        """
+        self.load_state()
+        results_pages = []
+        num_pages = 0
+        start_time = time.monotonic()
+        for record in records:
+            crawl_date = datetime.date.fromisoformat(record['crawl_date'])
+            # Ads first seen in a page are recorded with the crawl date of that page.
+            if results_pages and crawl_date != self.crawl_date:
+                self.process_results_pages(results_pages)
+                results_pages = []
+            self.crawl_date = crawl_date
+            results_pages.append(record['results'])
+            num_pages += 1
+            if len(results_pages) >= pages_per_batch:
+                self.process_results_pages(results_pages)
+                results_pages = []
+        if results_pages:
+            self.process_results_pages(results_pages)
+        seconds = time.monotonic() - start_time
+        logging.info('Replayed %d results pages in %.1f seconds (%.1f pages/second).', num_pages,
+                     seconds, num_pages / (seconds or 1))
+
+        self.perfrom_post_collection_actions()
+
+    def reset_new_records(self):
+        #structures to hold all the new stuff we find
+        self.new_ads = set()
+        self.new_ad_sponsors = set()
+        self.new_funding_entities = set()
+        self.new_regions = set()
+        # Impressions are keyed by archive_id, so an ad returned by several searches in one batch
+        # (ie overlapping date windows) is only written once, with the row from the latest results
+        # page. ON CONFLICT DO UPDATE cannot affect the same row twice in one statement.
+        self.new_impressions = dict()
+        # Lists of results_page_parser.DistributionColumns of each results page, in order. Their
+        # writers keep the latest of duplicate rows.
+        self.new_ad_region_impressions = list()
+        self.new_ad_demo_impressions = list()
+        self.new_pages = set()
+        self.new_page_record_to_max_last_seen_time = dict()
+
+    def process_results_pages(self, results_pages, checkpoints=()):
+        """Parse ads from API results pages, write them to DB, and refresh cached state.
+
+        Args:
+            results_pages: iterable of dict API results pages.
+            checkpoints: iterable of db_functions.CrawlCheckpoint after each results page, written
+                in the same transaction as the results.
+        """
+        self.reset_new_records()
+        for results in results_pages:
+            ads = [self.get_ad_from_result(result) for result in results['data']]
+            for curr_ad in ads:
+                self.process_ad(curr_ad)
+                self.process_funding_entity(curr_ad)
+                self.process_page(curr_ad)
 
+                # Update impressions
+                self.process_impressions(curr_ad)
+            self.process_demo_impressions(ads, results['data'])
+            self.process_region_impressions(ads, results['data'])
+
+        #we finished parsing all ads in the result
+        self.write_results(checkpoints)
+        self.refresh_state()
+
+    def get_search_query(self, page_id=None, page_name=None, ad_delivery_date_min=None,
+                         ad_delivery_date_max=None):
+        """Get checkpoint query of search. ad_delivery_date_min defaults to the incremental crawl
+        start date."""
+        return get_checkpoint_query(
+            page_id=page_id, page_name=page_name,
+            ad_delivery_date_min=ad_delivery_date_min or self.ad_delivery_date_min,
+            ad_delivery_date_max=ad_delivery_date_max)
+
+    def fetch_results_pages(self, page_id=None, page_name=None, stop_event=None,
+                            ad_delivery_date_min=None, ad_delivery_date_max=None):
+        """Generator yielding ads_archive API results pages for the page_id or page_name search.
+
+        Handles retries and sleeping between requests.
+
+        Args:
+            page_id: page ID to search for. Ignored if page_name is provided.
+            page_name: str search terms.
+            stop_event: threading.Event, if provided fetching stops when it is set.
+            ad_delivery_date_min: datetime.date, only ads delivered on or after this date are
+                returned. Defaults to the incremental crawl start date (if any).
+            ad_delivery_date_max: datetime.date, only ads delivered on or before this date are
+                returned.
+        Yields:
+            tuple of (dict of API results page, db_functions.CrawlCheckpoint after that page).
+        """
         #get ads
-        graph = facebook.GraphAPI(access_token=self.fb_access_token, version='7.0')
+        graph = self.graph
         has_next = True
         next_cursor = ""
         backoff_multiplier = 1
-        logging.info(datetime.datetime.now())
-        logging.info("page_id = %s", page_id)
-        logging.info("page_name = %s", page_name)
+        # Requests made by this search since it started, including by runs it was resumed from.
+        # Stored in checkpoints.
         request_count = 0
+        # Requests made by this run, limited to max_requests. Kept separate from request_count so
+        # that a search resumed from a checkpoint gets a full request budget.
+        num_requests_this_run = 0
+        ad_delivery_date_min = ad_delivery_date_min or self.ad_delivery_date_min
+        query = get_checkpoint_query(page_id=page_id, page_name=page_name,
+                                     ad_delivery_date_min=ad_delivery_date_min,
+                                     ad_delivery_date_max=ad_delivery_date_max)
+        # Optional search filters.
+        search_filters = dict()
+        if ad_delivery_date_min:
+            search_filters['ad_delivery_date_min'] = ad_delivery_date_min.isoformat()
+        if ad_delivery_date_max:
+            search_filters['ad_delivery_date_max'] = ad_delivery_date_max.isoformat()
+        checkpoint = self.checkpoints.get(query)
+        if checkpoint:
+            logging.info('Resuming %s from request %d.', query, checkpoint.request_count)
+            next_cursor = checkpoint.cursor or ""
+            request_count = checkpoint.request_count
         # TODO: Remove the request_count limit
         #LAE - this is more of a conceptual thing, but perhaps we should be writing to DB more frequently? In cases where we query by the empty string, we are high stakes succeeding or failing.
-        curr_ad = None
-        while (has_next and request_count < self.max_requests and
-               self.allowed_execution_time_remaining()):
-            #structures to hold all the new stuff we find
-            self.new_ads = set()
-            self.new_ad_sponsors = set()
-            self.new_funding_entities = set()
-            self.new_regions = set()
-            self.new_impressions = set()
-            self.new_ad_region_impressions = list()
-            self.new_ad_demo_impressions = list()
-            self.new_pages = set()
-            self.new_page_record_to_max_last_seen_time = dict()
+        while (has_next and num_requests_this_run < self.max_requests and
+               self.allowed_execution_time_remaining() and
+               not (stop_event and stop_event.is_set())):
             request_count += 1
-            total_ad_count = 0
+            num_requests_this_run += 1
             try:
                 results = None
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
                 if page_name is not None:
                     logging.info(f"making search term request for {page_name}")
                     logging.info(f"making request {request_count}")
@@ -408,7 +863,8 @@ class SearchRunner():
                         limit=self.request_limit,
                         search_terms=page_name,
                         fields=",".join(FIELDS_TO_REQUEST),
-                        after=next_cursor)
+                        after=next_cursor,
+                        **search_filters)
                 else:
                     logging.info(f"making page_id request for {page_id}")
                     logging.info(f"making request {request_count}")
@@ -420,8 +876,11 @@ class SearchRunner():
                         limit=self.request_limit,
                         search_page_ids=page_id,
                         fields=",".join(FIELDS_TO_REQUEST),
-                        after=next_cursor)
+                        after=next_cursor,
+                        **search_filters)
                 backoff_multiplier = 1
+                if self.rate_limiter:
+                    self.rate_limiter.on_success()
             except facebook.GraphAPIError as e:
                 logging.error("Graph Error")
                 logging.error(e.code)
@@ -441,15 +900,17 @@ class SearchRunner():
                 # Error 4 is application level throttling
                 # Error 613 is "Custom-level throttling" "Calls to this api have exceeded the rate limit."
                 # https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling/
-                if e.code == 4 or e.code == 613:
+                if e.code in rate_limiter.THROTTLING_ERROR_CODES:
                     backoff_multiplier *= 4
                     logging.info('Rate liimit exceeded, back off multiplier is now %d.',
                                  backoff_multiplier)
+                    if self.rate_limiter:
+                        # Slow down and hold off all workers sharing the rate limiter, not just
+                        # this one.
+                        self.rate_limiter.on_throttle(self.sleep_time * backoff_multiplier)
                 else:
                     backoff_multiplier += 1
 
-                logging.info("resetting graph")
-                graph = facebook.GraphAPI(access_token=self.fb_access_token)
                 continue
 
             except OSError as e:
@@ -457,45 +918,41 @@ class SearchRunner():
                 logging.error(datetime.datetime.now())
                 # Reset backoff multiplier since this is a local OS issue and not an API issue.
                 backoff_multiplier = 1
-                logging.info("resetting graph")
-                graph = facebook.GraphAPI(access_token=self.fb_access_token)
                 continue
 
             except SSL.SysCallError as e:
                 logging.error(e)
                 backoff_multiplier += backoff_multiplier
-                logging.error("resetting graph")
-                graph = facebook.GraphAPI(access_token=self.fb_access_token)
                 continue
 
             finally:
                 sleep_time = self.sleep_time * backoff_multiplier
+                if self.rate_limiter and backoff_multiplier == 1:
+                    # Request rate is governed by the rate limiter, only sleep to back off errors.
+                    sleep_time = 0
                 logging.info(f"waiting for {sleep_time} seconds before next query.")
-                sleep(sleep_time)
-
-            for result in results['data']:
-                total_ad_count += 1
-                curr_ad = self.get_ad_from_result(result)
-                self.process_ad(curr_ad)
-                self.process_funding_entity(curr_ad)
-                self.process_page(curr_ad)
-                self.process_impressions(curr_ad)
-
-                # Update impressions
-                self.process_impressions(curr_ad)
-                self.process_demo_impressions(result.get('demographic_distribution', []), curr_ad)
-                self.process_region_impressions(result.get('region_distribution', []), curr_ad)
+                if stop_event:
+                    stop_event.wait(sleep_time)
+                else:
+                    sleep(sleep_time)
 
-            #we finished parsing all ads in the result
-            self.write_results()
-            self.refresh_state()
+            # Outside of the request error handling above, so that archive write errors (eg disk
+            # full) stop the crawl instead of being retried as request errors.
+            if self.raw_results_archive:
+                self.raw_results_archive.append(query, self.crawl_date, results)
 
             if "paging" in results and "next" in results["paging"]:
                 next_cursor = results["paging"]["cursors"]["after"]
             else:
                 has_next = False
 
-        self.perfrom_post_collection_actions()
+            yield results, db_functions.CrawlCheckpoint(
+                country_code=self.country_code, query=query,
+                cursor=next_cursor if has_next else None, request_count=request_count,
+                completed=not has_next)
+
+        if not has_next:
+            self.completed_search_queries.add(query)
 
 
     def allowed_execution_time_remaining(self):
@@ -510,38 +967,84 @@ class SearchRunner():
         return True
 
 
-    def write_results(self):
+    def write_results(self, checkpoints=()):
         with db_functions.db_interface_context(self.database_connection_params) as db_interface:
             # write new pages, regions, and demo groups to database first so we can update our
             # caches before writing ads
-            db_interface.insert_funding_entities(self.new_funding_entities)
+            self.existing_funding_entities.update(
+                db_interface.insert_funding_entities(self.new_funding_entities))
             db_interface.insert_pages(self.new_pages, self.new_page_record_to_max_last_seen_time)
+            self.merge_page_records_to_max_last_seen(self.new_page_record_to_max_last_seen_time)
+
+            if self.use_bulk_writes:
+                insert_new_ads = db_interface.bulk_insert_new_ads
+                insert_new_impressions = db_interface.bulk_insert_new_impressions
+            else:
+                insert_new_ads = db_interface.insert_new_ads
+                insert_new_impressions = db_interface.insert_new_impressions
 
             #write new ads to our database
             num_new_ads = len(self.new_ads)
             logging.info("writing %d new ads to db", num_new_ads)
-            db_interface.insert_new_ads(self.new_ads)
+            insert_new_ads(self.new_ads)
             self.total_ads_added_to_db += num_new_ads
 
             #write new impressions to our database
             num_new_impressions = len(self.new_impressions)
             logging.info("writing %d impressions to db", num_new_impressions)
-            db_interface.insert_new_impressions(self.new_impressions)
+            insert_new_impressions(self.new_impressions.values())
             self.total_impressions_added_to_db += num_new_impressions
 
-            logging.info("writing self.new_ad_demo_impressions to db")
-            db_interface.insert_new_impression_demos(self.new_ad_demo_impressions)
-
-            logging.info("writing self.new_ad_region_impressions to db")
-            db_interface.insert_new_impression_regions(self.new_ad_region_impressions)
+            # Demo and region rows are always copied straight from their columns to staging
+            # tables.
+            if self.new_ad_demo_impressions:
+                logging.info("writing self.new_ad_demo_impressions to db")
+                db_interface.insert_new_impression_demo_columns(
+                    results_page_parser.concatenate_distribution_columns(
+                        self.new_ad_demo_impressions))
+
+            if self.new_ad_region_impressions:
+                logging.info("writing self.new_ad_region_impressions to db")
+                db_interface.insert_new_impression_region_columns(
+                    results_page_parser.concatenate_distribution_columns(
+                        self.new_ad_region_impressions))
+
+            completed_window_starts = [self.date_window_starts[checkpoint.query]
+                                       for checkpoint in checkpoints
+                                       if checkpoint.completed and
+                                       checkpoint.query in self.date_window_starts]
+            if completed_window_starts:
+                db_interface.mark_crawl_date_windows_completed(
+                    self.country_code, self.crawl_query, completed_window_starts)
+
+            if self.checkpoint_max_age is not None and checkpoints:
+                # Only the latest checkpoint of each query matters.
+                latest_checkpoints = {checkpoint.query: checkpoint for checkpoint in checkpoints}
+                db_interface.upsert_crawl_checkpoints(latest_checkpoints.values())
 
     def refresh_state(self):
+        """Update funder, page, and page name history caches with rows modified (by this or other
+        processes) since the last refresh. The first refresh loads all rows.
+        """
         with db_functions.db_interface_context(self.database_connection_params) as db_interface:
-            # We have to reload these since we rely on the row ids from the database for indexing
-            self.existing_funding_entities = db_interface.existing_funding_entities()
-            self.existing_page_ids = db_interface.existing_pages()
-            self.existing_page_record_to_max_last_seen_time = (
-                db_interface.page_records_to_max_last_seen())
+            refresh_start_time = db_interface.current_timestamp()
+            modified_since = None
+            if self.state_watermark is not None:
+                modified_since = self.state_watermark - STATE_REFRESH_OVERLAP
+            # We rely on the row ids from the database for indexing, so pick up funders added
+            # elsewhere.
+            self.existing_funding_entities.update(
+                db_interface.existing_funding_entities(modified_since=modified_since))
+            self.existing_page_ids.update(db_interface.existing_pages(modified_since=modified_since))
+            self.merge_page_records_to_max_last_seen(
+                db_interface.page_records_to_max_last_seen(modified_since=modified_since))
+            self.state_watermark = refresh_start_time
+
+    def merge_page_records_to_max_last_seen(self, page_record_to_last_seen_time):
+        for page_record, last_seen in page_record_to_last_seen_time.items():
+            existing_last_seen = self.existing_page_record_to_max_last_seen_time.get(page_record)
+            if existing_last_seen is None or existing_last_seen < last_seen:
+                self.existing_page_record_to_max_last_seen_time[page_record] = last_seen
 
     def perfrom_post_collection_actions(self):
         """Do actions after collection loop has terminated. eg cleanup or DB updates that should
@@ -599,10 +1102,11 @@ def get_pages_from_archive(archive_path):
     with open(archive_path) as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
+            num_ads = int(row["Number of Ads in Library"])
             if row["\ufeffPage ID"] in page_ads:
-                page_ads[row["\ufeffPage ID"]] += row["Number of Ads in Library"]
+                page_ads[row["\ufeffPage ID"]] += num_ads
             else:
-                page_ads[row["\ufeffPage ID"]] = row["Number of Ads in Library"]
+                page_ads[row["\ufeffPage ID"]] = num_ads
 
     return page_ads
 
@@ -672,18 +1176,58 @@ def main(config):
         min_expected_new_impressions = DEFAULT_MINIMUM_EXPECTED_NEW_IMPRESSIONS
     logging.info('Expecting minimum %d new impressions.', min_expected_new_impressions)
 
+    num_fetch_workers = config.getint('SEARCH', 'NUM_FETCH_WORKERS', fallback=1)
+    num_date_windows = config.getint('SEARCH', 'NUM_DATE_WINDOWS', fallback=1)
+    sleep_time = config.getint('SEARCH', 'SLEEP_TIME')
+    # Request rate shared by all workers, adapted to API throttling and usage headers.
+    rate_controller = rate_limiter.make_adaptive_rate_controller_from_config(config)
+
+    # Resume interrupted searches from checkpoints saved within this many hours. 0 disables.
+    checkpoint_max_age_hours = config.getfloat('SEARCH', 'CHECKPOINT_MAX_AGE_HOURS',
+                                               fallback=DEFAULT_CHECKPOINT_MAX_AGE_HOURS)
+    checkpoint_max_age = None
+    if checkpoint_max_age_hours:
+        checkpoint_max_age = datetime.timedelta(hours=checkpoint_max_age_hours)
+
+    # Only request ads delivered since the latest collected ads (less overlap) for the country.
+    incremental_overlap = None
+    if config.getboolean('SEARCH', 'INCREMENTAL', fallback=False):
+        incremental_overlap = datetime.timedelta(days=config.getint(
+            'SEARCH', 'INCREMENTAL_OVERLAP_DAYS', fallback=DEFAULT_INCREMENTAL_OVERLAP_DAYS))
+
     if 'STOP_AT_CLOCK_TIME' in config['SEARCH']:
         stop_at_datetime = get_stop_at_datetime(config['SEARCH']['STOP_AT_CLOCK_TIME'])
     else:
         stop_at_datetime = None
 
+    # Archive raw API results pages so they can be reprocessed with replay_raw_results.py.
+    raw_results_archive = None
+    if config.get('SEARCH', 'RAW_RESULTS_ARCHIVE_DIR', fallback=None):
+        max_segment_mb = config.getint(
+            'SEARCH', 'RAW_RESULTS_MAX_SEGMENT_MB',
+            fallback=raw_results_archive_writer.DEFAULT_MAX_SEGMENT_BYTES // (1024 * 1024))
+        raw_results_archive = raw_results_archive_writer.RawResultsArchiveWriter(
+            config['SEARCH']['RAW_RESULTS_ARCHIVE_DIR'], config['SEARCH']['COUNTRY_CODE'],
+            max_segment_bytes=max_segment_mb * 1024 * 1024)
+
     search_runner_params = SearchRunnerParams(
         country_code=config['SEARCH']['COUNTRY_CODE'],
         facebook_access_token=config_utils.get_facebook_access_token(config),
-        sleep_time=config.getint('SEARCH', 'SLEEP_TIME'),
+        sleep_time=sleep_time,
         request_limit=config.getint('SEARCH', 'LIMIT'),
         max_requests=config.getint('SEARCH', 'MAX_REQUESTS'),
-        stop_at_datetime=stop_at_datetime)
+        stop_at_datetime=stop_at_datetime,
+        use_bulk_writes=config.getboolean('SEARCH', 'BULK_WRITES', fallback=False),
+        pipeline_queue_size=config.getint('SEARCH', 'PIPELINE_QUEUE_SIZE', fallback=0),
+        rate_limiter=rate_controller,
+        graph_api_pool_size=config.getint('SEARCH', 'GRAPH_API_POOL_SIZE',
+                                          fallback=max(num_fetch_workers,
+                                                       graph_api_client.DEFAULT_POOL_SIZE)),
+        graph_api_max_retries=config.getint('SEARCH', 'GRAPH_API_MAX_RETRIES',
+                                            fallback=graph_api_client.DEFAULT_MAX_RETRIES),
+        checkpoint_max_age=checkpoint_max_age,
+        incremental_overlap=incremental_overlap,
+        raw_results_archive=raw_results_archive)
 
     database_connection_params = config_utils.get_database_connection_params_from_config(config)
     search_runner = SearchRunner(
@@ -701,6 +1245,7 @@ def main(config):
     slack_url_for_completion_msg = slack_url_error_channel
     try:
         if page_ids:
+            page_delta = {}
             curr_page_ids = get_page_data(database_connection_params, config)
             for page_id, ad_count in page_ids.items():
                 if page_id in curr_page_ids:
@@ -710,10 +1255,11 @@ def main(config):
                 else:
                     page_delta[page_id] = ad_count
 
-            prioritized_page_ids = [x for x in sorted(page_delta, key=d.get, reverse=True)]
-            #LAE - alter this to work for up to 10 page ids at a time
-            for page_id in prioritized_page_ids:
-                search_runner.run_search(page_id=page_id)
+            prioritized_page_ids = [x for x in sorted(page_delta, key=page_delta.get, reverse=True)]
+            search_runner.run_page_id_search(prioritized_page_ids, num_workers=num_fetch_workers)
+        elif num_date_windows > 1:
+            search_runner.run_date_window_search("''", num_date_windows,
+                                                 num_workers=num_fetch_workers)
         else:
             search_runner.run_search(page_name="''")
         completion_status = 'Success'
@@ -722,6 +1268,8 @@ def main(config):
         completion_status = f'Uncaught exception: {e}'
         logging.error(completion_status, exc_info=True)
     finally:
+        if raw_results_archive:
+            raw_results_archive.close()
         end_time = datetime.datetime.now()
         num_ads_added = search_runner.num_ads_added_to_db()
         num_impressions_added = search_runner.num_impressions_added_to_db()
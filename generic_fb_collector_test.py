@@ -1,9 +1,11 @@
 from collections import defaultdict
+import contextlib
+import datetime
 
 from unittest import TestCase
-from unittest.mock import MagicMock
-from generic_fb_collector import SearchRunner, PageRecord
-from db_functions import DBInterface
+from unittest.mock import MagicMock, patch
+from generic_fb_collector import SearchRunner, SearchRunnerParams
+from db_functions import CrawlCheckpoint, CrawlDateWindow, DBInterface, PageRecord
 
 class GenericFBCollectorTest(TestCase):
 
@@ -74,6 +76,146 @@ class GenericFBCollectorTest(TestCase):
         self.assertEqual(self.search_runner.new_pages, {})
     
 
+class ProcessResultsPagesTest(TestCase):
+
+    def setUp(self):
+        self.db_interface = MagicMock(DBInterface)
+        self.db_interface.insert_funding_entities.return_value = {}
+        with patch('graph_api_client.make_graph_api'):
+            self.search_runner = SearchRunner(
+                crawl_date='2024-01-01', database_connection_params=None,
+                search_runner_params=SearchRunnerParams(
+                    country_code='CA', facebook_access_token='', sleep_time=0, request_limit=1,
+                    max_requests=1, stop_at_datetime=None))
+        self.search_runner.existing_archive_ids = set()
+        self.search_runner.refresh_state = MagicMock()
+
+    def make_result(self, spend_upper_bound, region_percentage):
+        return {
+            'ad_snapshot_url': 'https://testurl.invalid/snapshot?id=111359',
+            'page_id': '65535',
+            'page_name': 'TestPage',
+            'funding_entity': 'TestFundingEntity',
+            'ad_creation_time': '2024-01-01T00:00:00+0000',
+            'spend': {'lower_bound': '0', 'upper_bound': str(spend_upper_bound)},
+            'demographic_distribution': [
+                {'age': '18-24', 'gender': 'female', 'percentage': '1.0'}],
+            'region_distribution': [{'region': 'Ontario', 'percentage': str(region_percentage)}],
+        }
+
+    def process_results_pages(self, results_pages):
+        with patch('db_functions.db_interface_context') as db_interface_context:
+            db_interface_context.return_value = contextlib.nullcontext(self.db_interface)
+            self.search_runner.process_results_pages(results_pages)
+
+    def testSameAdInSeveralPagesIsWrittenOnceWithLatestRows(self):
+        # eg the same ad returned by searches of overlapping date windows.
+        self.process_results_pages([{'data': [self.make_result(99, 0.5)]},
+                                    {'data': [self.make_result(199, 0.25)]}])
+
+        (impressions,), _ = self.db_interface.insert_new_impressions.call_args
+        impressions = list(impressions)
+        self.assertEqual(len(impressions), 1)
+        self.assertEqual(impressions[0].spend__upper_bound, 199)
+
+        # Demo and region writers keep the last of duplicate rows, so rows must be in page order.
+        (demo_columns,), _ = self.db_interface.insert_new_impression_demo_columns.call_args
+        self.assertEqual([row[:3] for row in demo_columns.rows()],
+                         [(111359, '18-24', 'female')] * 2)
+
+        (region_columns,), _ = self.db_interface.insert_new_impression_region_columns.call_args
+        region_rows = region_columns.rows()
+        self.assertEqual([row[:2] for row in region_rows], [(111359, 'Ontario')] * 2)
+        # max_spend of region is percentage * max_spend of ad in page.
+        self.assertAlmostEqual(region_rows[0][-1], 0.5 * 99)
+        self.assertAlmostEqual(region_rows[1][-1], 0.25 * 199)
+
+
+class FetchResultsPagesTest(TestCase):
+
+    def setUp(self):
+        self.graph = MagicMock()
+        with patch('graph_api_client.make_graph_api', return_value=self.graph):
+            self.search_runner = SearchRunner(
+                crawl_date='2024-01-01', database_connection_params=None,
+                search_runner_params=SearchRunnerParams(
+                    country_code='CA', facebook_access_token='', sleep_time=0, request_limit=1,
+                    max_requests=2, stop_at_datetime=None))
+
+    def testResumedSearchGetsFullRequestBudget(self):
+        # Previous run stopped at max_requests.
+        query = self.search_runner.get_search_query(page_name="''")
+        self.search_runner.checkpoints[query] = CrawlCheckpoint(
+            country_code='CA', query=query, cursor='cursor2', request_count=2, completed=False)
+        self.graph.get_object.return_value = {
+            'data': [], 'paging': {'next': 'next_url', 'cursors': {'after': 'cursor3'}}}
+
+        checkpoints = [checkpoint for _, checkpoint in
+                       self.search_runner.fetch_results_pages(page_name="''")]
+
+        self.assertEqual(self.graph.get_object.call_count, 2)
+        self.assertEqual(self.graph.get_object.call_args_list[0][1]['after'], 'cursor2')
+        self.assertEqual([checkpoint.request_count for checkpoint in checkpoints], [3, 4])
+
+
+class RunDateWindowSearchTest(TestCase):
+
+    def setUp(self):
+        self.graph = MagicMock()
+        self.graph.get_object.return_value = {'data': []}
+        with patch('graph_api_client.make_graph_api', return_value=self.graph):
+            self.search_runner = SearchRunner(
+                crawl_date='2024-01-01', database_connection_params=None,
+                search_runner_params=SearchRunnerParams(
+                    country_code='CA', facebook_access_token='', sleep_time=0, request_limit=1,
+                    max_requests=1, stop_at_datetime=None))
+        self.search_runner.existing_archive_ids = set()
+        self.search_runner.refresh_state = MagicMock()
+        self.search_runner.perfrom_post_collection_actions = MagicMock()
+        self.db_interface = MagicMock(DBInterface)
+        self.db_interface.insert_funding_entities.return_value = {}
+
+    def run_date_window_search(self, **kwargs):
+        with patch('db_functions.db_interface_context') as db_interface_context:
+            db_interface_context.return_value = contextlib.nullcontext(self.db_interface)
+            self.search_runner.run_date_window_search("''", 2, **kwargs)
+
+    def searched_date_windows(self):
+        return sorted((call[1]['ad_delivery_date_min'], call[1].get('ad_delivery_date_max'))
+                      for call in self.graph.get_object.call_args_list)
+
+    def completed_window_starts(self):
+        return sorted(start for call in
+                      self.db_interface.mark_crawl_date_windows_completed.call_args_list
+                      for start in call[0][2])
+
+    def testNewCrawlRecordsWindowsWithOpenEndedLatestWindow(self):
+        self.db_interface.uncompleted_crawl_date_windows.return_value = []
+
+        self.run_date_window_search(start_date=datetime.date(2024, 1, 1))
+
+        (_, _, date_windows), _ = self.db_interface.replace_crawl_date_windows.call_args
+        self.assertEqual(date_windows[-1].window_end, None)
+        self.assertEqual(date_windows[0].window_start, datetime.date(2024, 1, 1))
+        self.assertEqual(len(self.searched_date_windows()), 2)
+        self.assertEqual(self.searched_date_windows()[-1][1], None)
+        self.assertEqual(self.completed_window_starts(),
+                         [window.window_start for window in date_windows])
+
+    def testResumedCrawlOnlySearchesUncompletedWindows(self):
+        self.db_interface.uncompleted_crawl_date_windows.return_value = [
+            CrawlDateWindow(datetime.date(2024, 1, 1), datetime.date(2024, 1, 31)),
+            CrawlDateWindow(datetime.date(2024, 3, 1), None)]
+
+        self.run_date_window_search()
+
+        self.db_interface.replace_crawl_date_windows.assert_not_called()
+        self.assertEqual(self.searched_date_windows(),
+                         [('2024-01-01', '2024-01-31'), ('2024-03-01', None)])
+        self.assertEqual(self.completed_window_starts(),
+                         [datetime.date(2024, 1, 1), datetime.date(2024, 3, 1)])
+
+
 if __name__ == '__main__':
     test_class = GenericFBCollectorTest()
     test_class.setUp()
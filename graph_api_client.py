@@ -0,0 +1,53 @@
+"""Graph API client sharing one pooled, keep-alive HTTP session.
+
+Recovering from transient errors by making a new facebook.GraphAPI throws away the underlying
+connections, so every reset pays for a new TCP and TLS handshake. Clients made here reuse the
+session's connection pool instead; broken connections are discarded and replaced by the pool.
+"""
+import facebook
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+GRAPH_API_VERSION = '7.0'
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_FACTOR = 0.5
+_RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES):
+    """Make requests.Session with a keep-alive connection pool of pool_size connections (should be
+    at least the number of threads sharing the session).
+
+    Connection errors and 5xx responses are retried max_retries times with exponential backoff.
+    Other error responses are returned as-is so facebook.GraphAPI can raise GraphAPIError.
+    """
+    retry = Retry(total=max_retries, backoff_factor=DEFAULT_RETRY_BACKOFF_FACTOR,
+                  status_forcelist=_RETRY_STATUS_CODES, allowed_methods=frozenset(['GET']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def make_graph_api(access_token, rate_limiter=None, pool_size=DEFAULT_POOL_SIZE,
+                   max_retries=DEFAULT_MAX_RETRIES):
+    """Make facebook.GraphAPI using a new pooled session.
+
+    Args:
+        access_token: str Facebook API access token.
+        rate_limiter: optional rate_limiter.AdaptiveRateController to update from API usage headers
+            of every response.
+        pool_size: int max number of kept-alive connections.
+        max_retries: int number of retries of connection errors and 5xx responses.
+    Returns:
+        facebook.GraphAPI
+    """
+    session = make_session(pool_size=pool_size, max_retries=max_retries)
+    if rate_limiter:
+        session.hooks['response'].append(rate_limiter.response_hook)
+    return facebook.GraphAPI(access_token=access_token, version=GRAPH_API_VERSION,
+                             session=session)
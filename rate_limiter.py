@@ -0,0 +1,251 @@
+"""Rate limiting shared by API request workers."""
+import json
+import logging
+import threading
+import time
+
+
+class TokenBucketRateLimiter:
+    """Thread safe token bucket. Tokens are added at rate_per_second up to capacity, and each
+    request consumes one token.
+
+    All threads sharing an instance are subject to the same rate, so it can be used to keep several
+    concurrent workers under a single app-level request limit.
+    """
+
+    def __init__(self, rate_per_second, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        if rate_per_second <= 0:
+            raise ValueError('rate_per_second must be positive. got %s' % rate_per_second)
+        self._rate_per_second = rate_per_second
+        self._capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._last_refill_time = clock()
+        self._paused_until = 0
+
+    @property
+    def rate_per_second(self):
+        return self._rate_per_second
+
+    def set_rate(self, rate_per_second):
+        with self._lock:
+            self._refill()
+            self._rate_per_second = rate_per_second
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._last_refill_time
+        self._last_refill_time = now
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate_per_second)
+
+    def _seconds_until_token_available(self):
+        """Take a token and return 0 if one is available, otherwise return seconds to wait.
+        Must be called with lock held."""
+        now = self._clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._rate_per_second
+
+    def acquire(self):
+        """Block until a request is allowed.
+
+        Returns:
+            float seconds spent waiting.
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                wait_time = self._seconds_until_token_available()
+            if not wait_time:
+                return waited
+            self._sleep(wait_time)
+            waited += wait_time
+
+    def pause(self, seconds):
+        """Block all requests for the next seconds (ie after the API reports throttling) and
+        discard accumulated tokens."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self._tokens = 0
+            # Don't accumulate tokens while paused.
+            self._last_refill_time = self._paused_until
+        logging.info('Rate limiter paused for %s seconds.', seconds)
+
+
+# Graph API usage headers. Values are JSON with usage as percentage of quota.
+# https://developers.facebook.com/docs/graph-api/overview/rate-limiting/
+APP_USAGE_HEADER = 'x-app-usage'
+BUSINESS_USE_CASE_USAGE_HEADER = 'x-business-use-case-usage'
+_USAGE_PERCENTAGE_KEYS = ('call_count', 'total_cputime', 'total_time')
+# Graph API error codes reporting throttling. 4 is application level throttling, 613 is
+# "Custom-level throttling".
+# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling/
+THROTTLING_ERROR_CODES = frozenset([4, 613])
+
+
+def response_reports_throttling(response):
+    """Whether requests.Response is a Graph API error with a THROTTLING_ERROR_CODES code."""
+    # Only error responses are parsed, so results pages are not decoded an extra time.
+    if response.status_code < 400:
+        return False
+    try:
+        error = response.json().get('error')
+    except (ValueError, AttributeError):
+        return False
+    return isinstance(error, dict) and error.get('code') in THROTTLING_ERROR_CODES
+
+
+def max_usage_percentage_and_regain_access_seconds(headers):
+    """Parse Graph API usage headers.
+
+    Args:
+        headers: case-insensitive mapping of response headers (ie requests.Response.headers).
+    Returns:
+        tuple of (max usage percentage across all reported quotas, or None if no usage headers
+        present; seconds until access is regained, 0 if not throttled).
+    """
+    max_usage = None
+    regain_access_seconds = 0
+    usage_reports = []
+    app_usage = headers.get(APP_USAGE_HEADER)
+    if app_usage:
+        try:
+            usage_reports.append(json.loads(app_usage))
+        except ValueError:
+            logging.warning('Unable to parse %s header: %s', APP_USAGE_HEADER, app_usage)
+    business_use_case_usage = headers.get(BUSINESS_USE_CASE_USAGE_HEADER)
+    if business_use_case_usage:
+        try:
+            for business_usage_reports in json.loads(business_use_case_usage).values():
+                usage_reports.extend(business_usage_reports)
+        except (ValueError, AttributeError):
+            logging.warning('Unable to parse %s header: %s', BUSINESS_USE_CASE_USAGE_HEADER,
+                            business_use_case_usage)
+
+    for usage_report in usage_reports:
+        for key in _USAGE_PERCENTAGE_KEYS:
+            usage = usage_report.get(key)
+            if usage is not None and (max_usage is None or usage > max_usage):
+                max_usage = usage
+        # estimated_time_to_regain_access is in minutes.
+        regain_access_seconds = max(
+            regain_access_seconds, 60 * usage_report.get('estimated_time_to_regain_access', 0))
+    return max_usage, regain_access_seconds
+
+
+class AdaptiveRateController:
+    """Additive increase/multiplicative decrease (AIMD) controller of API request rate.
+
+    The request rate is increased by rate_increase_per_second after each successful request (while
+    reported quota usage is below low_usage_percentage), and multiplied by decrease_factor when the
+    API reports throttling or quota usage above high_usage_percentage. Thread safe, so one instance
+    can be shared by all workers making requests against the same quota.
+    """
+
+    def __init__(self, initial_rate_per_second, min_rate_per_second, max_rate_per_second,
+                 rate_increase_per_second=None, decrease_factor=0.5, low_usage_percentage=50,
+                 high_usage_percentage=90, throttle_pause_seconds=60, clock=time.monotonic,
+                 sleep=time.sleep):
+        self._min_rate_per_second = min_rate_per_second
+        self._max_rate_per_second = max_rate_per_second
+        self._rate_increase_per_second = rate_increase_per_second or min_rate_per_second
+        self._decrease_factor = decrease_factor
+        self._low_usage_percentage = low_usage_percentage
+        self._high_usage_percentage = high_usage_percentage
+        self._throttle_pause_seconds = throttle_pause_seconds
+        self._last_usage_percentage = None
+        self._lock = threading.Lock()
+        self._rate_limiter = TokenBucketRateLimiter(
+            self._clamp_rate(initial_rate_per_second), clock=clock, sleep=sleep)
+
+    @property
+    def rate_per_second(self):
+        return self._rate_limiter.rate_per_second
+
+    def _clamp_rate(self, rate_per_second):
+        return min(self._max_rate_per_second, max(self._min_rate_per_second, rate_per_second))
+
+    def acquire(self):
+        """Block until next request is allowed. Returns float seconds spent waiting."""
+        return self._rate_limiter.acquire()
+
+    def pause(self, seconds):
+        self._rate_limiter.pause(seconds)
+
+    def on_success(self):
+        with self._lock:
+            if (self._last_usage_percentage is not None and
+                    self._last_usage_percentage >= self._low_usage_percentage):
+                return
+            self._rate_limiter.set_rate(self._clamp_rate(
+                self._rate_limiter.rate_per_second + self._rate_increase_per_second))
+
+    def on_throttle(self, pause_seconds=None):
+        """Decrease rate and pause all requests after API reported throttling (error codes 4, 613
+        or usage over high_usage_percentage)."""
+        with self._lock:
+            new_rate = self._clamp_rate(
+                self._rate_limiter.rate_per_second * self._decrease_factor)
+            self._rate_limiter.set_rate(new_rate)
+        logging.info('API throttling reported, request rate decreased to %.4f requests/second.',
+                     new_rate)
+        self.pause(pause_seconds or self._throttle_pause_seconds)
+
+    def on_usage_headers(self, headers, throttling_reported=False):
+        """Update rate from Graph API usage headers.
+
+        Args:
+            headers: case-insensitive mapping of response headers.
+            throttling_reported: bool True if the response is a throttling error, in which case
+                rate is decreased once by on_throttle (called by the request's caller), so usage
+                headers of the response only pause requests until access is regained.
+        """
+        max_usage, regain_access_seconds = max_usage_percentage_and_regain_access_seconds(headers)
+        if max_usage is None:
+            return
+        with self._lock:
+            self._last_usage_percentage = max_usage
+        logging.debug('API quota usage %s%%', max_usage)
+        if throttling_reported:
+            if regain_access_seconds:
+                self.pause(regain_access_seconds)
+        elif regain_access_seconds:
+            self.on_throttle(pause_seconds=regain_access_seconds)
+        elif max_usage >= self._high_usage_percentage:
+            with self._lock:
+                new_rate = self._clamp_rate(
+                    self._rate_limiter.rate_per_second * self._decrease_factor)
+                self._rate_limiter.set_rate(new_rate)
+            logging.info('API quota usage %s%% exceeds %s%%, request rate decreased to %.4f '
+                         'requests/second.', max_usage, self._high_usage_percentage, new_rate)
+
+    def response_hook(self, response, *args, **kwargs):
+        """requests response hook that updates rate from Graph API usage headers. Install with
+        session.hooks['response'].append(controller.response_hook)."""
+        self.on_usage_headers(response.headers,
+                              throttling_reported=response_reports_throttling(response))
+
+
+def make_adaptive_rate_controller_from_config(config, section='SEARCH'):
+    """Make AdaptiveRateController from config, or None if requests should not be rate limited.
+
+    Initial rate is REQUESTS_PER_MINUTE, or 60 / SLEEP_TIME if not set. Rate is kept between
+    MIN_REQUESTS_PER_MINUTE (default 1) and MAX_REQUESTS_PER_MINUTE (default 4x initial rate).
+    """
+    sleep_time = config.getfloat(section, 'SLEEP_TIME', fallback=0)
+    requests_per_minute = config.getfloat(section, 'REQUESTS_PER_MINUTE',
+                                          fallback=60 / sleep_time if sleep_time else 0)
+    if not requests_per_minute:
+        return None
+    min_requests_per_minute = config.getfloat(section, 'MIN_REQUESTS_PER_MINUTE', fallback=1)
+    max_requests_per_minute = config.getfloat(section, 'MAX_REQUESTS_PER_MINUTE',
+                                              fallback=4 * requests_per_minute)
+    return AdaptiveRateController(initial_rate_per_second=requests_per_minute / 60,
+                                  min_rate_per_second=min_requests_per_minute / 60,
+                                  max_rate_per_second=max_requests_per_minute / 60)
@@ -0,0 +1,108 @@
+import unittest
+
+from rate_limiter import AdaptiveRateController, TokenBucketRateLimiter
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+
+    def json(self):
+        return self.body
+
+
+class TokenBucketRateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_rate_limiter(self, rate_per_second, capacity=1):
+        return TokenBucketRateLimiter(rate_per_second, capacity=capacity, clock=self.clock.time,
+                                      sleep=self.clock.sleep)
+
+    def testAcquireWaitsForToken(self):
+        rate_limiter = self.make_rate_limiter(0.5)
+        self.assertEqual(rate_limiter.acquire(), 0)
+        self.assertAlmostEqual(rate_limiter.acquire(), 2)
+        self.assertAlmostEqual(self.clock.now, 2)
+
+    def testBurstUpToCapacity(self):
+        rate_limiter = self.make_rate_limiter(1, capacity=3)
+        for _ in range(3):
+            self.assertEqual(rate_limiter.acquire(), 0)
+        self.assertAlmostEqual(rate_limiter.acquire(), 1)
+
+    def testPauseBlocksAndDiscardsTokens(self):
+        rate_limiter = self.make_rate_limiter(1, capacity=5)
+        rate_limiter.pause(10)
+        self.assertAlmostEqual(rate_limiter.acquire(), 11)
+        self.assertAlmostEqual(self.clock.now, 11)
+
+    def testInvalidRateRaises(self):
+        with self.assertRaises(ValueError):
+            TokenBucketRateLimiter(0)
+
+
+class AdaptiveRateControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.controller = AdaptiveRateController(
+            initial_rate_per_second=1, min_rate_per_second=0.1, max_rate_per_second=2,
+            rate_increase_per_second=0.5, throttle_pause_seconds=30, clock=self.clock.time,
+            sleep=self.clock.sleep)
+
+    def testAdditiveIncreaseUpToMax(self):
+        self.controller.on_success()
+        self.assertAlmostEqual(self.controller.rate_per_second, 1.5)
+        self.controller.on_success()
+        self.controller.on_success()
+        self.assertAlmostEqual(self.controller.rate_per_second, 2)
+
+    def testThrottleHalvesRateAndPauses(self):
+        self.controller.acquire()
+        self.controller.on_throttle()
+        self.assertAlmostEqual(self.controller.rate_per_second, 0.5)
+        self.assertAlmostEqual(self.controller.acquire(), 32)
+
+    def testHighUsageHeaderDecreasesRateAndBlocksIncrease(self):
+        self.controller.on_usage_headers(
+            {'x-app-usage': '{"call_count": 95, "total_cputime": 10, "total_time": 20}'})
+        self.assertAlmostEqual(self.controller.rate_per_second, 0.5)
+        self.controller.on_success()
+        self.assertAlmostEqual(self.controller.rate_per_second, 0.5)
+
+    def testBusinessUseCaseRegainAccessPauses(self):
+        self.controller.acquire()
+        self.controller.on_usage_headers({'x-business-use-case-usage': (
+            '{"123": [{"type": "ads_archive", "call_count": 100, "total_cputime": 5, '
+            '"total_time": 5, "estimated_time_to_regain_access": 2}]}')})
+        self.assertAlmostEqual(self.controller.acquire(), 122)
+
+    def testThrottlingErrorResponseOnlyDecreasesRateOnce(self):
+        throttled_response = FakeResponse(
+            400, {'error': {'code': 613, 'message': 'Calls to this api have exceeded the rate '
+                                                    'limit.'}},
+            {'x-app-usage': '{"call_count": 100, "total_cputime": 10, "total_time": 20}'})
+        self.controller.response_hook(throttled_response)
+        self.controller.on_throttle()
+        self.assertAlmostEqual(self.controller.rate_per_second, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
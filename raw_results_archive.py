@@ -0,0 +1,139 @@
+"""Archive of raw ads_archive API results pages, so they can be reprocessed without the API.
+
+Pages are appended to gzip compressed JSONL segment files:
+    <archive dir>/<country code>/<crawl date>/<segment start time>-<pid>-<segment number>.jsonl.gz
+Each line is a JSON object with country_code, query, crawl_date, fetch_time, and results (the API
+results page as returned by facebook.GraphAPI.get_object).
+
+Segments are written with a .partial suffix, which is removed when the segment is rotated or the
+archive closed. Readers also read .partial segments (ie from a crashed crawl), up to the last
+complete line.
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import zlib
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+PARTIAL_SEGMENT_SUFFIX = SEGMENT_SUFFIX + '.partial'
+DEFAULT_MAX_SEGMENT_BYTES = 256 * 1024 * 1024
+
+
+class RawResultsArchiveWriter:
+    """Thread safe writer of raw API results pages to rotating compressed JSONL segments."""
+
+    def __init__(self, archive_dir, country_code, max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES):
+        """
+        Args:
+            archive_dir: str path of archive root directory.
+            country_code: str country code of crawl.
+            max_segment_bytes: int, segments are rotated after this many (uncompressed) bytes.
+        """
+        self._archive_dir = archive_dir
+        self._country_code = country_code
+        self._max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._segment_file = None
+        self._segment_path = None
+        self._segment_crawl_date = None
+        self._segment_bytes = 0
+        self._num_segments = 0
+
+    def _open_segment(self, crawl_date):
+        segment_dir = os.path.join(self._archive_dir, self._country_code, crawl_date.isoformat())
+        os.makedirs(segment_dir, exist_ok=True)
+        self._num_segments += 1
+        segment_name = '%s-%d-%d' % (
+            datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ'), os.getpid(),
+            self._num_segments)
+        self._segment_path = os.path.join(segment_dir, segment_name + SEGMENT_SUFFIX)
+        self._segment_file = gzip.open(self._segment_path + '.partial', 'wt', encoding='utf-8')
+        self._segment_crawl_date = crawl_date
+        self._segment_bytes = 0
+
+    def _close_segment(self):
+        if self._segment_file is None:
+            return
+        self._segment_file.close()
+        os.rename(self._segment_path + '.partial', self._segment_path)
+        logging.info('Wrote raw results segment %s (%d bytes uncompressed)', self._segment_path,
+                     self._segment_bytes)
+        self._segment_file = None
+        self._segment_path = None
+
+    def append(self, query, crawl_date, results):
+        """Append API results page to current segment.
+
+        Args:
+            query: str identifying search that returned results (ie
+                generic_fb_collector.get_checkpoint_query).
+            crawl_date: datetime.date of crawl.
+            results: dict API results page.
+        """
+        line = json.dumps({
+            'country_code': self._country_code,
+            'query': query,
+            'crawl_date': crawl_date.isoformat(),
+            'fetch_time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'results': results}) + '\n'
+        with self._lock:
+            if self._segment_file is not None and (
+                    self._segment_crawl_date != crawl_date or
+                    self._segment_bytes >= self._max_segment_bytes):
+                self._close_segment()
+            if self._segment_file is None:
+                self._open_segment(crawl_date)
+            self._segment_file.write(line)
+            self._segment_bytes += len(line)
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+def segment_paths(archive_dir, country_code, start_date=None, end_date=None):
+    """Get sorted list of segment paths for country_code with crawl date between start_date and
+    end_date (inclusive, unbounded if None)."""
+    country_dir = os.path.join(archive_dir, country_code)
+    if not os.path.isdir(country_dir):
+        return []
+    paths = []
+    for crawl_date_dir in sorted(os.listdir(country_dir)):
+        try:
+            crawl_date = datetime.date.fromisoformat(crawl_date_dir)
+        except ValueError:
+            continue
+        if (start_date and crawl_date < start_date) or (end_date and crawl_date > end_date):
+            continue
+        segment_dir = os.path.join(country_dir, crawl_date_dir)
+        paths.extend(os.path.join(segment_dir, name) for name in sorted(os.listdir(segment_dir))
+                     if name.endswith(SEGMENT_SUFFIX) or name.endswith(PARTIAL_SEGMENT_SUFFIX))
+    return paths
+
+
+def read_segment(path):
+    """Generator yielding archived records (dicts) of segment. A truncated segment (ie from a
+    crashed crawl) is read up to the last complete record."""
+    with gzip.open(path, 'rt', encoding='utf-8') as segment_file:
+        try:
+            for line in segment_file:
+                if not line.endswith('\n'):
+                    logging.warning('Ignoring incomplete last record of segment %s', path)
+                    return
+                yield json.loads(line)
+        except (EOFError, zlib.error) as error:
+            logging.warning('Segment %s is truncated, stopping at last complete record: %s', path,
+                            error)
+
+
+def read_records(archive_dir, country_code, start_date=None, end_date=None, query=None):
+    """Generator yielding archived records of country_code with crawl date between start_date and
+    end_date (inclusive), optionally only of query."""
+    for path in segment_paths(archive_dir, country_code, start_date=start_date,
+                              end_date=end_date):
+        for record in read_segment(path):
+            if query is None or record['query'] == query:
+                yield record
@@ -0,0 +1,61 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import raw_results_archive
+
+CRAWL_DATE = datetime.date(2020, 10, 1)
+
+
+class RawResultsArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.archive_dir = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def testWriteRotateAndRead(self):
+        writer = raw_results_archive.RawResultsArchiveWriter(self.archive_dir, 'US',
+                                                             max_segment_bytes=1)
+        writer.append('query1', CRAWL_DATE, {'data': [{'id': 1}]})
+        writer.append('query2', CRAWL_DATE, {'data': [{'id': 2}]})
+        writer.append('query1', CRAWL_DATE + datetime.timedelta(days=1), {'data': [{'id': 3}]})
+        writer.close()
+
+        paths = raw_results_archive.segment_paths(self.archive_dir, 'US')
+        self.assertEqual(len(paths), 3)
+        self.assertTrue(all(path.endswith(raw_results_archive.SEGMENT_SUFFIX) for path in paths))
+        records = list(raw_results_archive.read_records(self.archive_dir, 'US'))
+        self.assertEqual([record['results']['data'][0]['id'] for record in records], [1, 2, 3])
+        self.assertEqual(records[0]['crawl_date'], '2020-10-01')
+        self.assertEqual(
+            [record['query'] for record in raw_results_archive.read_records(
+                self.archive_dir, 'US', start_date=CRAWL_DATE, end_date=CRAWL_DATE)],
+            ['query1', 'query2'])
+        self.assertEqual(
+            len(list(raw_results_archive.read_records(self.archive_dir, 'US', query='query1'))), 2)
+
+    def testReadTruncatedPartialSegment(self):
+        writer = raw_results_archive.RawResultsArchiveWriter(self.archive_dir, 'US')
+        for archive_id in range(100):
+            writer.append('query', CRAWL_DATE, {'data': [{'id': archive_id}]})
+        writer.close()
+        path, = raw_results_archive.segment_paths(self.archive_dir, 'US')
+        with open(path, 'rb') as segment_file:
+            segment_bytes = segment_file.read()
+        os.remove(path)
+        # Simulate crawl that crashed mid write.
+        with open(path + '.partial', 'wb') as segment_file:
+            segment_file.write(segment_bytes[:len(segment_bytes) // 2])
+
+        records = list(raw_results_archive.read_records(self.archive_dir, 'US'))
+        self.assertLess(len(records), 100)
+        self.assertEqual([record['results']['data'][0]['id'] for record in records],
+                         list(range(len(records))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Reprocess API results pages archived by generic_fb_collector (RAW_RESULTS_ARCHIVE_DIR) into the
+database without making any API requests, ie after parser or schema changes.
+
+Usage: python3 replay_raw_results.py <config file> [start crawl date [end crawl date]]
+Dates are YYYY-MM-DD, and default to all archived crawls of the config COUNTRY_CODE.
+"""
+import datetime
+import logging
+import sys
+
+import config_utils
+import generic_fb_collector
+import raw_results_archive
+
+
+def main(config, start_date=None, end_date=None):
+    country_code = config['SEARCH']['COUNTRY_CODE']
+    archive_dir = config['SEARCH']['RAW_RESULTS_ARCHIVE_DIR']
+    search_runner_params = generic_fb_collector.SearchRunnerParams(
+        country_code=country_code,
+        facebook_access_token=config_utils.get_facebook_access_token(config),
+        sleep_time=0,
+        request_limit=config.getint('SEARCH', 'LIMIT'),
+        max_requests=0,
+        stop_at_datetime=None,
+        use_bulk_writes=config.getboolean('SEARCH', 'BULK_WRITES', fallback=False))
+    search_runner = generic_fb_collector.SearchRunner(
+        datetime.date.today(),
+        config_utils.get_database_connection_params_from_config(config),
+        search_runner_params)
+    logging.info('Replaying %s raw results archived in %s from %s to %s.', country_code,
+                 archive_dir, start_date or 'first crawl', end_date or 'last crawl')
+    records = raw_results_archive.read_records(archive_dir, country_code, start_date=start_date,
+                                               end_date=end_date)
+    search_runner.replay_raw_results(records)
+    logging.info('Replay added %d ads and %d impressions.', search_runner.num_ads_added_to_db(),
+                 search_runner.num_impressions_added_to_db())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        exit(f"Usage:python3 {sys.argv[0]} generic_fb_collector.cfg [start date [end date]]")
+    config = config_utils.get_config(sys.argv[1])
+    country_code = config['SEARCH']['COUNTRY_CODE'].lower()
+    config_utils.configure_logger(f"{country_code}_fb_api_replay.log")
+    replay_start_date = None
+    replay_end_date = None
+    if len(sys.argv) > 2:
+        replay_start_date = datetime.date.fromisoformat(sys.argv[2])
+    if len(sys.argv) > 3:
+        replay_end_date = datetime.date.fromisoformat(sys.argv[3])
+    main(config, start_date=replay_start_date, end_date=replay_end_date)
@@ -0,0 +1,150 @@
+"""Batch parsing of ads_archive API results pages into columnar impression distributions."""
+import itertools
+import logging
+import re
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# ad_snapshot_url is https://www.facebook.com/ads/archive/render_ad/?id=<archive ID>&access_token=...
+_SNAPSHOT_URL_ARCHIVE_ID_RE = re.compile(r'[?&]id=(\d+)(?:&|$)')
+
+
+def archive_id_from_snapshot_url(ad_snapshot_url):
+    """Get int archive ID from ad_snapshot_url id query param."""
+    match = _SNAPSHOT_URL_ARCHIVE_ID_RE.search(ad_snapshot_url)
+    if match:
+        return int(match.group(1))
+    return int(parse_qs(urlparse(ad_snapshot_url).query)['id'][0])
+
+
+class DistributionColumns:
+    """Demographic or region impression distribution of a batch of ads, stored as columns.
+
+    Row order (ie the tuples returned by rows()) matches generic_fb_collector.SnapshotDemoRecord
+    and SnapshotRegionRecord fields: archive_id, key columns, spend_percentage, min_impressions,
+    max_impressions, min_spend, max_spend.
+    """
+
+    def __init__(self, archive_ids, key_columns, spend_percentages, min_impressions,
+                 max_impressions, min_spend, max_spend):
+        self.archive_ids = archive_ids
+        self.key_columns = key_columns
+        self.spend_percentages = spend_percentages
+        self.min_impressions = min_impressions
+        self.max_impressions = max_impressions
+        self.min_spend = min_spend
+        self.max_spend = max_spend
+
+    def __len__(self):
+        return len(self.spend_percentages)
+
+    def rows(self):
+        """Get list of row tuples."""
+        return list(zip(self.archive_ids.tolist(), *self.key_columns, self.spend_percentages,
+                        self.min_impressions.tolist(), self.max_impressions.tolist(),
+                        self.min_spend.tolist(), self.max_spend.tolist()))
+
+
+def concatenate_distribution_columns(distribution_columns):
+    """Concatenate DistributionColumns of the same distribution (ie of several results pages),
+    keeping row order.
+
+    Args:
+        distribution_columns: non-empty list of DistributionColumns.
+    Returns:
+        DistributionColumns
+    """
+    if len(distribution_columns) == 1:
+        return distribution_columns[0]
+    return DistributionColumns(
+        archive_ids=np.concatenate([columns.archive_ids for columns in distribution_columns]),
+        key_columns=[list(itertools.chain.from_iterable(key_columns)) for key_columns in
+                     zip(*(columns.key_columns for columns in distribution_columns))],
+        spend_percentages=list(itertools.chain.from_iterable(
+            columns.spend_percentages for columns in distribution_columns)),
+        min_impressions=np.concatenate(
+            [columns.min_impressions for columns in distribution_columns]),
+        max_impressions=np.concatenate(
+            [columns.max_impressions for columns in distribution_columns]),
+        min_spend=np.concatenate([columns.min_spend for columns in distribution_columns]),
+        max_spend=np.concatenate([columns.max_spend for columns in distribution_columns]))
+
+
+def _make_distribution_columns(ads, distributions, key_names, dedupe_keys, distribution_name):
+    """Flatten distributions of ads into columns, and compute impressions and spend bounds of each
+    row as percentage * ad bounds in one vectorized multiply.
+
+    Args:
+        ads: list of generic_fb_collector.AdRecord.
+        distributions: list of distribution list from API result for each ad (same order as ads).
+        key_names: list of str keys of distribution entries that identify the entry.
+        dedupe_keys: bool, if true only the first entry with the same keys is kept for each ad.
+        distribution_name: str for log messages.
+    Returns:
+        DistributionColumns
+    """
+    ad_indexes = []
+    key_columns = [[] for _ in key_names]
+    spend_percentages = []
+    for ad_index, (ad, distribution) in enumerate(zip(ads, distributions)):
+        if not distribution:
+            logging.info("no %s information for: %s", distribution_name, ad.archive_id)
+            continue
+        seen_keys = set()
+        for entry in distribution:
+            try:
+                keys = [entry[key_name] for key_name in key_names]
+                spend_percentage = entry['percentage']
+            except KeyError as key_error:
+                logging.warning('%s error while processing ad archive ID %s %s: %s', key_error,
+                                ad.archive_id, distribution_name, entry)
+                continue
+            if dedupe_keys:
+                # If we get the same keys more than once for an ad, later occurances are dropped.
+                # This is a data losing proposition but can't be helped till FB fixes the results
+                # They provide on the API
+                if tuple(keys) in seen_keys:
+                    continue
+                seen_keys.add(tuple(keys))
+            ad_indexes.append(ad_index)
+            for key_column, key in zip(key_columns, keys):
+                key_column.append(key)
+            spend_percentages.append(spend_percentage)
+
+    ad_bounds = np.array(
+        [(ad.archive_id, int(ad.impressions__lower_bound), int(ad.impressions__upper_bound),
+          int(ad.spend__lower_bound), int(ad.spend__upper_bound)) for ad in ads],
+        dtype=np.int64).reshape(-1, 5)
+    row_ad_bounds = ad_bounds[np.array(ad_indexes, dtype=np.intp)]
+    percentages = np.array(spend_percentages, dtype=np.float64)
+    products = percentages[:, np.newaxis] * row_ad_bounds[:, 1:]
+    return DistributionColumns(
+        archive_ids=row_ad_bounds[:, 0], key_columns=key_columns,
+        spend_percentages=spend_percentages, min_impressions=products[:, 0],
+        max_impressions=products[:, 1], min_spend=products[:, 2], max_spend=products[:, 3])
+
+
+def parse_demographic_distributions(ads, results):
+    """Get DistributionColumns of age_range, gender demographic_distribution of results.
+
+    Args:
+        ads: list of generic_fb_collector.AdRecord parsed from results (same order).
+        results: list of dict API results.
+    """
+    return _make_distribution_columns(
+        ads, [result.get('demographic_distribution', []) for result in results],
+        key_names=['age', 'gender'], dedupe_keys=False,
+        distribution_name='demographic_distribution')
+
+
+def parse_region_distributions(ads, results):
+    """Get DistributionColumns of region_distribution of results.
+
+    Args:
+        ads: list of generic_fb_collector.AdRecord parsed from results (same order).
+        results: list of dict API results.
+    """
+    return _make_distribution_columns(
+        ads, [result.get('region_distribution', []) for result in results],
+        key_names=['region'], dedupe_keys=True, distribution_name='region_distribution')
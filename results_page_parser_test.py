@@ -0,0 +1,66 @@
+import unittest
+
+from generic_fb_collector import AdRecord
+import results_page_parser
+
+
+def make_ad(archive_id, impressions_bounds, spend_bounds):
+    return AdRecord(*([None] * len(AdRecord._fields)))._replace(
+        archive_id=archive_id, impressions__lower_bound=impressions_bounds[0],
+        impressions__upper_bound=impressions_bounds[1], spend__lower_bound=spend_bounds[0],
+        spend__upper_bound=spend_bounds[1])
+
+
+class ResultsPageParserTest(unittest.TestCase):
+
+    def testArchiveIdFromSnapshotUrl(self):
+        self.assertEqual(results_page_parser.archive_id_from_snapshot_url(
+            'https://www.facebook.com/ads/archive/render_ad/?id=123&access_token=abc'), 123)
+        self.assertEqual(results_page_parser.archive_id_from_snapshot_url(
+            'https://www.facebook.com/ads/archive/render_ad/?access_token=abc&id=456'), 456)
+        self.assertEqual(results_page_parser.archive_id_from_snapshot_url(
+            'https://www.facebook.com/ads/archive/render_ad/?page_id=7&id=89'), 89)
+
+    def testParseDemographicDistributions(self):
+        ads = [make_ad(1, (1000, 1999), (100, 199)), make_ad(2, (0, 999), (0, 99))]
+        results = [
+            {'demographic_distribution': [
+                {'percentage': '0.25', 'age': '18-24', 'gender': 'female'},
+                {'percentage': '0.75', 'age': '25-34', 'gender': 'male'}]},
+            {}]
+        rows = results_page_parser.parse_demographic_distributions(ads, results).rows()
+        self.assertEqual(rows, [(1, '18-24', 'female', '0.25', 250.0, 499.75, 25.0, 49.75),
+                                (1, '25-34', 'male', '0.75', 750.0, 1499.25, 75.0, 149.25)])
+
+    def testParseRegionDistributionsKeepsFirstOfDuplicateRegions(self):
+        ads = [make_ad(1, (100, 199), (10, 19))]
+        results = [{'region_distribution': [
+            {'percentage': '0.5', 'region': 'Ohio'},
+            {'percentage': '0.1', 'region': 'Ohio'},
+            {'region': 'Missing percentage'},
+            {'percentage': '0.4', 'region': 'Texas'}]}]
+        rows = results_page_parser.parse_region_distributions(ads, results).rows()
+        self.assertEqual(rows, [(1, 'Ohio', '0.5', 0.5 * 100, 0.5 * 199, 0.5 * 10, 0.5 * 19),
+                                (1, 'Texas', '0.4', 0.4 * 100, 0.4 * 199, 0.4 * 10, 0.4 * 19)])
+
+    def testConcatenateDistributionColumns(self):
+        first_page = results_page_parser.parse_demographic_distributions(
+            [make_ad(1, (100, 199), (10, 19))],
+            [{'demographic_distribution': [
+                {'percentage': '0.5', 'age': '18-24', 'gender': 'female'}]}])
+        empty_page = results_page_parser.parse_demographic_distributions([], [])
+        second_page = results_page_parser.parse_demographic_distributions(
+            [make_ad(2, (0, 999), (0, 99))],
+            [{'demographic_distribution': [
+                {'percentage': '1.0', 'age': '65+', 'gender': 'male'}]}])
+        columns = results_page_parser.concatenate_distribution_columns(
+            [first_page, empty_page, second_page])
+        self.assertEqual(len(columns), 2)
+        self.assertEqual(columns.rows(), first_page.rows() + second_page.rows())
+
+    def testEmptyPage(self):
+        self.assertEqual(results_page_parser.parse_region_distributions([], []).rows(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
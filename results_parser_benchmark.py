@@ -0,0 +1,234 @@
+"""Benchmark row by row vs columnar parsing of ads_archive API results pages demographic and region
+distributions, archive ID extraction from ad_snapshot_url, and datetime parsing.
+
+Results pages are read from a JSONL file (one API results page per line, ie as returned by
+facebook.GraphAPI.get_object), or generated if no file is provided.
+
+Usage: python3 results_parser_benchmark.py [results pages JSONL file]
+"""
+import datetime
+import json
+import logging
+import random
+import sys
+import time
+from urllib.parse import parse_qs, urlparse
+
+from generic_fb_collector import (DATETIME_MIN_UTC, AdRecord, SnapshotDemoRecord,
+                                  SnapshotRegionRecord, get_int_with_default,
+                                  parse_api_result_datetime)
+import results_page_parser
+
+NUM_GENERATED_PAGES = 200
+RESULTS_PER_GENERATED_PAGE = 250
+NUM_ITERATIONS = 5
+_AGE_RANGES = ['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']
+_GENDERS = ['female', 'male', 'unknown']
+_REGIONS = ['Region %d' % i for i in range(60)]
+_DATETIME_FIELDS = ['ad_creation_time', 'ad_delivery_start_time', 'ad_delivery_stop_time']
+
+
+def make_results_pages(num_pages, results_per_page, seed=0):
+    rand = random.Random(seed)
+    archive_id = 10 ** 15
+    pages = []
+    first_creation_time = datetime.datetime(2020, 9, 1, tzinfo=datetime.timezone.utc)
+    for _ in range(num_pages):
+        data = []
+        # Ads are often created in batches, so many ads in a page share creation time.
+        page_creation_times = [
+            (first_creation_time + datetime.timedelta(seconds=rand.randint(0, 60 * 86400))
+            ).strftime('%Y-%m-%dT%H:%M:%S%z') for _ in range(results_per_page // 10)]
+        for _ in range(results_per_page):
+            archive_id += 1
+            ad_creation_time = rand.choice(page_creation_times)
+            impressions_lower_bound = rand.choice([0, 1000, 5000, 10000, 50000])
+            spend_lower_bound = rand.choice([0, 100, 500, 1000])
+            data.append({
+                'ad_snapshot_url': ('https://www.facebook.com/ads/archive/render_ad/?id=%d&'
+                                    'access_token=abc123' % archive_id),
+                'impressions': {'lower_bound': str(impressions_lower_bound),
+                                'upper_bound': str(impressions_lower_bound * 2 - 1)},
+                'spend': {'lower_bound': str(spend_lower_bound),
+                          'upper_bound': str(spend_lower_bound * 2 - 1)},
+                'ad_creation_time': ad_creation_time,
+                'ad_delivery_start_time': ad_creation_time,
+                'ad_delivery_stop_time': ad_creation_time[:10],
+                'demographic_distribution': [
+                    {'percentage': '%.6f' % rand.random(), 'age': age, 'gender': gender}
+                    for age in _AGE_RANGES for gender in _GENDERS],
+                'region_distribution': [
+                    {'percentage': '%.6f' % rand.random(), 'region': region}
+                    for region in rand.sample(_REGIONS, rand.randint(1, 30))],
+            })
+        pages.append({'data': data})
+    return pages
+
+
+def read_results_pages(path):
+    with open(path) as jsonl_file:
+        return [json.loads(line) for line in jsonl_file if line.strip()]
+
+
+def make_ads(results, archive_id_from_url):
+    """Make AdRecords with fields used by distribution parsing."""
+    ads = []
+    for result in results:
+        impressions__lower_bound = get_int_with_default(
+            result.get('impressions', dict()).get('lower_bound'), default=0)
+        spend__lower_bound = get_int_with_default(
+            result.get('spend', dict()).get('lower_bound'), default=0)
+        ads.append(AdRecord(*([None] * len(AdRecord._fields)))._replace(
+            archive_id=archive_id_from_url(result['ad_snapshot_url']),
+            impressions__lower_bound=impressions__lower_bound,
+            impressions__upper_bound=get_int_with_default(
+                result.get('impressions', dict()).get('upper_bound'),
+                default=impressions__lower_bound),
+            spend__lower_bound=spend__lower_bound,
+            spend__upper_bound=get_int_with_default(
+                result.get('spend', dict()).get('upper_bound'), default=spend__lower_bound)))
+    return ads
+
+
+def archive_id_with_parse_qs(ad_snapshot_url):
+    return int(parse_qs(urlparse(ad_snapshot_url).query)['id'][0])
+
+
+def parse_datetime_with_strptime(datetime_str):
+    """Previous parse_api_result_datetime implementation."""
+    try:
+        return datetime.datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%S%z')
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.strptime(datetime_str, '%Y-%m-%d').replace(
+            tzinfo=datetime.timezone.utc)
+    except ValueError:
+        pass
+    return DATETIME_MIN_UTC
+
+
+def parse_page_datetimes(parse_datetime, datetime_strs):
+    return [parse_datetime(datetime_str) for datetime_str in datetime_strs]
+
+
+def parse_page_datetimes_with_cold_cache(datetime_strs):
+    parse_api_result_datetime.cache_clear()
+    return parse_page_datetimes(parse_api_result_datetime, datetime_strs)
+
+
+def row_by_row_distributions(ads, results):
+    """Previous SearchRunner.process_demo_impressions/process_region_impressions implementation."""
+    demos = []
+    regions = []
+    for curr_ad, result in zip(ads, results):
+        for demo_result in result.get('demographic_distribution', []):
+            demos.append(SnapshotDemoRecord(
+                curr_ad.archive_id,
+                demo_result['age'],
+                demo_result['gender'],
+                demo_result['percentage'],
+                float(demo_result['percentage']) * int(curr_ad.impressions__lower_bound),
+                float(demo_result['percentage']) * int(curr_ad.impressions__upper_bound),
+                float(demo_result['percentage']) * int(curr_ad.spend__lower_bound),
+                float(demo_result['percentage']) * int(curr_ad.spend__upper_bound)))
+        seen_regions = set()
+        for region_result in result.get('region_distribution', []):
+            if region_result['region'] in seen_regions:
+                continue
+            seen_regions.add(region_result['region'])
+            regions.append(SnapshotRegionRecord(
+                curr_ad.archive_id,
+                region_result['region'],
+                region_result['percentage'],
+                float(region_result['percentage']) * int(curr_ad.impressions__lower_bound),
+                float(region_result['percentage']) * int(curr_ad.impressions__upper_bound),
+                float(region_result['percentage']) * int(curr_ad.spend__lower_bound),
+                float(region_result['percentage']) * int(curr_ad.spend__upper_bound)))
+    return demos, regions
+
+
+def columnar_distributions(ads, results):
+    return (results_page_parser.parse_demographic_distributions(ads, results).rows(),
+            results_page_parser.parse_region_distributions(ads, results).rows())
+
+
+def time_per_page(function, pages_args):
+    """Get (best of NUM_ITERATIONS) seconds per page to call function on every page."""
+    best_seconds = None
+    for _ in range(NUM_ITERATIONS):
+        start_time = time.perf_counter()
+        for args in pages_args:
+            function(*args)
+        seconds = time.perf_counter() - start_time
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return best_seconds / len(pages_args)
+
+
+def main(argv):
+    if argv:
+        results_pages = read_results_pages(argv[0])
+    else:
+        results_pages = make_results_pages(NUM_GENERATED_PAGES, RESULTS_PER_GENERATED_PAGE)
+    pages_results = [[result for result in page['data'] if 'ad_snapshot_url' in result]
+                     for page in results_pages]
+    num_results = sum(len(results) for results in pages_results)
+    logging.info('Benchmarking %d results pages with %d results.', len(pages_results),
+                 num_results)
+
+    snapshot_urls = [[(result['ad_snapshot_url'],) for result in results]
+                     for results in pages_results]
+    urls_args = [(urls,) for urls in snapshot_urls]
+    parse_qs_seconds = time_per_page(
+        lambda urls: [archive_id_with_parse_qs(*url) for url in urls], urls_args)
+    regex_seconds = time_per_page(
+        lambda urls: [results_page_parser.archive_id_from_snapshot_url(*url) for url in urls],
+        urls_args)
+    logging.info('archive ID from ad_snapshot_url: parse_qs %.3fms/page, regex %.3fms/page '
+                 '(%.1fx speedup)', parse_qs_seconds * 1000, regex_seconds * 1000,
+                 parse_qs_seconds / regex_seconds)
+
+    pages_datetime_strs = [[result[field] for result in results for field in _DATETIME_FIELDS
+                            if result.get(field)] for results in pages_results]
+    for datetime_strs in pages_datetime_strs:
+        if (parse_page_datetimes(parse_datetime_with_strptime, datetime_strs) !=
+                parse_page_datetimes(parse_api_result_datetime.__wrapped__, datetime_strs)):
+            sys.exit('Fast datetime parsing results differ from strptime parsing.')
+    strptime_seconds = time_per_page(
+        parse_page_datetimes, [(parse_datetime_with_strptime, datetime_strs)
+                               for datetime_strs in pages_datetime_strs])
+    uncached_seconds = time_per_page(
+        parse_page_datetimes, [(parse_api_result_datetime.__wrapped__, datetime_strs)
+                               for datetime_strs in pages_datetime_strs])
+    cold_cache_seconds = time_per_page(
+        parse_page_datetimes_with_cold_cache, [(datetime_strs,)
+                                               for datetime_strs in pages_datetime_strs])
+    parse_api_result_datetime.cache_clear()
+    warm_cache_seconds = time_per_page(
+        parse_page_datetimes, [(parse_api_result_datetime, datetime_strs)
+                               for datetime_strs in pages_datetime_strs])
+    logging.info('%d datetimes per page: strptime %.3fms/page, fast path %.3fms/page, fast path '
+                 'with per page cache %.3fms/page, with crawl wide cache %.3fms/page (%.1fx '
+                 'speedup)', sum(map(len, pages_datetime_strs)) / len(pages_datetime_strs),
+                 strptime_seconds * 1000, uncached_seconds * 1000, cold_cache_seconds * 1000,
+                 warm_cache_seconds * 1000, strptime_seconds / warm_cache_seconds)
+
+    pages_args = [(make_ads(results, archive_id_with_parse_qs), results)
+                  for results in pages_results]
+    for ads, results in pages_args:
+        row_by_row_demos, row_by_row_regions = row_by_row_distributions(ads, results)
+        columnar_demos, columnar_regions = columnar_distributions(ads, results)
+        if (list(map(tuple, row_by_row_demos)) != columnar_demos or
+                list(map(tuple, row_by_row_regions)) != columnar_regions):
+            sys.exit('Columnar parsing results differ from row by row parsing.')
+    row_by_row_seconds = time_per_page(row_by_row_distributions, pages_args)
+    columnar_seconds = time_per_page(columnar_distributions, pages_args)
+    logging.info('demographic and region distributions: row by row %.3fms/page, columnar '
+                 '%.3fms/page (%.1fx speedup)', row_by_row_seconds * 1000,
+                 columnar_seconds * 1000, row_by_row_seconds / columnar_seconds)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -115,6 +115,8 @@ CREATE TABLE ad_snapshot_metadata (
   snapshot_fetch_time timestamp with timezone,
   snapshot_fetch_status int,
   snapshot_fetch_batch_id bigint,
+  -- Fetch priority of snapshot when it was last batched or rescored by archive_id_batcher.
+  snapshot_fetch_priority double precision,
   last_modified_time timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
   PRIMARY KEY (archive_id),
   CONSTRAINT archive_id_fk FOREIGN KEY (archive_id) REFERENCES ads (archive_id) MATCH SIMPLE ON UPDATE NO ACTION ON DELETE NO ACTION,
@@ -199,7 +201,13 @@ CREATE TABLE snapshot_fetch_batches (
   batch_id bigserial PRIMARY KEY,
   time_started timestamp with time zone,
   time_completed timestamp with time zone,
-  last_modified_time timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+  -- Claim by worker_id is valid until lease_expiry_time, after which another worker may claim the
+  -- batch.
+  lease_expiry_time timestamp with time zone,
+  worker_id character varying,
+  -- Max priority of snapshots in batch. Batches are claimed highest priority first.
+  priority double precision,
+  last_modified_time timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
 );
 
 CREATE TABLE ad_ids (
@@ -207,6 +215,28 @@ CREATE TABLE ad_ids (
   archive_id bigint NOT NULL,
   CONSTRAINT unique_ad_id_archive_id UNIQUE(ad_id, archive_id)
 );
+-- Last ads_archive API results page cursor written by a collector, so interrupted crawls can resume.
+CREATE TABLE crawl_checkpoints (
+  country_code character varying NOT NULL,
+  query character varying NOT NULL,
+  cursor character varying,
+  request_count integer NOT NULL DEFAULT 0,
+  completed boolean NOT NULL DEFAULT FALSE,
+  last_modified_time timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+  PRIMARY KEY (country_code, query)
+);
+-- Delivery date windows of the latest date windowed crawl of each country and crawl query, so
+-- that windows completed by an interrupted crawl are not crawled again when it resumes.
+CREATE TABLE crawl_date_windows (
+  country_code character varying NOT NULL,
+  crawl_query character varying NOT NULL,
+  window_start date NOT NULL,
+  -- NULL if the window is open-ended.
+  window_end date,
+  completed boolean NOT NULL DEFAULT FALSE,
+  last_modified_time timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+  PRIMARY KEY (country_code, crawl_query, window_start)
+);
 
 -- Triggers to automatatically update the last_modified_time on every update.
 CREATE EXTENSION IF NOT EXISTS moddatetime;
@@ -301,8 +331,34 @@ FOR EACH ROW
 WHEN (OLD IS DISTINCT FROM NEW)
 EXECUTE PROCEDURE moddatetime(last_modified_time);
 
+CREATE TRIGGER crawl_checkpoints_moddatetime
+BEFORE UPDATE ON crawl_checkpoints
+FOR EACH ROW
+WHEN (OLD IS DISTINCT FROM NEW)
+EXECUTE PROCEDURE moddatetime(last_modified_time);
+
+CREATE TRIGGER crawl_date_windows_moddatetime
+BEFORE UPDATE ON crawl_date_windows
+FOR EACH ROW
+WHEN (OLD IS DISTINCT FROM NEW)
+EXECUTE PROCEDURE moddatetime(last_modified_time);
+
 CREATE INDEX ads_page_id_idx ON public.ads USING btree (page_id);
 CREATE INDEX ads_page_id_ad_delivery_start_time_idx ON public.ads USING btree (page_id, ad_delivery_start_time ASC);
+-- Used by fb_ad_creative_retriever to claim uncompleted snapshot fetch batches.
+CREATE INDEX snapshot_fetch_batches_uncompleted_idx ON public.snapshot_fetch_batches USING btree (priority DESC NULLS LAST, batch_id DESC) WHERE time_completed IS NULL;
+CREATE INDEX ad_snapshot_metadata_unfetched_batch_id_idx ON public.ad_snapshot_metadata USING btree (snapshot_fetch_batch_id) WHERE needs_scrape = TRUE;
+-- Used by archive_id_batcher to find snapshots whose fetch priority may have changed.
+CREATE INDEX impressions_last_modified_time_idx ON public.impressions USING btree (last_modified_time);
+CREATE INDEX impressions_last_active_date_idx ON public.impressions USING btree (last_active_date);
+CREATE INDEX ad_snapshot_metadata_snapshot_fetch_time_idx ON public.ad_snapshot_metadata USING btree (snapshot_fetch_time);
+-- Used by fb_ad_creative_retriever to skip uploading media that is already stored.
+CREATE INDEX ad_creatives_image_bucket_path_idx ON public.ad_creatives USING btree (image_bucket_path);
+CREATE INDEX ad_creatives_video_bucket_path_idx ON public.ad_creatives USING btree (video_bucket_path);
+-- Used by collectors to incrementally refresh cached state.
+CREATE INDEX pages_last_modified_time_idx ON public.pages USING btree (last_modified_time);
+CREATE INDEX funder_metadata_last_modified_time_idx ON public.funder_metadata USING btree (last_modified_time);
+CREATE INDEX page_name_history_last_modified_time_idx ON public.page_name_history USING btree (last_modified_time);
 
 -- Crowdtangle database
 